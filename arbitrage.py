@@ -1,14 +1,10 @@
 #!/bin/python
 
-from datetime import datetime
+# The books are fetched from the exchange at once (see
+# functions.log_arbitrage), not read from the market data server of
+# the logger, whose books are fetched one after another
+
 from functions import log_arbitrage
 
 if __name__ == '__main__':
-    path = os.path.join(
-        'arbitrage',
-        datetime.now().strftime('%Y%m%d-%H:%M'))
-
-    log_arbitrage(path)
-
-
-
+    log_arbitrage('arbitrage')
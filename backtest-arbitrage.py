@@ -0,0 +1,194 @@
+#!/bin/env python3
+
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from kraken import KrakenData
+from functions import DepthMatrix, ArbitrageLP, pair_depth, top_depth_matrix, \
+    negative_cycles, cycle_str, head_depth_matrix
+import numpy as np
+import json
+import os
+
+# read-only database connection of a worker process
+kraken = None
+
+def _init_worker(db_path):
+    """Open a read-only database connection in a worker process
+
+    db_path --- path for the database location
+    """
+    global kraken
+    kraken = KrakenData(db_path = db_path, read_only = True)
+
+def get_pairs(kraken, names, fee = 0.26, fee_maker = 0.16, pairs_file = ''):
+    """Pair metadata in the format of functions.query_tradable_pairs
+
+    The fees are not stored in the database, they are either taken
+    from a pairs.json exported by snapshots.py or set to the given
+    values for all pairs.
+
+    kraken --- KrakenData object
+    names --- list of trading pairs
+    fee, fee_maker --- fees in percent
+    pairs_file --- optional pairs.json
+
+    """
+    saved = {}
+    if pairs_file:
+        with open(pairs_file, 'r') as f:
+            saved = json.load(f)
+
+    res = {}
+    for pair in names:
+        if pair in saved:
+            res[pair] = saved[pair]
+            continue
+
+        info = kraken.get_pair_info(pair)
+        res[pair] = {'base': info['base'], 'quote': info['quote'],
+                     'fees': [[0, fee]], 'fees_maker': [[0, fee_maker]]}
+
+    return res
+
+def get_time_grid(kraken, pairs, step, start = None, end = None):
+    """Time points covered by the snapshots of all pairs
+
+    kraken --- KrakenData object
+    pairs --- list of trading pairs
+    step --- seconds between time points
+    start, end --- optional time interval
+
+    return --- np.array of time points
+
+    """
+    first, last = [], []
+    for pair in pairs:
+        times = kraken.get_snapshot_times(pair, start, end)
+        if len(times):
+            first += [times[0]]
+            last += [times[-1]]
+
+    if 0 == len(first):
+        return np.zeros(0, dtype=int)
+
+    start = min(first) if start is None else start
+    end = max(last) if end is None else end
+
+    return np.arange(start, end, step)
+
+def backtest_chunk(times, pairs, owncur = "ZEUR", head = 2, tol = 1e-9):
+    """Look for arbitrage at the given time points
+
+    Has to be called in a worker process (see _init_worker). The books
+    of all pairs are reconstructed in one pass per pair
+    (KrakenData.iter_books). The depth-aware LP is solved (warm
+    started, see ArbitrageLP) only at the time points where the top of
+    the books has a cycle (see negative_cycles).
+
+    times --- sorted list of time points
+    pairs --- see get_pairs
+    owncur --- own currency
+    head --- number of first volumes of a pair, the n of
+    head_depth_matrix (at most head - 1 slices in a direction)
+    tol --- minimal profit
+
+    return --- tuple (number of time points, list of tuples (time,
+    owncur, cycles, size, profit, solution)), see
+    KrakenData._insert_to_ArbitrageOpportunities
+
+    """
+    books = {pair: kraken.iter_books(pair, times) for pair in pairs}
+    session = ArbitrageLP(pairs, [owncur], head)
+
+    res = []
+    for t in times:
+        orderbook = {}
+        for pair, it in books.items():
+            _, asks, bids = next(it)
+            if len(asks) and len(bids):
+                orderbook[pair] = {pair: {'asks': asks, 'bids': bids}}
+
+        top = top_depth_matrix(orderbook, pairs)
+        cycles = negative_cycles(top)
+        if 0 == len(cycles):
+            continue
+
+        prices = DepthMatrix.from_pairs([pair_depth(key, item[key], pairs)
+                                         for key, item in orderbook.items()])
+        prices = head_depth_matrix(prices, n = head)
+        if owncur not in prices.currencies:
+            continue
+
+        sol = session.solve(prices)
+        if not sol['objective'] > tol:
+            continue
+
+        # own currency spent on the exchanges from it
+        out = prices.fr == prices.currencies.index(owncur)
+        size = (sol['x'][out]/prices.price[prices.rev[out]]).sum()
+
+        res += [(int(t), owncur,
+                 json.dumps([(cycle_str(c, top), g) for c, g in cycles]),
+                 float(size), float(sol['objective']),
+                 json.dumps({prices.key(int(k[1:])): v
+                             for k, v in sol['solution'].items() if 'x' == k[0]}))]
+
+    return (len(times), res)
+
+def _backtest_chunk(args):
+    """Helper of backtest_chunk for Pool.imap_unordered"""
+    return backtest_chunk(*args)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='backtest-arbitrage',
+                            description='Look for arbitrage in the order book history')
+    parser.add_argument('--db', default='data/data.db', type=str,
+                        help='Location of the database. Default: data/data.db')
+    parser.add_argument('-p','--pairs', default=[], nargs='*',
+                        help='Currency pairs. Default: all pairs in database')
+    parser.add_argument('--pairs-file', default='', type=str,
+                        help='Pairs with fees (pairs.json exported by snapshots.py)')
+    parser.add_argument('--fee', default=0.26, type=float,
+                        help='Taker fee in percent, unless in --pairs-file. Default: 0.26')
+    parser.add_argument('--fee-maker', default=0.16, type=float,
+                        help='Maker fee in percent, unless in --pairs-file. Default: 0.16')
+    parser.add_argument('--own', default='ZEUR', type=str,
+                        help='Own currency. Default: ZEUR')
+    parser.add_argument('--start', default=None, type=int, help='Start time')
+    parser.add_argument('--end', default=None, type=int, help='End time')
+    parser.add_argument('--step', default=60, type=int,
+                        help='Seconds between time points. Default: 60')
+    parser.add_argument('--chunk', default=24*3600, type=int,
+                        help='Length of a time range of a task in seconds. Default: one day')
+    parser.add_argument('-j','--jobs', default=os.cpu_count(), type=int,
+                        help='Number of processes. Default: number of cores')
+    args = parser.parse_args()
+
+    data = KrakenData(db_path = args.db)
+    names = args.pairs if len(args.pairs) else data._get_pairs()
+    pairs = get_pairs(data, names, args.fee, args.fee_maker, args.pairs_file)
+    times = get_time_grid(data, names, args.step, args.start, args.end)
+
+    # stored once here, so that the workers bound their scans without
+    # going through the whole history (see KrakenData.iter_books)
+    for pair in names:
+        data._get_max_lifetime(data._get_pair_id(pair))
+
+    n = max(1, args.chunk//args.step)
+    tasks = [([int(x) for x in times[i:i+n]], pairs, args.own)
+             for i in range(0, len(times), n)]
+
+    print("number of time points: " + str(len(times)) + ", tasks: " + str(len(tasks)))
+
+    # the results are committed chunk by chunk, the workers hold their
+    # read locks only while fetching the rows of a chunk
+    done = 0
+    found = 0
+    with Pool(processes = args.jobs, initializer = _init_worker,
+              initargs = (args.db,)) as pool:
+        for n_times, res in pool.imap_unordered(_backtest_chunk, tasks):
+            data._insert_to_ArbitrageOpportunities(res)
+            done += n_times
+            found += len(res)
+            print("Processed " + str(done) + "/" + str(len(times)) +
+                  " time points, opportunities: " + str(found))
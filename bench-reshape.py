@@ -0,0 +1,154 @@
+#!/bin/env python3
+
+from argparse import ArgumentParser
+from functions import orderbook2commonvolumes, depth_matrix
+from math import isclose
+
+import numpy as np
+import json
+import time
+
+def loop_reshape_by_volume(item, by_volumes, tol=1e-6):
+    """orderbook_reshape_by_volume before the vectorisation, the
+    baseline of the benchmark
+
+    :item: orderbook entry
+    :by_volumes: a list of volumes in the output orderbook entry
+    :return: orderbook entry
+    """
+    item = np.array(item).astype(float)
+
+    res = []
+    i = 0
+    cur = item[i,:].copy()
+
+    for v in by_volumes:
+        if i >= item.shape[0]:
+            res += [[cur[0],v,cur[2]]]
+            continue
+
+        while v > cur[1] or isclose(v,cur[1],abs_tol=tol):
+            if not isclose(cur[1],0, abs_tol = tol):
+                res += [[cur[0],cur[1],cur[2]]]
+            v -= cur[1]
+            i += 1
+            if i >= item.shape[0]:
+                break
+            cur = item[i,:].copy()
+
+        if isclose(v,0,abs_tol = tol):
+            continue
+
+        if i >= item.shape[0]:
+            continue
+
+        res += [[cur[0],v,cur[2]]]
+        cur[1] -= v
+
+    return res
+
+def loop_commonvolumes(item1,item2):
+    """orderbook2commonvolumes before the vectorisation, the baseline
+    of the benchmark
+
+    :item1,item2: orderbook entries
+    :return: (res1,res2) a tuple of converted orderbook entries
+    """
+    A = np.array(item1)
+    B = np.array(item2)
+
+    vA = np.cumsum(A[:,1].astype(float))
+    vB = np.cumsum(B[:,1].astype(float))
+    V = np.unique(np.concatenate((vA,vB),axis=0))
+    V = np.diff(np.concatenate(([0],V),axis=0))
+
+    resA = loop_reshape_by_volume(A,V)
+    resB = loop_reshape_by_volume(B,V)
+
+    if len(resA) != len(resB):
+        raise RuntimeError("loop_reshape_by_volume: different number of slices")
+
+    return (resA,resB)
+
+def synthetic_market(n_pairs, n_levels, seed=0):
+    """Random order books and pairs
+
+    :n_pairs: number of pairs
+    :n_levels: number of orders in asks and bids
+    :return: tuple (orderbook, pairs) as query_orderbook and
+    query_tradable_pairs return
+    """
+    rng = np.random.default_rng(seed)
+    orderbook = {}
+    pairs = {}
+
+    for i in range(n_pairs):
+        key = 'B' + str(i) + 'Q' + str(i % 7)
+        pairs[key] = {'base': 'B' + str(i), 'quote': 'Q' + str(i % 7),
+                      'fees': [[0, 0.26]], 'fees_maker': [[0, 0.16]]}
+
+        mid = rng.lognormal()
+        asks = mid*(1.001 + np.cumsum(rng.exponential(1e-4, n_levels)))
+        bids = mid*(0.999 - np.cumsum(rng.exponential(1e-4, n_levels)))
+        orderbook[key] = {key: {
+            'asks': [["%.8f" % p, "%.8f" % v, 0] for p,v in
+                     zip(asks, rng.exponential(1, n_levels))],
+            'bids': [["%.8f" % p, "%.8f" % v, 0] for p,v in
+                     zip(bids, rng.exponential(1, n_levels))]}}
+
+    return orderbook, pairs
+
+def timeit(f, repeat):
+    res = []
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        res += [time.time() - start]
+
+    return min(res)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='bench-reshape',
+                            description='Benchmark common volumes and depth matrix')
+    parser.add_argument('-p','--pairs', default=80, type=int,
+                        help='Number of synthetic pairs. Default: 80')
+    parser.add_argument('-n','--levels', default=500, type=int,
+                        help='Number of orders in asks and bids. Default: 500')
+    parser.add_argument('-r','--repeat', default=3, type=int,
+                        help='Number of repetitions, the best is reported. Default: 3')
+    parser.add_argument('-j','--jobs', default=4, type=int,
+                        help='Number of processes for the depth_matrix comparison. Default: 4')
+    parser.add_argument('--orderbook', default='', type=str,
+                        help='Use order books exported by snapshots.py (orderbook.json)')
+    parser.add_argument('--pairs-file', default='', type=str,
+                        help='Pairs exported by snapshots.py (pairs.json), for --orderbook')
+    args = parser.parse_args()
+
+    if args.orderbook:
+        with open(args.orderbook, 'r') as f:
+            orderbook = json.load(f)
+        with open(args.pairs_file, 'r') as f:
+            pairs = json.load(f)
+    else:
+        orderbook, pairs = synthetic_market(args.pairs, args.levels)
+
+    def commonvolumes(f):
+        for key,item in orderbook.items():
+            f(item[key]['asks'], item[key]['bids'])
+
+    # the loop version is slow, it is run once
+    base = timeit(lambda: commonvolumes(loop_commonvolumes), 1)
+    print("orderbook2commonvolumes, baseline loop: {:.4f}s for {} pairs ({:.3f}ms per pair)".\
+          format(base, len(orderbook), 1000*base/len(orderbook)))
+
+    t = timeit(lambda: commonvolumes(orderbook2commonvolumes), args.repeat)
+    print("orderbook2commonvolumes: {:.4f}s for {} pairs ({:.3f}ms per pair), {:.1f}x".\
+          format(t, len(orderbook), 1000*t/len(orderbook), base/t))
+
+    serial = timeit(lambda: depth_matrix(orderbook, pairs), args.repeat)
+    print("depth_matrix: {:.4f}s for {} pairs".format(serial, len(orderbook)))
+
+    # a pool is started on every call, it does not pay off for books
+    # of the size of the Kraken market (see depth_matrix)
+    t = timeit(lambda: depth_matrix(orderbook, pairs, processes=args.jobs), args.repeat)
+    print("depth_matrix, {} processes: {:.4f}s, {:.2f}x of serial".format(args.jobs, t, serial/t))
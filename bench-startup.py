@@ -0,0 +1,153 @@
+#!/bin/env python3
+
+from argparse import ArgumentParser
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+# directory of krak and of the modules
+path = os.path.dirname(os.path.realpath(__file__))
+
+modules = ['formats', 'marketdata', 'kraken', 'krakenapi', 'functions', 'monitor', 'inference']
+
+def import_time(module, repeat):
+    """Best import time of a module in a fresh interpreter
+
+    module --- module name
+    repeat --- number of interpreters to start
+
+    return --- seconds, without the interpreter start
+    """
+    code = "import time; t = time.perf_counter(); import " + module + \
+        "; print(time.perf_counter() - t)"
+
+    res = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd = path,
+                             stdout = subprocess.PIPE, check = True)
+        res += [float(out.stdout)]
+
+    return min(res)
+
+def run_time(args, repeat):
+    """Best wall time of a command
+
+    args --- command line
+    repeat --- number of runs
+
+    return --- seconds
+    """
+    res = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, cwd = path, stdout = subprocess.DEVNULL,
+                       stderr = subprocess.DEVNULL)
+        res += [time.perf_counter() - start]
+
+    return min(res)
+
+def start_time(args, fn, repeat, timeout = 60):
+    """Best wall time from the start of a command until a file appears
+
+    The command (with its child processes) is killed once the file
+    appears, e.g. the logger once its market data socket is served.
+
+    args --- command line
+    fn --- file to wait for, removed before every run
+    repeat --- number of runs
+
+    return --- seconds
+    """
+    res = []
+    for _ in range(repeat):
+        if os.path.exists(fn):
+            os.remove(fn)
+
+        start = time.perf_counter()
+        proc = subprocess.Popen(args, cwd = path, stdout = subprocess.DEVNULL,
+                                stderr = subprocess.DEVNULL, start_new_session = True)
+        try:
+            while not os.path.exists(fn):
+                if proc.poll() is not None:
+                    raise RuntimeError("Command exited before " + fn + " appeared")
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError("Timeout waiting for " + fn)
+                time.sleep(0.001)
+            res += [time.perf_counter() - start]
+        finally:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+
+    return min(res)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='bench-startup',
+                            description='Benchmark import times and krak start-up')
+    parser.add_argument('-r','--repeat', default=5, type=int,
+                        help='Number of repetitions, the best is reported. Default: 5')
+    parser.add_argument('--db', default='', type=str,
+                        help='Database for "krak depth --local" and the logger start. ' + \
+                        'Default: skip them')
+    parser.add_argument('-p','--pair', default='XXBTZEUR', type=str,
+                        help='Currency pair for "krak depth --local". Default: XXBTZEUR')
+    args = parser.parse_args()
+
+    for module in modules:
+        print("import {:<12} {:8.1f} ms".format(module, 1000*import_time(module, args.repeat)))
+
+    python = run_time([sys.executable, '-c', 'pass'], args.repeat)
+    print("{:<40} {:8.1f} ms".format("python", 1000*python))
+
+    krak = [sys.executable, os.path.join(path, 'krak')]
+    commands = [('krak --help', ['--help']),
+                ('krak depth --help', ['depth', '--help']),
+                ('krak logger --help', ['logger', '--help'])]
+
+    tmp = tempfile.mkdtemp()
+    server = None
+
+    if args.db:
+        from kraken import KrakenData
+        from marketdata import MarketDataServer
+
+        # the market data server of a running logger
+        socket = os.path.join(tmp, 'market.sock')
+        server = MarketDataServer(socket, KrakenData(db_path = args.db, read_only = True))
+        server.start()
+
+        commands += [('krak depth --local (database)',
+                      ['depth', '--local', '-p', args.pair, '--db', args.db,
+                       '--socket', '']),
+                     ('krak depth --local (socket)',
+                      ['depth', '--local', '-p', args.pair, '--db', args.db,
+                       '--socket', socket])]
+
+    try:
+        for name, command in commands:
+            t = run_time(krak + command, args.repeat)
+            print("{:<40} {:8.1f} ms ({:.1f} ms over python)".\
+                  format(name, 1000*t, 1000*(t - python)))
+
+        if args.db:
+            # the logger runs on a copy of the database, it is killed
+            # once it serves the market data socket, i.e. before the
+            # first sweep
+            db = os.path.join(tmp, 'data.db')
+            shutil.copy(args.db, db)
+            socket = os.path.join(tmp, 'logger.sock')
+
+            t = start_time(krak + ['logger', '--db', db, '--socket', socket,
+                                   '--logfile', os.path.join(tmp, 'logger.log')],
+                           socket, args.repeat)
+            print("{:<40} {:8.1f} ms ({:.1f} ms over python)".\
+                  format('krak logger (until socket is served)', 1000*t, 1000*(t - python)))
+    finally:
+        if server is not None:
+            server.close()
+        shutil.rmtree(tmp)
@@ -0,0 +1,161 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import threading
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from kraken import Kraken
+
+def snapshot_skew(received):
+    """Seconds between the first and the last book of a snapshot
+
+    received --- dict pair -> receive time, see SnapshotCollector.sweep
+
+    """
+    if 0 == len(received):
+        return 0
+
+    return max(received.values()) - min(received.values())
+
+def start_workers(pool, max_workers, init):
+    """Run init once in every worker thread of a pool
+
+    The workers wait for each other at a barrier, so that each of them
+    takes one of the tasks. If init raises in a worker, the barrier is
+    aborted, so that the other workers do not wait forever, the pool
+    is shut down and the error is raised.
+
+    pool --- ThreadPoolExecutor
+    max_workers --- number of workers of the pool
+    init --- function called without arguments in every worker,
+    e.g. the one creating the client of the thread
+
+    """
+    barrier = threading.Barrier(max_workers)
+
+    def start():
+        try:
+            init()
+        except Exception:
+            barrier.abort()
+            raise
+        barrier.wait()
+
+    futures = [pool.submit(start) for _ in range(max_workers)]
+    wait(futures)
+
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if len(errors):
+        pool.shutdown(wait = False)
+        # the error of init, not the broken barrier of the others
+        errors.sort(key = lambda e: isinstance(e, threading.BrokenBarrierError))
+        raise errors[0]
+
+class SnapshotCollector(object):
+    """Order books of several pairs, fetched as close in time as possible
+
+    functions.query_orderbook fetches the books one after another, so
+    that the books of one sweep are seconds apart and the arbitrage
+    found in them might not exist. Here all requests of a sweep are
+    sent at once, every worker thread has its own client (created by
+    the constructor). Before a sweep the collector waits until the
+    call counter allows all its requests (Kraken.wait_budget), so that
+    none of them is held back by the rate control in the middle of the
+    sweep. Sweeps larger than the budget are sent in batches.
+
+    """
+
+    def __init__(self, client_factory = Kraken, count = 20, max_workers = 16):
+        """Constructor
+
+        client_factory --- function returning a new client with
+        query_public (e.g. kraken.Kraken). The wait for the budget is
+        done if the client has wait_budget
+        count --- maximum number of asks/bids
+        max_workers --- number of requests sent at once
+
+        """
+        self._factory = client_factory
+        self._count = count
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers = max_workers)
+
+        # start all workers with their clients
+        start_workers(self._pool, max_workers, self._client)
+
+    def _client(self):
+        """Client of the current thread"""
+        if not hasattr(self._local, 'client'):
+            self._local.client = self._factory()
+
+        return self._local.client
+
+    def _fetch(self, pair):
+        """Order book of a pair
+
+        return --- tuple (pair, API response, receive time)
+
+        """
+        try:
+            x = self._client().query_public('Depth', {'pair': pair, 'count': self._count})
+        except Exception as e:
+            x = {'error': [str(e)]}
+
+        return (pair, x, time.time())
+
+    def sweep(self, pairs):
+        """Fetch the order books of the pairs
+
+        pairs --- list of pair names, e.g. all pairs or the pairs of
+        the candidate cycles (see functions.cycle_pairs)
+
+        return --- tuple (orderbook, received), where orderbook is in
+        the format of functions.query_orderbook and received is a dict
+        pair -> time the book was received. Pairs with API errors are
+        missing
+
+        """
+        client = self._client()
+        budget = client._counter_limit() - 1 if hasattr(client, 'wait_budget') \
+            else len(pairs)
+
+        orderbook, received = {}, {}
+        for i in range(0, len(pairs), max(1, budget)):
+            batch = pairs[i:i + max(1, budget)]
+            if hasattr(client, 'wait_budget'):
+                client.wait_budget(len(batch))
+
+            for pair, x, t in self._pool.map(self._fetch, batch):
+                if len(x['error']):
+                    logging.error("API error for " + pair + ": " + str(x['error']))
+                    continue
+
+                orderbook[pair] = x['result']
+                received[pair] = t
+
+        logging.info("Order books: " + str(len(orderbook)) + ", skew " +
+                     "{:.3f}".format(snapshot_skew(received)) + "s")
+
+        return orderbook, received
+
+    def close(self):
+        self._pool.shutdown()
@@ -75,6 +75,17 @@ FOREIGN KEY(pair_id) REFERENCES pairs(id),
 CONSTRAINT uc_orderID UNIQUE (price, time, type, volume, pair_id)
 );
 
+-- longest time an order of a pair has been in the orderBook (time_l -
+-- time). It bounds the scans over the orderBook from below: an order
+-- alive at time t has been created after t - lifetime
+CREATE TABLE IF NOT EXISTS orderBookLifetime
+(
+pair_id INTEGER NOT NULL,                 -- pair name
+lifetime INTEGER NOT NULL,                -- maximum of time_l - time
+FOREIGN KEY(pair_id) REFERENCES pairs(id),
+CONSTRAINT uc_lifetime UNIQUE (pair_id)
+);
+
 -- table containing recent trades
 CREATE TABLE IF NOT EXISTS trades
 (
@@ -188,7 +199,106 @@ FOREIGN KEY(refid) REFERENCES tradesPrivate(refid)
 );
 
 
+-- refids of the ledger entries written to ledger files
+CREATE TABLE IF NOT EXISTS ledgerExported
+(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+refid varchar(19) NOT NULL,               -- trade id string
+filename TEXT NOT NULL,                   -- ledger file
+time REAL NOT NULL,                       -- time of the export
+CONSTRAINT uc_ledgerExported UNIQUE (refid, filename)
+);
+
+
+-- refids of the ledger entries that are not written to ledger files
+CREATE TABLE IF NOT EXISTS ledgerSkipped
+(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+refid varchar(19) NOT NULL,               -- trade id string
+filename TEXT NOT NULL,                   -- ledger file
+time REAL NOT NULL,                       -- time of the export
+reason TEXT NOT NULL,                     -- why the entries are not converted
+CONSTRAINT uc_ledgerSkipped UNIQUE (refid, filename)
+);
+
+
+-- table for storing predictions of the live models
+CREATE TABLE IF NOT EXISTS predictions
+(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+pair_id INTEGER NOT NULL,                 -- pair name
+time INTEGER NOT NULL,                    -- snapshot time the prediction is made for
+model varchar(255) NOT NULL,              -- model name
+prediction REAL NOT NULL,                 -- predicted class
+latency REAL,                             -- seconds between book receive and prediction
+FOREIGN KEY(pair_id) REFERENCES pairs(id),
+CONSTRAINT uc_prediction UNIQUE (pair_id, time, model)
+);
+
+-- table for storing arbitrage opportunities found in the history
+CREATE TABLE IF NOT EXISTS arbitrageOpportunities
+(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+time INTEGER NOT NULL,                    -- snapshot time
+owncur varchar(4) NOT NULL,               -- own currency
+cycles TEXT,                              -- cycles with the gains at the top of the books
+size REAL NOT NULL,                       -- volume of own currency put in
+profit REAL NOT NULL,                     -- volume of own currency gained (LP objective)
+solution TEXT,                            -- json of the volumes of the exchanges
+CONSTRAINT uc_opportunity UNIQUE (time, owncur)
+);
+
 -- index is needed to search among the names of tradable pairs
 CREATE INDEX IF NOT EXISTS pairs_name_Index ON pairs (name);
 CREATE INDEX IF NOT EXISTS pairs_altname_Index ON pairs (altname);
 
+-- index is needed for incremental ledger syncs and exports
+CREATE INDEX IF NOT EXISTS ledger_time_Index ON ledger (time);
+
+-- index is needed for ordered passes over the order book of a pair
+CREATE INDEX IF NOT EXISTS orderBook_pair_time_Index ON orderBook (pair_id, time);
+
+
+-- packed order book frames. A keyframe (keyframe = 1) holds the full
+-- book of a pair at a snapshot time, a delta frame (keyframe = 0)
+-- holds only the levels changed since the previous snapshot of the
+-- pair (zero volume marks a removed level). Levels are stored as
+-- packed little-endian float64 (price, volume) pairs.
+CREATE TABLE IF NOT EXISTS orderBookFrames
+(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+pair_id INTEGER NOT NULL,                 -- pair name
+time INTEGER NOT NULL,                    -- snapshot time
+keyframe INTEGER NOT NULL,                -- 1 for keyframes, 0 for deltas
+asks BLOB NOT NULL,                       -- packed asks levels
+bids BLOB NOT NULL,                       -- packed bids levels
+FOREIGN KEY(pair_id) REFERENCES pairs(id),
+CONSTRAINT uc_frame UNIQUE (pair_id, time)
+);
+
+-- catalog of collected order book snapshots. Each snapshot points to
+-- the keyframe it is based on, so a book is rebuilt from a single
+-- keyframe and at most frame_offset delta frames.
+CREATE TABLE IF NOT EXISTS orderBookSnapshots
+(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+pair_id INTEGER NOT NULL,                 -- pair name
+time INTEGER NOT NULL,                    -- snapshot time
+keyframe_time INTEGER NOT NULL,           -- time of the base keyframe
+frame_offset INTEGER NOT NULL,            -- number of delta frames since keyframe
+FOREIGN KEY(pair_id) REFERENCES pairs(id),
+CONSTRAINT uc_snapshot UNIQUE (pair_id, time)
+);
+
+-- latest stored order book of every pair, kept by the logger for
+-- instant local depth queries. The levels are packed as in
+-- orderBookFrames
+CREATE TABLE IF NOT EXISTS orderBookLatest
+(
+pair_id INTEGER PRIMARY KEY,              -- pair name
+time INTEGER NOT NULL,                    -- snapshot time (Kraken time)
+received REAL,                            -- local time the book was received at
+asks BLOB NOT NULL,                       -- packed asks levels
+bids BLOB NOT NULL,                       -- packed bids levels
+FOREIGN KEY(pair_id) REFERENCES pairs(id)
+);
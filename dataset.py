@@ -0,0 +1,162 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import os
+
+import numpy as np
+
+from features import load_features
+
+def windows(features, T):
+    """Sliding windows of T consecutive rows
+
+    The result is a read-only view on features, nothing is copied.
+
+    features --- np.array of shape (n, d)
+    T --- number of rows in a window
+
+    return --- np.array of shape (n-T+1, T, d), where window i
+    consists of rows i,...,i+T-1
+
+    """
+    n, d = features.shape
+    s0, s1 = features.strides
+
+    return np.lib.stride_tricks.as_strided(features, shape = (max(n-T+1, 0), T, d),
+                                           strides = (s0, s0, s1), writeable = False)
+
+class FeatureDataset(object):
+    """Out-of-core access to exported depth features
+
+    The dataset is either a single directory written by FeatureWriter
+    or an export directory with manifest.json (see
+    export-depth-data.py), in which case the partitions of a pair are
+    used in time order. Windows never cross partition borders.
+
+    """
+
+    def __init__(self, path, pair = None):
+        """Constructor
+
+        path --- dataset or export directory
+        pair --- pair to use from the manifest. Default: first pair
+
+        """
+        manifest = os.path.join(path, "manifest.json")
+
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as f:
+                partitions = json.load(f)['partitions']
+
+            if pair is None and len(partitions):
+                pair = partitions[0]['pair']
+
+            paths = [os.path.join(path, x['path']) for x in
+                     sorted(partitions, key = lambda x: x['start'])
+                     if x['pair'] == pair]
+        else:
+            paths = [path]
+
+        self._parts = [load_features(x) for x in paths]
+
+    def __len__(self):
+        return sum(len(x['times']) for x in self._parts)
+
+    def _concat(self, name):
+        if 1 == len(self._parts):
+            return self._parts[0][name]
+
+        return np.concatenate([x[name] for x in self._parts])
+
+    @property
+    def times(self):
+        """Snapshot times of all rows
+
+        Rows of different partitions are concatenated, a time series
+        computation over them would span the gaps between the
+        partitions (see labels).
+
+        """
+        return self._concat('times')
+
+    @property
+    def price(self):
+        """Market prices of all rows, see times"""
+        return self._concat('price')
+
+    def labels(self, fun, *args):
+        """Labels computed on every partition separately
+
+        fun --- function of the market prices returning labels of the
+        first rows, e.g. labels.get_classes
+        args --- further arguments of fun
+
+        return --- list of np.array, labels of the partitions
+
+        """
+        return [fun(x['price'], *args) for x in self._parts]
+
+    def windows(self, T):
+        """Zero-copy sliding windows of T prior snapshots
+
+        T --- number of snapshots in a window
+
+        return --- generator of tuples (offset, windows), where
+        offset is the row index (in the whole dataset) of the first
+        snapshot of the partition and windows is the view given by
+        the windows function. Window i ends at row offset + i + T - 1
+
+        """
+        offset = 0
+        for x in self._parts:
+            yield (offset, windows(x['features'], T))
+            offset += len(x['times'])
+
+    def iter_batches(self, T, labels, batch_size = 10000, start = 0, stop = None):
+        """Stream mini-batches of stacked windows
+
+        Only a mini-batch is ever copied to memory.
+
+        T --- number of snapshots in a window
+
+        labels --- list of np.array, labels of the rows of every
+        partition (see the labels method). Windows ending at a row
+        beyond the labels of its partition are skipped
+
+        batch_size --- number of windows in a batch
+
+        start, stop --- range of rows (of the window ends) to use
+
+        return --- generator of tuples (X, y), X has shape
+        (batch_size, T*d)
+
+        """
+        stop = len(self) if stop is None else stop
+
+        for (offset, w), y_part in zip(self.windows(T), labels):
+            # rows of the window ends inside of [start, stop)
+            lo = max(start - offset - T + 1, 0)
+            hi = min(stop - offset - T + 1, w.shape[0], len(y_part) - T + 1)
+
+            for i in range(lo, hi, batch_size):
+                j = min(i + batch_size, hi)
+                X = w[i:j].reshape(j - i, -1)
+                y = y_part[i + T - 1:j + T - 1]
+
+                yield (X, y)
@@ -2,18 +2,37 @@
 
 import sys
 
+import os
+
 from kraken import Kraken
 
 from functions import depth_format
 
-k = Kraken()
-
 arg = dict()
 
 arg['pair'] = sys.argv[1] if len(sys.argv) > 1 else 'XXBTZEUR' 
 arg['count'] = '2000'
 
-depth = k.query_public('Depth',arg)
+# market data socket of "krak logger --socket", the book stored by
+# the logger is used if it is served. The exchange is queried otherwise
+socket_path = os.path.expanduser(sys.argv[2]) if len(sys.argv) > 2 else ''
+
+depth = None
+if socket_path and os.path.exists(socket_path):
+    from marketdata import MarketDataClient
+    client = MarketDataClient(socket_path)
+    book = client.book(arg['pair'], arrays=False)
+    client.close()
+
+    if book is not None:
+        t, asks, bids = book
+        depth = {'error': [],
+                 'result': {arg['pair']: {'asks': [[p, v, t] for p, v in asks],
+                                          'bids': [[p, v, t] for p, v in bids]}}}
+
+if depth is None:
+    k = Kraken()
+    depth = k.query_public('Depth',arg)
 
 try:
     print(depth_format(depth['result'],arg['pair']))
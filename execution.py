@@ -0,0 +1,461 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import math
+
+import threading
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import pair_fees, f2s
+
+from collector import start_workers
+
+def _round(x, decimals, rounding):
+    """Round to decimals with math.floor or math.ceil"""
+    scale = 10**decimals
+    # tolerance for prices that are exact in decimal but not in binary
+    return rounding(x*scale + (1e-9 if rounding is math.floor else -1e-9))/scale
+
+def _isclose_volume(x, volume):
+    """Whether x is the order volume (a string with lot_decimals)"""
+    decimals = len(volume.split('.')[1]) if '.' in volume else 0
+    return abs(float(x) - float(volume)) < 0.5*10**-decimals
+
+def solution_orders(solution, prices, pairs, timeinforce = 'IOC'):
+    """Limit orders of an LP solution
+
+    All slices of a pair in one direction make a single order. Its
+    limit is the worst price of the slices (the fees are taken out as
+    in functions.pair_depth), rounded to pair_decimals towards the
+    book. The volume is rounded down to lot_decimals. Legs below the
+    minimal order volume of the pair are dropped.
+
+    solution --- dict edge index -> volume in the 'to' currency
+    (e.g. the first output of functions.print_strategy). Other keys
+    are ignored
+    prices --- the DepthMatrix of the solution
+    pairs --- whatever functions.query_tradable_pairs returns
+    timeinforce --- time in force of the orders, None for GTC
+
+    return --- list of dictionaries, the AddOrder arguments
+
+    """
+    legs = {}
+    for k, x in solution.items():
+        if isinstance(k, str) or not x > 0:
+            continue
+
+        key = prices.pairs[prices.pair[k]]
+        fp, fq = pair_fees(key, pairs)
+        rate = prices.price[prices.rev[k]]
+
+        if prices.to[k] == prices.base[k]:
+            type_, volume, price = 'buy', x, 1/(rate*(1+fp))
+        else:
+            type_, volume, price = 'sell', x/rate, rate/(1-fq)
+
+        if (key, type_) not in legs:
+            legs[(key, type_)] = [0, price]
+
+        leg = legs[(key, type_)]
+        leg[0] += volume
+        leg[1] = max(leg[1], price) if 'buy' == type_ else min(leg[1], price)
+
+    res = []
+    for (key, type_), (volume, price) in legs.items():
+        pd, ld = pairs[key]['pair_decimals'], pairs[key]['lot_decimals']
+        price = _round(price, pd, math.ceil if 'buy' == type_ else math.floor)
+        volume = _round(volume, ld, math.floor)
+
+        if volume <= 0 or volume < float(pairs[key].get('ordermin', 0)):
+            logging.warning("Leg " + type_ + " " + f2s(volume) + " " + key +
+                            " is below the minimal order volume, dropped")
+            continue
+
+        order = {'pair': key, 'type': type_, 'ordertype': 'limit',
+                 'price': "{:.{}f}".format(price, pd),
+                 'volume': "{:.{}f}".format(volume, ld)}
+        if timeinforce is not None:
+            order['timeinforce'] = timeinforce
+
+        res += [order]
+
+    return res
+
+class _Nonce(object):
+    """Nonces shared by the clients of one key
+
+    krakenex takes milliseconds as the nonce, which repeats for
+    requests sent at once. The nonce here is the same clock, but
+    strictly increasing.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = 0
+
+    def __call__(self):
+        with self._lock:
+            self._last = max(self._last + 1, int(1000*time.time()))
+            return self._last
+
+class ArbitrageExecutor(object):
+    """Concurrent execution of the legs of an arbitrage
+
+    All legs are submitted at once, every worker thread has its own
+    client (a krakenex session and the call counter database can not
+    be shared between threads). The clients are created by the
+    constructor, so that the first execution does not pay for
+    it. AddOrder is free in the call rate (Kraken._query_cost), the
+    fills are tracked afterwards with QueryOrders.
+
+    The requests of the legs share the nonce sequence but might
+    arrive out of order, the API key needs a nonce window.
+
+    If a leg fails, or the fills are not complete within the
+    timeout, the legs still open are canceled. Filled legs are not
+    unwound: the execution tells which legs failed and how much of
+    every leg is executed, it is up to the caller to rebalance.
+
+    """
+
+    def __init__(self, client_factory, pairs, max_workers = 8, poll = 0.5,
+                 timeout = 30, validate = False, min_interval = 5):
+        """Constructor
+
+        client_factory --- function returning a new client with
+        query_private (kraken.Kraken with a key, or MockExchange)
+        pairs --- whatever functions.query_tradable_pairs returns
+        max_workers --- number of legs submitted at once
+        poll --- seconds between the fill queries
+        timeout --- seconds to track the fills
+        validate --- validate the orders only, nothing is placed
+        min_interval --- seconds between the executions of
+        on_opportunity
+
+        """
+        self._factory = client_factory
+        self._pairs = pairs
+        self._poll = poll
+        self._timeout = timeout
+        self._validate = validate
+        self._min_interval = min_interval
+        self._last = -float('inf')
+
+        self._nonce = _Nonce()
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers = max_workers)
+        self._tracker = ThreadPoolExecutor(max_workers = 1)
+
+        # start all workers with their clients
+        start_workers(self._pool, max_workers, self._client)
+        start_workers(self._tracker, 1, self._client)
+
+    def _client(self):
+        """Client of the current thread"""
+        if not hasattr(self._local, 'client'):
+            self._local.client = self._factory()
+            self._local.client._nonce = self._nonce
+
+        return self._local.client
+
+    def _submit(self, order):
+        """Place one order
+
+        return --- dictionary with the 'order', the 'sent' and 'acked'
+        times, the API 'error' and the 'txid' of the order
+
+        """
+        data = dict(order)
+        if self._validate:
+            data['validate'] = True
+
+        sent = time.time()
+        try:
+            x = self._client().query_private('AddOrder', data)
+        except Exception as e:
+            x = {'error': [str(e)]}
+
+        return {'order': order, 'sent': sent, 'acked': time.time(),
+                'error': x.get('error', []),
+                'txid': x.get('result', {}).get('txid', [])}
+
+    def execute(self, orders, detected = None):
+        """Submit all orders concurrently
+
+        orders --- list of AddOrder arguments, see solution_orders
+        detected --- detection time of the opportunity. Default: now
+
+        return --- dictionary with 'detected', 'legs' (see _submit),
+        'failed' (the legs with an API error), 'submitted' (seconds
+        from the detection to sending the last leg) and 'latency' (to
+        the last acknowledgement). If a leg failed, the other legs are
+        canceled (see cancel)
+
+        """
+        detected = time.time() if detected is None else detected
+
+        legs = [f.result() for f in [self._pool.submit(self._submit, x) for x in orders]]
+
+        res = {'detected': detected, 'legs': legs,
+               'failed': [x for x in legs if len(x['error'])],
+               'submitted': max([x['sent'] for x in legs], default=detected) - detected,
+               'latency': max([x['acked'] for x in legs], default=detected) - detected}
+
+        for leg in res['failed']:
+            logging.error("Leg " + str(leg['order']) + " failed: " + str(leg['error']))
+
+        if len(res['failed']) and not self._validate:
+            self.cancel(res)
+
+        logging.info("Arbitrage legs: " + str(len(legs)) + ", submitted after " +
+                     f2s(res['submitted'], "{:.6f}") + "s, acknowledged after " +
+                     f2s(res['latency'], "{:.6f}") + "s")
+
+        return res
+
+    def cancel(self, execution):
+        """Cancel the placed orders of an execution
+
+        Orders that are already closed are left as they are.
+
+        execution --- whatever execute returns
+
+        return --- list of txids, which could not be canceled
+
+        """
+        txids = [txid for leg in execution['legs'] for txid in leg['txid']
+                 if leg.get('status') not in ('closed', 'canceled', 'expired')]
+
+        def cancel(txid):
+            try:
+                x = self._client().query_private('CancelOrder', {'txid': txid})
+            except Exception as e:
+                x = {'error': [str(e)]}
+            return x['error']
+
+        errors = list(self._pool.map(cancel, txids))
+
+        res = [txid for txid, error in zip(txids, errors) if len(error)]
+        for txid, error in zip(txids, errors):
+            if len(error):
+                logging.error("Cancel of " + txid + " failed: " + str(error))
+
+        return res
+
+    def track(self, execution, timeout = None):
+        """Wait for the legs to be closed
+
+        The legs still open after the timeout are canceled.
+
+        execution --- whatever execute returns, the legs get 'status',
+        'vol_exec' and 'price' (average) of their orders
+        timeout --- seconds. Default: timeout of the constructor
+
+        return --- execution with 'filled', True if all legs are
+        executed completely
+
+        """
+        timeout = self._timeout if timeout is None else timeout
+        legs = [x for x in execution['legs'] if len(x['txid'])]
+        end = time.time() + timeout
+        canceled = False
+
+        while len(legs):
+            x = self._client().query_private('QueryOrders', {
+                'txid': ",".join(txid for leg in legs for txid in leg['txid'])})
+
+            if len(x['error']):
+                logging.error("API error while tracking the fills: " + str(x['error']))
+            else:
+                for leg in legs:
+                    info = [x['result'][txid] for txid in leg['txid'] if txid in x['result']]
+                    if 0 == len(info):
+                        continue
+                    leg['status'] = info[0]['status']
+                    leg['vol_exec'] = sum(float(y['vol_exec']) for y in info)
+                    leg['price'] = float(info[0]['price'])
+
+                legs = [leg for leg in legs
+                        if leg.get('status') not in ('closed', 'canceled', 'expired')]
+
+            if 0 == len(legs) or canceled:
+                break
+            if time.time() + self._poll > end:
+                # the fills are queried once more after the cancel
+                logging.warning("Arbitrage legs open after " + f2s(timeout, "{:.1f}") +
+                                "s, canceled")
+                self.cancel({'legs': legs})
+                canceled = True
+                continue
+            time.sleep(self._poll)
+
+        execution['filled'] = all(
+            x.get('status') == 'closed' and
+            _isclose_volume(x.get('vol_exec', 0), x['order']['volume'])
+            for x in execution['legs'])
+
+        logging.info("Arbitrage fills: " + ", ".join(
+            x['order']['type'] + " " + f2s(x.get('vol_exec', 0)) + "/" +
+            x['order']['volume'] + " " + x['order']['pair'] + " " +
+            str(x.get('status', x['error'])) for x in execution['legs']))
+
+        return execution
+
+    def on_opportunity(self, opportunity):
+        """Execute an opportunity of monitor.ArbitrageMonitor
+
+        The legs are submitted before anything else is done, the fills
+        are tracked in the background. Opportunities that come within
+        min_interval from the previous execution are only logged.
+
+        opportunity --- dictionary, see ArbitrageMonitor.__call__
+
+        return --- whatever execute returns, with 'tracking', the
+        future of track (None in validate mode). None if nothing is
+        executed
+
+        """
+        if opportunity['detected'] - self._last < self._min_interval:
+            logging.info("Arbitrage skipped: objective " + f2s(opportunity['objective']))
+            return None
+
+        orders = solution_orders(opportunity['edges'], opportunity['prices'], self._pairs)
+        if 0 == len(orders):
+            return None
+
+        self._last = opportunity['detected']
+        res = self.execute(orders, detected = opportunity['detected'])
+
+        logging.info("Arbitrage: " + ", ".join(c + " " + f2s(g) for c, g in opportunity['cycles']) +
+                     "; objective " + f2s(opportunity['objective']))
+
+        res['tracking'] = None if self._validate else self._tracker.submit(self.track, res)
+
+        return res
+
+    def close(self):
+        self._pool.shutdown()
+        self._tracker.shutdown()
+
+class MockExchange(object):
+    """Local exchange for testing the execution
+
+    Implements AddOrder, QueryOrders and CancelOrder of
+    krakenex.API.query_private on fixed order books. Orders are
+    matched on arrival against the opposite side and consume its
+    volume; the rest is canceled for IOC orders and stays open (not
+    matched anymore) otherwise. Fees are paid in the quote currency
+    as in functions.pair_fees. One instance is shared by all threads.
+
+    """
+
+    def __init__(self, orderbook, pairs, balances = None, latency = 0):
+        """Constructor
+
+        orderbook --- whatever functions.query_orderbook returns
+        pairs --- whatever functions.query_tradable_pairs returns
+        balances --- dict currency -> amount. Default: unlimited
+        latency --- seconds every request takes
+
+        """
+        self._books = {key: {x: sorted([[float(p), float(v)] for p, v, *_ in item[key][x]],
+                                       reverse = ('bids' == x))
+                             for x in ('asks', 'bids')}
+                       for key, item in orderbook.items()}
+        self._pairs = pairs
+        self.balances = balances
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.orders = {}
+
+    def query_private(self, method, data = None, timeout = None):
+        time.sleep(self._latency)
+
+        data = {} if data is None else data
+        with self._lock:
+            return getattr(self, '_' + method)(data)
+
+    def _AddOrder(self, data):
+        key = data['pair']
+        if key not in self._books:
+            return {'error': ['EQuery:Unknown asset pair']}
+        if 'limit' != data.get('ordertype'):
+            return {'error': ['EGeneral:Invalid arguments:ordertype']}
+
+        type_, price, volume = data['type'], float(data['price']), float(data['volume'])
+        descr = {'order': type_ + " " + data['volume'] + " " + key + " @ limit " + data['price']}
+        if data.get('validate'):
+            return {'error': [], 'result': {'descr': descr}}
+
+        fp, fq = pair_fees(key, self._pairs)
+        base, quote = self._pairs[key]['base'], self._pairs[key]['quote']
+
+        book = self._books[key]['asks' if 'buy' == type_ else 'bids']
+        if self.balances is not None:
+            need = (quote, volume*price*(1+fp)) if 'buy' == type_ else (base, volume)
+            if self.balances.get(need[0], 0) < need[1]:
+                return {'error': ['EOrder:Insufficient funds']}
+
+        vol_exec, cost = 0, 0
+        while len(book) and vol_exec < volume and \
+              (book[0][0] <= price if 'buy' == type_ else book[0][0] >= price):
+            v = min(book[0][1], volume - vol_exec)
+            vol_exec += v
+            cost += v*book[0][0]
+            book[0][1] -= v
+            if book[0][1] <= 0:
+                book.pop(0)
+
+        if self.balances is not None:
+            sign = 1 if 'buy' == type_ else -1
+            self.balances[base] = self.balances.get(base, 0) + sign*vol_exec
+            self.balances[quote] = self.balances.get(quote, 0) - sign*cost - \
+                cost*(fp if 'buy' == type_ else fq)
+
+        if vol_exec >= volume:
+            status = 'closed'
+        elif 'IOC' == data.get('timeinforce'):
+            status = 'canceled'
+        else:
+            status = 'open'
+
+        txid = 'O' + str(len(self.orders))
+        self.orders[txid] = {'status': status, 'descr': descr,
+                             'vol': data['volume'], 'vol_exec': f2s(vol_exec),
+                             'cost': f2s(cost),
+                             'price': f2s(cost/vol_exec if vol_exec > 0 else 0)}
+
+        return {'error': [], 'result': {'descr': descr, 'txid': [txid]}}
+
+    def _QueryOrders(self, data):
+        return {'error': [], 'result': {x: dict(self.orders[x]) for x in
+                                        data['txid'].split(',') if x in self.orders}}
+
+    def _CancelOrder(self, data):
+        if data['txid'] not in self.orders:
+            return {'error': ['EOrder:Unknown order']}
+        if 'open' == self.orders[data['txid']]['status']:
+            self.orders[data['txid']]['status'] = 'canceled'
+
+        return {'error': [], 'result': {'count': 1}}
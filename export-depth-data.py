@@ -1,14 +1,35 @@
 #!/bin/env python3
 
-from kraken import Kraken, KrakenData
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from kraken import KrakenData
+from features import FeatureWriter, iter_feature_batches
 import numpy as np
 import json
+import os
 
-kraken = KrakenData(db_path="data/data.db",key_path="keys/albus.key")
+# read-only database connection of a worker process
+kraken = None
 
-def get_time_points(observe_each = 180, max_gap = 1000):
+def _init_worker(db_path):
+    """Open a read-only database connection in a worker process
+
+    db_path --- path for the database location
+    """
+    global kraken
+    kraken = KrakenData(db_path = db_path, read_only = True)
+
+def get_time_points(kraken, pair, start = None, end = None,
+                    observe_each = 180, max_gap = 1000):
     """Get available time points when order book was collected
 
+    kraken --- KrakenData object
+
+    pair --- trading pair
+
+    start, end --- interval [start, end) of the time points. By
+    default all collected snapshots
+
     max_gap --- max gap in seconds to be allowed between
     observations. In case observations in some period are missing then
     we do not query orderBook at that point
@@ -17,110 +38,145 @@ def get_time_points(observe_each = 180, max_gap = 1000):
     in the produced interval
     """
 
-    c = kraken._dbconn.cursor()
+    # times of the collected snapshots from the catalog (with a margin
+    # to detect gaps at the interval borders)
+    time_l = np.array(kraken.get_snapshot_times(
+        pair,
+        None if start is None else start - max_gap,
+        None if end is None else end + max_gap))
 
-    # query all time_l
-    try:
-        c.execute('SELECT DISTINCT time_l FROM orderBook ORDER BY time_l')
-        time_l = c.fetchall()
-    except Exception as e:
-        logging.error("Error quering timestamps from orderBook",e)
-        kraken._dbconn.rollback()
-        raise e
-    kraken._dbconn.commit()
+    if 0 == len(time_l):
+        return []
 
-    # convert list of tuples to list
-    time_l = [x[0] for x in time_l]
+    start = time_l[0] if start is None else max(start, time_l[0])
+    end = time_l[-1] if end is None else min(end, time_l[-1])
 
     # get sequence of times
-    res = list(range(min(time_l),max(time_l),observe_each))
-
-    # calculate times of big gaps
-    big_diff = filter(lambda x: x[2] > max_gap,
-                      zip(range(1,len(time_l)), time_l,
-                          np.array(time_l[1:]) - np.array(time_l[:-1])))
+    res = np.arange(start, end, observe_each)
 
-    # remove the gap times from the resulting observation points
-    for i,t,d in big_diff:
-        res = filter(lambda x: x <= time_l[i-1] or x >= time_l[i], res)
-    res = list(res)
+    # remove the points lying inside of big gaps between observations
+    i = np.searchsorted(time_l, res)
+    inside = (i > 0) & (i < len(time_l))
+    i = np.clip(i, 1, len(time_l) - 1)
+    gap = inside & (time_l[i] - time_l[i-1] > max_gap) & (res < time_l[i])
 
-    return res
+    return [int(x) for x in res[~gap]]
 
-def process_orderbook(data, price_interval = 0.05, len_bids_asks = 20):
-    """Process the query result and produce vectors of fixed lengths of
-    asks and bids volumes around an interval of the market price, and
-    the current market price
+def get_shards(kraken, pairs, chunk, start = None, end = None, observe_each = 180):
+    """Split export work by pair and time range
 
-    data --- result of _select_from_OrderBook method
-
-    price_interval --- percentage around the current market price to
-    consider the orderBook
+    kraken --- KrakenData object
+    pairs --- list of trading pairs
+    chunk --- length of a time range in seconds
+    start, end --- optional time interval to export
 
-    len_bids_asks --- lengths of asks and bids output vectors
+    return --- list of tuples (pair, start, end)
 
     """
-    # get asks and bids from queried data
-    asks = sorted(filter(lambda x: x[2] == "asks", data),key=lambda x: x[0])
-    bids = sorted(filter(lambda x: x[2] == "bids", data),key=lambda x: -x[0])
+    # keep shards aligned to the observation grid
+    chunk = int(np.ceil(chunk/observe_each))*observe_each
 
-    if 0 == len(asks) or 0 == len(bids):
-        return []
+    res = []
+    for pair in pairs:
+        times = kraken.get_snapshot_times(pair, start, end)
 
-    # get market price (average between largest bids and smallest asks)
-    market_price=(max([float(x[0]) for x in bids]) + min([float(x[0]) for x in asks]))/2
+        if 0 == len(times):
+            continue
 
-    # calculate accumulated volume and corresponding price
-    volume = list(np.cumsum([float(x[1]) for x in bids]))[::-1] + list(np.cumsum([float(x[1]) for x in asks]))
-    price = list([float(x[0]) for x in bids])[::-1] + list([float(x[0]) for x in asks])
+        for s in range(times[0], times[-1], chunk):
+            res += [(pair, s, min(s + chunk, times[-1]))]
 
-    res=[]
-    # price points at which we evaluate volume
-    for p in np.linspace((1-price_interval)*market_price,
-                         (1+price_interval)*market_price,
-                         len_bids_asks):
-        # get index inside price vector
-        try:
-            i = list(filter(lambda i: price[i] <= p and price[i+1] > p,
-                            range(1,len(price)-1)))[0]
-        except IndexError as e:
-            if p < market_price:
-                i = 0
-            if p > market_price:
-                i = -1
+    return res
+
+def export_shard(pair, start, end, path, price_interval = 0.1, len_bids_asks = 400,
+                 observe_each = 180, max_gap = 1000, batch_size = 1000):
+    """Write the depth features of one pair and time range to a partition
 
-        # if bid take right things
-        if p <= market_price:
-            res+=[volume[i+1]]
+    Has to be called in a worker process (see _init_worker).
 
-        if p > market_price:
-            res+=[volume[i]]
+    pair --- trading pair
 
-    return (res,market_price)
+    start, end --- time range of the shard
 
-def get_orderBook_data(price_interval = 0.1, len_bids_asks = 400):
-    """Query order book data for all available
+    path --- output directory of the dataset
 
     price_interval --- percentage around the current market price to
     consider the orderBook
 
     len_bids_asks --- lengths of asks and bids output vectors
 
-    """
-    time_points = get_time_points()
+    batch_size --- number of books processed at once
 
-    time_points = list(filter(lambda x: x < 1486119006, time_points))
-
-    print("length of time_points: " + str(len(time_points)))
-
-    res=[]
-    for time in time_points:
-        print("Time: " + str(time))
-        query = kraken._select_from_OrderBook(time,pair="XXBTZEUR")
-        res += [process_orderbook(query,price_interval,len_bids_asks)]
-
-
-    print("Saving results")
-    with open("orderBook_0.1_400.json",'w') as ofile:
-        json.dump(res, ofile)
+    return --- dict describing the partition
 
+    """
+    time_points = get_time_points(kraken, pair, start, end, observe_each, max_gap)
+
+    partition = os.path.join(pair, str(start) + "-" + str(end))
+    writer = FeatureWriter(os.path.join(path, partition), len(time_points),
+                           price_interval, len_bids_asks)
+
+    books = kraken.iter_books(pair, time_points)
+    for times, features, price in iter_feature_batches(books, price_interval,
+                                                       len_bids_asks, batch_size):
+        writer.append(times, features, price)
+
+    return {'pair': pair, 'start': start, 'end': end,
+            'path': partition, 'rows': writer.close()}
+
+def _export_shard(args):
+    """Helper of export_shard for Pool.imap_unordered"""
+    return export_shard(*args)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='export-depth-data',
+                            description='Export order book depth features')
+    parser.add_argument('--db', default='data/data.db', type=str,
+                        help='Location of the database. Default: data/data.db')
+    parser.add_argument('-o','--output', default='orderBook_0.1_400', type=str,
+                        help='Output directory. Default: orderBook_0.1_400')
+    parser.add_argument('-p','--pairs', default=[], nargs='*',
+                        help='Currency pairs. Default: all pairs in database')
+    parser.add_argument('--start', default=None, type=int, help='Start time')
+    parser.add_argument('--end', default=None, type=int, help='End time')
+    parser.add_argument('--chunk', default=7*24*3600, type=int,
+                        help='Length of a time range of a shard in seconds. Default: one week')
+    parser.add_argument('-j','--jobs', default=os.cpu_count(), type=int,
+                        help='Number of processes. Default: number of cores')
+    parser.add_argument('--price-interval', default=0.1, type=float,
+                        help='Percentage around the market price. Default: 0.1')
+    parser.add_argument('-n','--points', default=400, type=int,
+                        help='Number of price points. Default: 400')
+    parser.add_argument('--observe-each', default=180, type=int,
+                        help='Seconds between time points. Default: 180')
+    parser.add_argument('--max-gap', default=1000, type=int,
+                        help='Max allowed gap between observations. Default: 1000')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok = True)
+
+    _init_worker(args.db)
+    pairs = args.pairs if len(args.pairs) else kraken._get_pairs()
+    shards = get_shards(kraken, pairs, args.chunk, args.start, args.end,
+                        args.observe_each)
+
+    print("number of shards: " + str(len(shards)))
+
+    tasks = [(pair, start, end, args.output, args.price_interval, args.points,
+              args.observe_each, args.max_gap) for pair, start, end in shards]
+
+    partitions = []
+    with Pool(processes = args.jobs, initializer = _init_worker,
+              initargs = (args.db,)) as pool:
+        for x in pool.imap_unordered(_export_shard, tasks):
+            print("Exported " + x['path'] + ": " + str(x['rows']) + " rows")
+            partitions += [x]
+
+    # the manifest ties the partitions together
+    manifest = {'price_interval': args.price_interval,
+                'n_points': args.points,
+                'observe_each': args.observe_each,
+                'partitions': sorted(partitions, key=lambda x: (x['pair'], x['start']))}
+
+    with open(os.path.join(args.output, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent = 2)
@@ -0,0 +1,219 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import os
+
+import numpy as np
+
+def price_grid(price_interval = 0.1, n_points = 400):
+    """Relative price points at which the depth is evaluated
+
+    price_interval --- percentage around the market price
+    n_points --- number of price points
+
+    return --- np.array of prices relative to the market price
+
+    """
+    return np.linspace(1 - price_interval, 1 + price_interval, n_points)
+
+def _side_depth(levels, mid, grid, sign):
+    """Cumulative volume of one side of several books at price points
+
+    Levels of all books are concatenated into one sorted array of keys
+    (relative price plus an offset per book), so that all price points
+    of all books are located with a single searchsorted.
+
+    levels --- list of np.array with price and volume columns, asks
+    sorted by increasing, bids by decreasing price
+    mid --- np.array of market prices
+    grid --- relative price points
+    sign --- 1 for asks, -1 for bids
+
+    return --- np.array of shape (len(levels), len(grid))
+
+    """
+    n = np.array([x.shape[0] for x in levels])
+    start = np.concatenate(([0], np.cumsum(n)[:-1]))
+    rows = np.repeat(np.arange(len(levels)), n)
+
+    price = np.concatenate([x[:,0] for x in levels] + [np.zeros(0)])
+    volume = np.concatenate([x[:,1] for x in levels] + [np.zeros(0)])
+
+    # relative prices are in [1,2] for asks and in [-1,0] for bids
+    # after clipping, so that an offset of 3 per book keeps the keys
+    # of different books apart
+    rel = np.clip(sign*price/mid[rows], -1, 2)
+    keys = rel + 3*rows
+
+    cum = np.concatenate(([0], np.cumsum(volume)))
+    points = sign*grid[None,:] + 3*np.arange(len(levels))[:,None]
+
+    # asks: number of levels with price <= p, bids: with price > p
+    side = 'right' if sign > 0 else 'left'
+    k = np.searchsorted(keys, points, side = side)
+
+    return cum[k] - cum[start][:,None]
+
+def depth_features(books, price_interval = 0.1, n_points = 400):
+    """Cumulative depth at fixed relative price offsets
+
+    For price points below the market price the feature is the volume
+    of bids with a larger price, for the points above the market price
+    the volume of asks with a smaller or equal price.
+
+    books --- list of tuples (asks, bids) of np.array with price and
+    volume columns, as given by KrakenData.iter_books. Books must not
+    have empty sides
+
+    price_interval --- percentage around the market price
+    n_points --- number of price points
+
+    return --- tuple (features, mid), features is np.array of shape
+    (len(books), n_points), mid are the market prices
+
+    """
+    asks = [x[0] for x in books]
+    bids = [x[1] for x in books]
+
+    # market price (average between largest bids and smallest asks)
+    mid = np.array([(a[0,0] + b[0,0])/2 for a, b in books]).reshape(-1)
+
+    grid = price_grid(price_interval, n_points)
+
+    res = np.where(grid[None,:] <= 1,
+                   _side_depth(bids, mid, grid, -1),
+                   _side_depth(asks, mid, grid, 1))
+
+    return (res, mid)
+
+def iter_feature_batches(books, price_interval = 0.1, n_points = 400,
+                         batch_size = 1000):
+    """Compute features of a stream of books in batches
+
+    books --- iterable of (time, asks, bids), e.g. KrakenData.iter_books
+    price_interval --- percentage around the market price
+    n_points --- number of price points
+    batch_size --- number of books in a batch
+
+    return --- generator of tuples (times, features, mid). Books with
+    an empty side are skipped
+
+    """
+    batch = []
+    times = []
+
+    for t, asks, bids in books:
+        if 0 == len(asks) or 0 == len(bids):
+            continue
+
+        batch += [(asks, bids)]
+        times += [t]
+
+        if len(batch) >= batch_size:
+            yield (np.array(times),) + depth_features(batch, price_interval, n_points)
+            batch, times = [], []
+
+    if len(batch):
+        yield (np.array(times),) + depth_features(batch, price_interval, n_points)
+
+class FeatureWriter(object):
+    """Preallocated memory-mapped feature dataset
+
+    The dataset is a directory with features.npy, times.npy, price.npy
+    and meta.json. The arrays are preallocated for the maximal number
+    of rows, the number of actually written rows is stored in
+    meta.json on close.
+
+    """
+
+    def __init__(self, path, n_rows, price_interval = 0.1, n_points = 400):
+        """Constructor
+
+        path --- output directory
+        n_rows --- maximal number of rows
+        price_interval, n_points --- feature parameters, see depth_features
+
+        """
+        os.makedirs(path, exist_ok = True)
+
+        self._path = path
+        self._rows = 0
+        self._meta = {'price_interval': price_interval, 'n_points': n_points}
+
+        open_memmap = np.lib.format.open_memmap
+        self._features = open_memmap(os.path.join(path, "features.npy"), mode = 'w+',
+                                     dtype = np.float32, shape = (n_rows, n_points))
+        self._times = open_memmap(os.path.join(path, "times.npy"), mode = 'w+',
+                                  dtype = np.int64, shape = (n_rows,))
+        self._price = open_memmap(os.path.join(path, "price.npy"), mode = 'w+',
+                                  dtype = np.float64, shape = (n_rows,))
+
+    def append(self, times, features, price):
+        """Append a batch of rows
+
+        times --- np.array of snapshot times
+        features --- np.array of shape (n, n_points)
+        price --- np.array of market prices
+
+        """
+        n = len(times)
+
+        if self._rows + n > self._times.shape[0]:
+            raise RuntimeError("FeatureWriter: preallocated rows exceeded")
+
+        self._features[self._rows:self._rows+n] = features
+        self._times[self._rows:self._rows+n] = times
+        self._price[self._rows:self._rows+n] = price
+        self._rows += n
+
+    def close(self):
+        """Flush the arrays and write meta.json
+
+        return --- number of written rows
+
+        """
+        for x in (self._features, self._times, self._price):
+            x.flush()
+
+        self._meta['rows'] = self._rows
+
+        with open(os.path.join(self._path, "meta.json"), 'w') as f:
+            json.dump(self._meta, f)
+
+        return self._rows
+
+def load_features(path):
+    """Open a dataset written by FeatureWriter
+
+    The arrays are memory-mapped, nothing is read until used.
+
+    path --- dataset directory
+
+    return --- dict with 'features', 'times', 'price' np.arrays and
+    the meta data
+
+    """
+    with open(os.path.join(path, "meta.json"), 'r') as f:
+        res = json.load(f)
+
+    for name in ('features', 'times', 'price'):
+        res[name] = np.load(os.path.join(path, name + ".npy"),
+                            mmap_mode = 'r')[:res['rows']]
+
+    return res
@@ -0,0 +1,74 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Text formatting helpers
+
+Only the standard library is used here, the module is imported by the
+command line tools on start.
+
+"""
+
+def _rou(value, currency):
+    """
+    Round up for printing ledger, such that it will fit to double entry
+
+    value -- the volume of currency
+    currency -- the corresponding currency
+    """
+    prec_list = {'XBT' : 3,
+                 'EUR' : 3,
+                 'XRP' : 3,
+                 'XLM' : 8
+                 }
+
+    fmt = "{:.%if}"%prec_list[currency] if currency in prec_list else "{:.9f}"
+
+    return fmt.format(value)
+
+def depth_format(result,pair):
+    """
+    Display the table of depth
+
+    result -- result of public query of depth : depth['result']
+    pair -- currency pair
+
+    """
+    wc = 16 #width of each column
+
+    table = "Order Book {}/{}\n\n".format(pair[1:4],pair[5:])
+
+    fmttitle='{:^%i}  {:^%i}\n'%(3*wc+5,3*wc+5)
+    table+=fmttitle.format('Buying','Selling')
+
+    #table entries formatting
+    fmtt='{0:1}{5:^%i}{0:1}{1:^%i}{0:1}{2:^%i}{0:1}  {0:1}{3:^%i}{0:1}{4:^%i}{0:1}{6:^%i}{0:1}\n'%(wc+4,wc,wc,wc,wc,wc+4)
+    hline=fmtt.format('+','-'*wc,'-'*wc,'-'*wc,'-'*wc,'-'*(wc+4),'-'*(wc+4))
+
+    table += hline
+    table += fmtt.format('|','Volume','Price','Price','Volume','Cum. Vol','Cum. Vol')
+    table += hline
+
+    curr1 = pair[1:4]
+    c_ask,c_bid = 0,0 #cumulative values
+    for bid,ask in zip(result[pair]['bids'],result[pair]['asks']):
+        c_bid += float(bid[1])
+        c_ask += float(ask[1])
+        table += fmtt.format('|',bid[1],bid[0],ask[0],ask[1],_rou(c_bid,curr1),_rou(c_ask,curr1))
+
+    table+=hline
+
+    return table
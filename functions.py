@@ -6,24 +6,25 @@ import krakenex
 import logging
 import re
 import sqlite3
-import sys
 import time
 import numpy as np
+import networkx as nx
 
-from sklearn.cluster import KMeans
-
+from scipy import sparse
+from scipy.optimize import linprog
 from tqdm import tqdm
-from collections import defaultdict
 
-import networkx as nx
+from quantize import kmeans_edges, quantile_edges, quantize
 
-import subprocess
+from collections import defaultdict
+
+from multiprocessing import Pool
 
 import os
-import shutil
 from kraken import Kraken
 
-import ipdb
+from formats import _rou, depth_format
+
 
 def f2s(x, f="{:.8f}"):
     if isinstance(x,str):
@@ -113,9 +114,7 @@ def orderbook_entry2array(orderbook_entry,invert_price=False):
     :invert_price: if True invert volume
     :return: 2d np.array
     """
-    if not isinstance(orderbook_entry,np.float):
-        orderbook_entry = np.array(orderbook_entry)
-        orderbook_entry = orderbook_entry.astype(float)
+    orderbook_entry = np.array(orderbook_entry).astype(float)
 
     p = orderbook_entry[:,0]
     v = orderbook_entry[:,1]
@@ -125,34 +124,133 @@ def orderbook_entry2array(orderbook_entry,invert_price=False):
 
     return np.array(list(zip(p,v)))
 
-def dict_price_volume_interval(pair_key,cpcv,base_cur):
-    """
-    :pair_key: name of the pair
-    :cpcv: whatever orderbook_entry2array returns
-    :base_cur: base currency to be used in key
-    :return: dictionary '<pair_key>$base#<v1><-><v2>': float
-    """
-    p = cpcv[:,0]
-    v = cpcv[:,1]
-    v = np.cumsum(v)
+class DepthMatrix(object):
+    """Exchange edges with available volumes
 
-    res = {}
-    for i in range(v.shape[0]):
-        vl = v[i-1] if i > 0 else 0
-        vu = v[i]
-        key = pair_key+'$'+base_cur+'#'+\
-            f2s(vl)+'<->'+f2s(vu)
+    Every edge is an exchange from one currency to another within a
+    volume slice of the base currency of the pair, at a price
+    including the fees. Edges come in pairs of both directions of the
+    same slice. Currencies and pairs are interned, the edges are
+    stored in arrays:
 
-        res[key] = p[i]
+    :fr, to, base: currency codes (index in currencies)
+    :pair: pair codes (index in pairs)
+    :vl, vr: volume slice in base currency, vr is inf for the last slice
+    :price: exchange price
+    :rev: index of the edge of the same slice in the other direction
 
-    # assume the last order in orderbook is infinite
-    vl = v[-1]
-    vu = 'Inf'
-    key = pair_key+'$'+base_cur+'#'+\
-            f2s(vl)+'<->'+f2s(vu)
-    res[key] = p[-1]
+    """
 
-    return res
+    _fields = {'fr': int, 'to': int, 'base': int, 'pair': int,
+               'vl': float, 'vr': float, 'price': float, 'rev': int}
+
+    def __init__(self, currencies = None, pairs = None, **arrays):
+        """
+        :currencies: list of currency names
+        :pairs: list of pair names
+        :arrays: edge arrays (see class description), empty by default
+        """
+        self.currencies = [] if currencies is None else list(currencies)
+        self.pairs = [] if pairs is None else list(pairs)
+        self._currency_codes = {x: i for i, x in enumerate(self.currencies)}
+        self._pair_codes = {x: i for i, x in enumerate(self.pairs)}
+        self._pair_index = None
+
+        for name, dtype in self._fields.items():
+            setattr(self, name, np.asarray(arrays.get(name, []), dtype=dtype))
+
+    def __len__(self):
+        return len(self.price)
+
+    def currency(self, name):
+        """Code of a currency, the currency is added if new"""
+        if name not in self._currency_codes:
+            self._currency_codes[name] = len(self.currencies)
+            self.currencies.append(name)
+
+        return self._currency_codes[name]
+
+    def pair_code(self, name):
+        """Code of a pair, the pair is added if new"""
+        if name not in self._pair_codes:
+            self._pair_codes[name] = len(self.pairs)
+            self.pairs.append(name)
+
+        return self._pair_codes[name]
+
+    @classmethod
+    def from_pairs(cls, chunks):
+        """Assemble depth matrix from per-pair slices
+
+        :chunks: list of tuples (pair, base, quote, vl, vr, price_bq,
+        price_qb), where vl, vr are volume slices in base currency,
+        price_bq are the prices of base->quote and price_qb of
+        quote->base edges
+        :return: DepthMatrix
+        """
+        res = cls()
+        arrays = {name: [] for name in cls._fields}
+
+        n = 0
+        for pair, base, quote, vl, vr, price_bq, price_qb in chunks:
+            m = len(vl)
+            b, q, p = res.currency(base), res.currency(quote), res.pair_code(pair)
+
+            arrays['fr'] += [np.full(m, b), np.full(m, q)]
+            arrays['to'] += [np.full(m, q), np.full(m, b)]
+            arrays['base'] += [np.full(2*m, b)]
+            arrays['pair'] += [np.full(2*m, p)]
+            arrays['vl'] += [vl, vl]
+            arrays['vr'] += [vr, vr]
+            arrays['price'] += [price_bq, price_qb]
+            arrays['rev'] += [np.arange(n+m, n+2*m), np.arange(n, n+m)]
+            n += 2*m
+
+        for name, dtype in cls._fields.items():
+            x = np.concatenate(arrays[name]) if len(arrays[name]) else []
+            setattr(res, name, np.asarray(x, dtype=dtype))
+
+        return res
+
+    def subset(self, idx):
+        """Depth matrix with a subset of edges
+
+        :idx: boolean mask or indices of the edges. Reverse edges of
+        the selected ones must be selected as well
+        :return: DepthMatrix
+        """
+        idx = np.arange(len(self))[idx]
+        new = np.full(len(self), -1)
+        new[idx] = np.arange(len(idx))
+
+        if np.any(new[self.rev[idx]] < 0):
+            raise RuntimeError("DepthMatrix.subset: reverse edges are not selected")
+
+        arrays = {name: getattr(self, name)[idx] for name in self._fields}
+        arrays['rev'] = new[arrays['rev']]
+
+        return DepthMatrix(self.currencies, self.pairs, **arrays)
+
+    @property
+    def pair_index(self):
+        """Dictionary pair code -> indices of the edges of the pair"""
+        if self._pair_index is None:
+            order = np.argsort(self.pair, kind='stable')
+            codes, start = np.unique(self.pair[order], return_index=True)
+            self._pair_index = dict(zip(codes.tolist(), np.split(order, start[1:])))
+
+        return self._pair_index
+
+    def name(self, i):
+        """Short name 'AB' of the edge A->B"""
+        return self.currencies[self.fr[i]] + self.currencies[self.to[i]]
+
+    def key(self, i):
+        """Human readable key 'A->B$C#vl<->vr' of an edge"""
+        vr = 'Inf' if np.isinf(self.vr[i]) else self.vr[i]
+
+        return self.currencies[self.fr[i]]+'->'+self.currencies[self.to[i]]+\
+            '$'+self.currencies[self.base[i]]+'#'+f2s(self.vl[i])+'<->'+f2s(vr)
 
 def price_matrix(ticker, pairs):
     """Compute price matrix including the fees
@@ -172,170 +270,249 @@ def price_matrix(ticker, pairs):
 
     return res
 
-def orderbook_reshape_by_volume(item, by_volumes, tol=1e-6):
+def orderbook_reshape_by_volume(item, by_volumes, tol=1e-9):
     """Split orderbook by cumulative volume rule
 
-    This function is a disaster.
-
     :item: orderbook entry
 
     :by_volumes: a list of volumes in the output orderbook entry. It
-    is assumed that every entry of by_volumes is smaller or equal than
-    the volume in item, and that cumvol of by_volumes contains values
-    from cumvol from item
+    is assumed that the cumulative volumes of item are among the
+    cumulative by_volumes. Volume beyond the volume of item gets the
+    price of the last order
 
-    :return: orderbook entry
+    :return: np.array with rows (price, volume, timestamp)
 
     """
-    item = np.array(item).astype(float)
+    item = np.asarray(item, dtype=float)
+    by_volumes = np.asarray(by_volumes, dtype=float)
 
-    res = []
-    i = 0
-    cur = item[i,:].copy()
+    # slice (V[j-1], V[j]] lies in the first order with cumulative
+    # volume reaching V[j]
+    V = np.cumsum(by_volumes)
+    idx = np.searchsorted(np.cumsum(item[:,1]), V - tol, side='left')
+    idx = np.minimum(idx, len(item) - 1)
 
-    for v in by_volumes:
-        if i >= item.shape[0]:
-            res += [[cur[0],v,cur[2]]]
-            continue
+    res = item[idx]
+    res[:,1] = by_volumes
 
-        while v > cur[1] or isclose(v,cur[1],abs_tol=tol):
-            if not isclose(cur[1],0, abs_tol = tol):
-                res += [[cur[0],cur[1],cur[2]]]
-            v -= cur[1]
-            i += 1
-            if i >= item.shape[0]:
-                break
-            cur = item[i,:].copy()
+    return res
 
-        if isclose(v,0,abs_tol = tol):
-            continue
+def orderbook2commonvolumes(item1,item2,tol=1e-9):
+    """Convert 2 orderbook entries to common volumes
 
-        if i >= item.shape[0]:
-            continue
+    :item1,item2: orderbook entries
 
-        res += [[cur[0],v,cur[2]]]
-        cur[1] -= v
+    :tol: cumulative volumes closer than tol are merged
 
-    return res
+    :return: (res1,res2) a tuple of converted orderbook entries, see
+    orderbook_reshape_by_volume
 
-def orderbook2commonvolumes(item1,item2):
-    """Convert 2 orderbook entries to common volumes
+    """
+    A = np.asarray(item1, dtype=float)
+    B = np.asarray(item2, dtype=float)
 
-    :item1,item2: orderbook entries
+    if 0 == len(A) or 0 == len(B):
+        raise ValueError("orderbook2commonvolumes: empty orderbook entry")
+
+    if np.any(A[:,1] <= 0) or np.any(B[:,1] <= 0):
+        raise ValueError("orderbook2commonvolumes: non-positive volume")
+
+    V = np.union1d(np.cumsum(A[:,1]), np.cumsum(B[:,1]))
+    V = V[np.diff(V, prepend=0) > tol]
+    V = np.diff(V, prepend=0)
 
-    :return: (res1,res2) a tuple of converted orderbook entries
+    return (orderbook_reshape_by_volume(A,V,tol),
+            orderbook_reshape_by_volume(B,V,tol))
 
+def pair_depth(key, item, pairs):
+    """Volume slices and prices of one pair
+
+    :key: pair name
+    :item: order book of the pair, {'asks': ..., 'bids': ...}
+    :pairs: whatever query_tradable_pairs returns
+    :return: tuple (pair, base, quote, vl, vr, price_bq, price_qb),
+    see DepthMatrix.from_pairs
     """
-    A = np.array(item1)
-    B = np.array(item2)
-
-    vA = np.cumsum(A[:,1].astype(float))
-    vB = np.cumsum(B[:,1].astype(float))
-    V = np.unique(np.concatenate((vA,vB),axis=0))
-    V = np.diff(np.concatenate(([0],V),axis=0))
-
-    resA = orderbook_reshape_by_volume(A,V)
-    resB = orderbook_reshape_by_volume(B,V)
-
-    if len(resA) != len(resB):
-        ipdb.set_trace()
-        raise RuntimeError("Your buggy shit: orderbook_reshape_by_volume")
-    for i in range(len(resA)):
-        if not isclose(resA[i][1],resB[i][1],abs_tol = 1e-9):
-            ipdb.set_trace()
-            raise RuntimeError("Your buggy shit: orderbook_reshape_by_volume")
-
-    return (resA,resB)
-
-def check_same_volumes_key(a,b, tol=1e-7):
-    resA = resB = {}
-    r=re.compile('^(.*)->(.*)\$(.*)#(.*)<->(.*)$')
-
-    vA = np.array([(r.sub(r'\4',x),r.sub(r'\5',x))
-                   for x in a.keys()]).astype(float)
-    vB = np.array([(r.sub(r'\4',x),r.sub(r'\5',x))
-                   for x in b.keys()]).astype(float)
-
-    for key, item in a.items():
-        k = r.sub(r'\2',key)+'->'+r.sub(r'\1',key)+\
-            '$'+r.sub(r'\3',key)+'#'+\
-            r.sub(r'\4',key)+'<->'+r.sub(r'\5',key)
-
-        if k in b:
-            resA[key]=item
-            resB[k]=b[k]
-            continue
+    fp,fq = pair_fees(key,pairs)
 
-        idx = np.sum(np.abs(vB - (float(r.sub(r'\4',key)),
-                                  float(r.sub(r'\5',key)))),axis=1) < tol
-        if not any(idx):
-            ipdb.set_trace()
-            raise RuntimeError("no similar volumes found")
+    a,b = orderbook2commonvolumes(item['asks'], item['bids'])
+    a = orderbook_entry2array(a, True)
+    b = orderbook_entry2array(b, False)
 
-        vl, vr = vB[idx][0,:]
-        kB = r.sub(r'\2',key)+'->'+r.sub(r'\1',key)+\
-            '$'+r.sub(r'\3',key)+'#'+f2s(vl)+'<->'+f2s(vr)
+    # assume the last order in orderbook is infinite
+    v = np.cumsum(a[:,1])
+    vl = np.concatenate(([0], v))
+    vr = np.concatenate((v, [float('inf')]))
 
-        resA[key]=item
-        resB[k]=b[kB]
+    price_bq = np.append(a[:,0], a[-1,0])/(1+fp)
+    price_qb = np.append(b[:,0], b[-1,0])*(1-fq)
 
-    return (resA,resB)
+    return (key, pairs[key]['base'], pairs[key]['quote'],
+            vl, vr, price_bq, price_qb)
 
-def depth_matrix(orderbook, pairs):
+def depth_matrix(orderbook, pairs, processes=1):
     """Compute matrix prices with available volumes
 
+    The pairs are independent. With several processes they are
+    converted by a pool, the workers get only the book and the
+    metadata of their pair and return the slices as arrays (see
+    pair_depth), the matrix is assembled here. A pool is started on
+    every call, for books of the size of the Kraken market it costs
+    more than the conversion itself (see bench-reshape.py).
+
     :orderbook: whatever query_orderbook returns
     :pairs: whatever query_tradable_pairs returns
-    :return: dict: 'str key'->float
+    :processes: number of processes, None for the number of cores
+    :return: DepthMatrix
 
     """
-    res = {}
+    tasks = [(key, item[key], {key: pairs[key]}) for key,item in orderbook.items()]
+
+    if 1 == processes:
+        chunks = [pair_depth(*x) for x in tqdm(tasks)]
+    else:
+        with Pool(processes=processes) as pool:
+            chunks = pool.starmap(pair_depth, tasks,
+                                  chunksize=max(1, len(tasks)//(4*(processes or os.cpu_count()))))
+
+    return DepthMatrix.from_pairs(chunks)
+
+def top_depth_matrix(orderbook, pairs):
+    """Depth matrix of the top of the order books
+
+    Every pair has a single infinite slice at the best ask and bid
+    prices, including the fees (as in pair_depth).
+
+    :orderbook: whatever query_orderbook returns
+    :pairs: whatever query_tradable_pairs returns
+    :return: DepthMatrix
+    """
+    chunks = []
+
+    for key,item in orderbook.items():
+        item = item[key]
+        if 0 == len(item['asks']) or 0 == len(item['bids']):
+            continue
 
-    for key,item in tqdm(orderbook.items()):
-        base_cur = pairs[key]['base']
-        p,q = pair_name(key,pairs)
         fp,fq = pair_fees(key,pairs)
+        chunks += [(key, pairs[key]['base'], pairs[key]['quote'],
+                    np.zeros(1), np.full(1, float('inf')),
+                    np.full(1, 1/float(item['asks'][0][0])/(1+fp)),
+                    np.full(1, float(item['bids'][0][0])*(1-fq)))]
+
+    return DepthMatrix.from_pairs(chunks)
+
+def negative_cycles(prices, tol=1e-9):
+    """Find arbitrage cycles in the best exchange rates
+
+    Bellman-Ford on the weights -log(rate) of the first slices of the
+    depth matrix, started from all currencies at once. The rate of an
+    edge is the amount of the 'to' currency for a unit of the 'from'
+    currency, i.e. the price of the reverse edge (see
+    lp_constraints_exchange). Rates only get worse deeper in the
+    books, so without a cycle here there is no arbitrage at all.
+
+    Reported are the cycles of the predecessor graph once the
+    relaxation has not converged after n rounds.
+
+    :prices: whatever depth_matrix or top_depth_matrix returns
+    :tol: relaxations smaller than tol (in log scale) are ignored
+    :return: list of tuples (edges, gain), where edges is a list of
+    edge indices in prices forming the cycle, and gain is the
+    estimated relative profit of one turn
+    """
+    edges = np.nonzero(prices.vl == 0)[0]
+    fr = prices.fr[edges]
+    to = prices.to[edges]
+    w = -np.log(prices.price[prices.rev[edges]])
 
-        a,b = orderbook2commonvolumes(item[key]['asks'],
-                                      item[key]['bids'])
-        a = orderbook_entry2array(a, True)
-        b = orderbook_entry2array(b, False)
+    n = len(prices.currencies)
+    dist = np.zeros(n)
+    pred = np.full(n, -1)
 
-        a[:,0] = a[:,0]/(1+fp)
-        b[:,0] = b[:,0]*(1-fq)
+    for _ in range(n):
+        cand = dist[fr] + w
 
-        a = dict_price_volume_interval(p,a,base_cur)
-        b = dict_price_volume_interval(q,b,base_cur)
+        # best candidate for every target
+        order = np.lexsort((cand, to))
+        _, first = np.unique(to[order], return_index=True)
+        best = order[first]
 
-        a,b = check_same_volumes_key(a,b)
+        improve = cand[best] < dist[to[best]] - tol
+        if not np.any(improve):
+            return []
 
-        res.update(a)
-        res.update(b)
+        best = best[improve]
+        dist[to[best]] = cand[best]
+        pred[to[best]] = best
+
+    # every currency in the predecessor graph leads to a cycle or to
+    # a start
+    res = []
+    seen = set()
+    for c in np.nonzero(pred >= 0)[0]:
+        path = []
+        while c not in path and pred[c] >= 0:
+            path += [c]
+            c = fr[pred[c]]
+
+        if pred[c] < 0:
+            continue
+
+        cycle = path[path.index(c):]
+        key = frozenset(cycle)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        # edges in the order of trading
+        cycle = [pred[x] for x in reversed(cycle)]
+        gain = np.exp(-w[cycle].sum()) - 1
+        if gain > 0:
+            res += [([int(edges[x]) for x in cycle], gain)]
 
     return res
 
+def cycle_str(cycle, prices):
+    """Human readable cycle 'A->B->C->A'
+
+    :cycle: list of edge indices, see negative_cycles
+    :prices: whatever depth_matrix returns
+    """
+    return '->'.join([prices.currencies[prices.fr[k]] for k in cycle] +
+                     [prices.currencies[prices.to[cycle[-1]]]])
+
+def cycle_pairs(cycles, prices):
+    """Pairs traded on the cycles
+
+    :cycles: whatever negative_cycles returns
+    :prices: the depth matrix of the cycles
+    :return: sorted list of pair names
+    """
+    return sorted({prices.pairs[prices.pair[k]] for cycle, _ in cycles for k in cycle})
+
 def lp_variables_names(prices,owncur=["ZEUR"]):
     """Generate variable names from the depth_matrix
 
     :prices: whatever depth_matrix returns
 
-    :return: dict 'x<id>' -> '<prices key>'
+    :owncur: list of own currencies. Currencies missing in prices
+    get no variable, the variables are numbered as in lp_matrix
+
+    :return: tuple of dicts (xp, px), xp maps 'y<id>' -> own
+    currency and 'x<id>' -> edge index, px is the inverse
     """
     xp = {}
     px = {}
 
-    i = 0
-    r = re.compile("^(.*)->(.*)\$(.*)#(.*)<->(.*)$")
-    for k in owncur:
+    own = [x for x in owncur if x in prices.currencies]
+    for i, k in enumerate(own):
         key = "y" + str(int(i))
-        i += 1
         xp[key] = k
         px[k] = key
 
-    i = 0
-    for k in prices.keys():
-        key="x"+str(int(i))
-        i += 1
+    for k in range(len(prices)):
+        key="x"+str(int(k))
         xp[key] = k
         px[k] = key
 
@@ -346,43 +523,30 @@ def lp_constraints_exchange(prices, sx):
 
     :prices: whatever depth_matrix returns
 
-    :sx: dict: '<prices key>' -> '<variable name>'
+    :sx: dict: edge index or own currency -> '<variable name>'
 
     :return: list of strings for lp file format
 
     """
-    r = re.compile("^(.*)->(.*)\$(.*)#(.*)<->(.*)$")
+    rate = 1/prices.price[prices.rev]
 
-    pq_names = defaultdict(list)
-    q_names = defaultdict(list)
-    o_names = defaultdict(list)
-    for x in prices.keys():
-        q_names[r.sub(r'\2',x)] += [sx[x]]
-        xp = r.sub(r'\2->\1$\3#\4<->\5',x)
-        pq_names[r.sub(r'\1',x)] += [str(1/prices[xp]) + ' ' + sx[x]]
-
-    for v,y in sx.items():
-        if not re.match(r'y[0-9]*',y):
-            continue
-        o_names[v] += [y]
+    # currencies in order of appearance
+    _, first = np.unique(prices.fr, return_index=True)
 
     res = []
-    done = set()
-    for key in tqdm(prices.keys()):
-        fr = r.sub(r'\1',key)
-        to = r.sub(r'\2',key)
-        if hash(fr) in done:
-            continue
-        done.add(hash(fr))
+    for c in tqdm(prices.fr[np.sort(first)]):
+        out = np.nonzero(prices.fr == c)[0]
+        inc = np.nonzero(prices.to == c)[0]
 
         s = ' - '
-        s += ' - '.join(pq_names[fr])
+        s += ' - '.join(str(rate[k]) + ' ' + sx[k] for k in out)
         s += ' + '
-        s += ' + '.join(q_names[fr])
+        s += ' + '.join(sx[k] for k in inc)
 
-        if fr in o_names:
+        cur = prices.currencies[c]
+        if cur in sx:
             s += ' - '
-            s += ' - '.join(o_names[fr])
+            s += sx[cur]
 
         s += ' = 0;'
 
@@ -394,27 +558,15 @@ def lp_constraints_volume(prices, sx):
     """Generate volume constraints
 
     :prices: whatever depth_matrix returns
-    :sx: dict: '<prices key>' -> '<variable name>'
+    :sx: dict: edge index or own currency -> '<variable name>'
     :return: list of strings for lp file format
     """
-    r = re.compile("^(.*)->(.*)\$(.*)#(.*)<->(.*)$")
+    x = prices.vr - prices.vl
+    x = np.where(prices.to == prices.base, x, x/prices.price)
 
     res = []
-    for key in prices.keys():
-        f,t,b,vl,vr = [r.sub(x,key)
-                       for x in (r'\1',r'\2',r'\3',
-                                 r'\4',r'\5')]
-
-        if vr in ('inf','Inf'):
-            continue
-
-        x = float(vr) - float(vl)
-
-        if t == b:
-            res += [sx[key] + ' <= ' + str(x) + ';']
-            continue
-
-        res += [sx[key] + ' <= ' + str(x/prices[key]) + ';']
+    for k in np.nonzero(np.isfinite(prices.vr))[0]:
+        res += [sx[k] + ' <= ' + str(x[k]) + ';']
 
     return res
 
@@ -422,7 +574,7 @@ def lp_constraints_non_zero(prices, sx):
     """ Generate non-zero constraints
 
     :prices: whatever depth_matrix returns
-    :sx: dict: '<prices key>' -> '<variable name>'
+    :sx: dict: edge index or own currency -> '<variable name>'
     :return: list of strings for lp file format
     """
     res = []
@@ -449,7 +601,7 @@ def lp_contraints_bounded(sx):
 def lp_objective(sx):
     """Generate objective function string
 
-    :sx: dict: '<prices key>' -> '<variable name>'
+    :sx: dict: edge index or own currency -> '<variable name>'
     :return: list of strings for lp file format
     """
 
@@ -464,7 +616,12 @@ def lp_objective(sx):
 
     return ["max: " + s + " ;"]
 
-def save_lp(prices, fn):
+def lp_text(prices):
+    """The arbitrage LP in lp_solve format
+
+    :prices: whatever depth_matrix returns
+    :return: string
+    """
     _, sx = lp_variables_names(prices, owncur = ["ZEUR"])
     res = []
 
@@ -479,187 +636,446 @@ def save_lp(prices, fn):
     res += ["/* Bounded problem constraint: */"]
     res += lp_contraints_bounded(sx)
 
+    return '\n'.join(res)
+
+def save_lp(prices, fn):
     with open(fn, 'w') as f:
-        f.write('\n'.join(res))
+        f.write(lp_text(prices))
+
+def lp_matrix(prices, owncur=["ZEUR"]):
+    """Sparse form of the arbitrage LP
+
+    The model is the one written by save_lp: the variables are the
+    edges of the depth matrix followed by the own currencies, the
+    objective maximises the sum of own currencies, every currency has
+    an exchange (balance) constraint and the edges are bounded by the
+    volumes of their slices.
+
+    :prices: whatever depth_matrix returns
+    :owncur: list of own currencies
+    :return: tuple (c, A_eq, b_eq, bounds) for scipy.optimize.linprog
+    (minimisation)
+    """
+    n = len(prices)
+    m = len(prices.currencies)
+    own = [prices.currencies.index(x) for x in owncur if x in prices.currencies]
+    k = np.arange(n)
+
+    # - sum rate x (out of c) + sum x (into c) - y_c = 0
+    rows = np.concatenate((prices.fr, prices.to, own))
+    cols = np.concatenate((k, k, n + np.arange(len(own))))
+    data = np.concatenate((-1/prices.price[prices.rev], np.ones(n), -np.ones(len(own))))
+    A_eq = sparse.csr_matrix((data, (rows, cols)), shape=(m, n + len(own)))
+    b_eq = np.zeros(m)
+
+    c = np.concatenate((np.zeros(n), -np.ones(len(own))))
+
+    ub = prices.vr - prices.vl
+    ub = np.where(prices.to == prices.base, ub, ub/prices.price)
+    ub = np.concatenate((ub, np.full(len(own), np.inf)))
+    bounds = np.column_stack((np.zeros(n + len(own)), ub))
+
+    return (c, A_eq, b_eq, bounds)
+
+def solve_lp(prices, owncur=["ZEUR"], tol=1e-7):
+    """Solve the arbitrage LP in process (HiGHS)
+
+    :prices: whatever depth_matrix returns
+    :owncur: list of own currencies
+    :tol: variables not larger than tol are solver noise, they are
+    not in the solution (the HiGHS feasibility tolerance is 1e-7)
+    :return: dict with 'objective' -> float, 'status' -> int
+    (scipy.optimize.linprog status, 0 on success), 'x' -> np.array of
+    edge volumes, 'y' -> np.array of own currency volumes, and
+    'solution' -> dict '[xy][0-9]+' -> float of the non-zero
+    variables (the names of lp_text, see lp_variables_names)
+    """
+    c, A_eq, b_eq, bounds = lp_matrix(prices, owncur)
+    own = [x for x in owncur if x in prices.currencies]
+
+    res = linprog(c, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method='highs')
+
+    if 0 != res.status:
+        logging.warning("Arbitrage LP: " + res.message)
+        return {'objective': float('nan'), 'status': res.status,
+                'x': np.zeros(len(prices)), 'y': np.zeros(len(own)),
+                'solution': {}}
+
+    x = res.x[:len(prices)]
+    y = res.x[len(prices):]
+
+    solution = {'x' + str(k): x[k] for k in np.nonzero(x > tol)[0]}
+    solution.update({'y' + str(k): y[k] for k in np.nonzero(y > tol)[0]})
+
+    return {'objective': -res.fun, 'status': res.status,
+            'x': x, 'y': y, 'solution': solution}
+
+class ArbitrageLP(object):
+    """Arbitrage LP session across consecutive snapshots
+
+    The model of solve_lp with a fixed structure: a column per pair,
+    direction and volume slice (up to head - 1 slices, the most
+    head_depth_matrix(n=head) keeps), a balance row per currency and
+    the own currencies. A new snapshot changes only the exchange coefficients
+    and the volume bounds, slices missing in the snapshot get the
+    upper bound 0.
+
+    With highspy the model stays in one HiGHS instance and every solve
+    is warm-started from the basis of the previous one. Without it
+    the stored sparse matrix is updated in place and solved by
+    scipy.optimize.linprog from scratch.
+
+    """
+
+    def __init__(self, pairs, owncur=["ZEUR"], head=2, tol=1e-7):
+        """
+        :pairs: whatever query_tradable_pairs returns, restricted to
+        the pairs of the snapshots
+        :owncur: list of own currencies
+        :head: the n of head_depth_matrix the snapshots are reduced
+        with, the same as in monitor.ArbitrageMonitor
+        :tol: solver noise, see solve_lp
+        """
+        # head_depth_matrix keeps the first head volumes of a pair, 0
+        # is one of them, so there are at most head - 1 slices in a
+        # direction
+        self._slices = max(head - 1, 1)
+        self._tol = tol
+        self._pairs = list(pairs.keys())
+        self._pair_codes = {x: i for i, x in enumerate(self._pairs)}
+
+        self.currencies = sorted(set([x['base'] for x in pairs.values()] +
+                                     [x['quote'] for x in pairs.values()]))
+        codes = {x: i for i, x in enumerate(self.currencies)}
+        self._owncur = [x for x in owncur if x in codes]
+
+        # slot (pair, direction, slice): direction 0 is base->quote
+        n = 2*len(self._pairs)*self._slices
+        slot = np.arange(n)
+        pair = slot // (2*self._slices)
+        base = np.array([codes[pairs[x]['base']] for x in self._pairs], dtype=int)
+        quote = np.array([codes[pairs[x]['quote']] for x in self._pairs], dtype=int)
+        backward = (slot // self._slices) % 2 == 1
+        self._fr = np.where(backward, quote[pair], base[pair])
+        self._to = np.where(backward, base[pair], quote[pair])
+        self._n = n
+
+        m = len(self.currencies)
+        k = len(self._owncur)
+        own = np.array([codes[x] for x in self._owncur], dtype=int)
+
+        # column-wise matrix, every slot has entries in its fr and to
+        # rows, every own currency in its row
+        rows = np.concatenate((np.column_stack((self._fr, self._to)).reshape(-1), own))
+        values = np.concatenate((np.column_stack((-np.ones(n), np.ones(n))).reshape(-1),
+                                 -np.ones(k)))
+        start = np.concatenate((2*np.arange(n+1), 2*n + 1 + np.arange(k)))
+
+        self._cost = np.concatenate((np.zeros(n), -np.ones(k)))
+        self._upper = np.concatenate((np.zeros(n), np.full(k, np.inf)))
+        self._matrix = sparse.csc_matrix((values, rows, start), shape=(m, n + k))
+
+        self._highs = None
+        try:
+            import highspy
+        except ImportError:
+            logging.info("ArbitrageLP: no highspy, solving without warm start")
+            return
+
+        lp = highspy.HighsLp()
+        lp.num_col_ = n + k
+        lp.num_row_ = m
+        lp.col_cost_ = self._cost
+        lp.col_lower_ = np.zeros(n + k)
+        lp.col_upper_ = np.where(np.isinf(self._upper), highspy.kHighsInf, self._upper)
+        lp.row_lower_ = np.zeros(m)
+        lp.row_upper_ = np.zeros(m)
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+        lp.a_matrix_.start_ = self._matrix.indptr
+        lp.a_matrix_.index_ = self._matrix.indices
+        lp.a_matrix_.value_ = self._matrix.data
+
+        self._highs = highspy.Highs()
+        self._highs.setOptionValue('output_flag', False)
+        self._highs.passModel(lp)
+        self._optimal = highspy.HighsModelStatus.kOptimal
+
+    def _slots(self, prices):
+        """Slots of the edges of a depth matrix"""
+        try:
+            pair = np.array([self._pair_codes[x] for x in prices.pairs], dtype=int)[prices.pair]
+        except KeyError as e:
+            raise ValueError("ArbitrageLP: unknown pair " + str(e))
+
+        group = 2*pair + (prices.fr != prices.base)
+
+        # rank of the slice inside of its pair and direction, the
+        # edges come ordered by volume
+        order = np.argsort(group, kind='stable')
+        _, first, counts = np.unique(group[order], return_index=True, return_counts=True)
+        rank = np.empty(len(prices), dtype=int)
+        rank[order] = np.arange(len(prices)) - np.repeat(first, counts)
+
+        if np.any(rank >= self._slices):
+            raise ValueError("ArbitrageLP: more than " + str(self._slices) + \
+                             " slices in a pair direction")
+
+        return group*self._slices + rank
+
+    def solve(self, prices):
+        """Solve the LP of a snapshot
+
+        :prices: whatever head_depth_matrix returns, with the pairs
+        given in the constructor
+        :return: the same as solve_lp
+        """
+        slots = self._slots(prices)
+
+        rate = 1/prices.price[prices.rev]
+        ub = prices.vr - prices.vl
+        ub = np.where(prices.to == prices.base, ub, ub/prices.price)
+
+        upper = np.zeros(self._n)
+        upper[slots] = ub
+
+        # the fr entry of a slot is first in its column
+        self._matrix.data[2*slots] = -rate
+
+        if self._highs is not None:
+            for k, r in zip(slots.tolist(), rate.tolist()):
+                self._highs.changeCoeff(int(self._fr[k]), k, -r)
+            self._highs.changeColsBounds(self._n, np.arange(self._n, dtype=np.int32),
+                                         np.zeros(self._n), upper)
+            self._highs.run()
+
+            ok = self._highs.getModelStatus() == self._optimal
+            res = np.array(self._highs.getSolution().col_value) if ok else None
+            status, message = (0, '') if ok else (2, self._highs.modelStatusToString(
+                self._highs.getModelStatus()))
+        else:
+            self._upper[:self._n] = upper
+            out = linprog(self._cost, A_eq=self._matrix, b_eq=np.zeros(self._matrix.shape[0]),
+                          bounds=np.column_stack((np.zeros(len(self._upper)), self._upper)),
+                          method='highs')
+            res, status, message = out.x, out.status, out.message
+
+        if 0 != status:
+            logging.warning("Arbitrage LP: " + message)
+            return {'objective': float('nan'), 'status': status,
+                    'x': np.zeros(len(prices)), 'y': np.zeros(len(self._owncur)),
+                    'solution': {}}
+
+        x = res[slots]
+        y = res[self._n:]
 
+        # own currencies of the snapshot, as in solve_lp
+        y = y[[x in prices.currencies for x in self._owncur]]
 
-def cluster_1d_vector(vector, n_clusters):
+        solution = {'x' + str(k): x[k] for k in np.nonzero(x > self._tol)[0]}
+        solution.update({'y' + str(k): y[k] for k in np.nonzero(y > self._tol)[0]})
+
+        return {'objective': -(self._cost*res).sum(), 'status': status,
+                'x': x, 'y': y, 'solution': solution}
+
+def cluster_1d_vector(vector, n_clusters, method='kmeans'):
     """Cluster 1d vector
 
     Convert [0,1,2,3,...,Inf] -> {0:0,1:cluster1,...,Inf:Inf}
 
     :vector: 1d np.array
     :number_clusters: number of clusters to combine the order volumes
+    :method: 'kmeans' (optimal, see quantize.kmeans_edges) or
+    'quantile' (see quantize.quantile_edges)
+    :return: tuple (edges, centers) of the quantizer, 0 and Inf are
+    kept as they are (see cluster_volumes)
 
     """
-    vector = np.unique(sorted(np.array(vector)))
-    v = vector[np.logical_and(vector!=float('inf'),vector!=0)]
-    n_clusters = min(v.shape[0],n_clusters)
-
-    if n_clusters > 1:
-        kmeans = KMeans(n_clusters = n_clusters).fit(v.reshape(-1,1))
-        label = lambda x: kmeans.cluster_centers_[
-            kmeans.predict(np.array(v).reshape(-1,1))][0,0]
-    else:
-        label = lambda x: 0
+    v = np.unique(np.asarray(vector, dtype=float))
+    v = v[(v != float('inf')) & (v != 0)]
 
-    res = {}
-    for v in vector:
-        if float('inf') == v:
-            res[v] = float('inf')
-        elif 0 == v:
-            res[v] = 0
-        else:
-            res[v] = label(v)
+    if 'kmeans' == method:
+        return kmeans_edges(v, n_clusters)
 
-    return res
+    if 'quantile' == method:
+        return quantile_edges(v, n_clusters)
+
+    raise ValueError("cluster_1d_vector: unknown method " + str(method))
 
-def cluster_volumes(depth_matrix, n_intervals = 50):
+def cluster_volumes(depth_matrix, n_intervals = 50, method = 'kmeans'):
     """Cluster volumes of the depth_matrix
 
     :depth_matrix: whatever depth_matrix returns
     :n_intervals: number of intervals to produce
-    :return: dictionary: key of depth_matrix -> new key
+    :method: see cluster_1d_vector
+    :return: tuple (vl, vr) of np.array with the clustered volume
+    slices of the edges
     """
-    r = re.compile('^(.*)->(.*)\$(.*)#(.*)<->(.*)$')
-    v = []
-    v += [float(r.sub(r'\4',x)) for x in depth_matrix.keys()]
-    v += [float(r.sub(r'\5',x)) for x in depth_matrix.keys()]
-    clusters = cluster_1d_vector(v, n_clusters = n_intervals - 1)
+    v = np.concatenate((depth_matrix.vl, depth_matrix.vr))
+    edges, centers = cluster_1d_vector(v, n_intervals - 1, method)
 
-    res = {}
-    for x in depth_matrix.keys():
-        fr = r.sub(r'\1',x)
-        to = r.sub(r'\2',x)
-        base = r.sub(r'\3',x)
-        vl = str(clusters[float(r.sub(r'\4',x))])
-        vu = str(clusters[float(r.sub(r'\5',x))])
-        res[x] = fr+'->'+to+'$'+base+'#'+vl+'<->'+vu
+    def label(x):
+        if 0 == len(centers):
+            return x
+        res = quantize(x, edges, centers)
+        keep = (0 == x) | np.isinf(x)
+        res[keep] = x[keep]
+        return res
 
-    return res
+    return (label(depth_matrix.vl), label(depth_matrix.vr))
 
-def lp_replace_variables(ifn, ofn, xs):
+def lp_replace_variables(ifn, ofn, xs, prices):
     """Replace all variables by their proper names
 
     :ifn: path to the problem filename
     :ofn: output file
-    :xs: dict with variable names
+    :xs: dict with variable names, see lp_variables_names
+    :prices: whatever depth_matrix returns
     """
     with open(ifn,'r') as f:
         S = f.read()
 
+    with open(ofn,'w') as f:
+        f.write(lp_rename_variables(S, xs, prices))
+
+def lp_rename_variables(S, xs, prices):
+    """Replace all variables by their proper names
+
+    :S: the problem in text format, see lp_text
+    :xs: dict with variable names, see lp_variables_names
+    :prices: whatever depth_matrix returns
+    :return: string
+    """
     v = re.compile(r'([xy][0-9]+) ')
-    r1 = re.compile('^(.*)->(.*)\$(.*)#(.*)<->(.*)$')
-    r2 = re.compile('^(.*)#(.*)<->(.*)$')
 
     for m in v.finditer(S):
         old = m.groups(1)[0]
         if old not in xs:
             continue
-        new = xs[m.groups(1)[0]]
-        if r1.match(new):
-            new = r1.sub(r'\1\2',new)
-        if r2.match(new):
-            new = r2.sub(r'\1\2',new)
+        new = xs[old]
+        if not isinstance(new, str):
+            new = prices.name(new)
 
         S = S.replace(old + ' ',new + ' ')
 
-    with open(ofn,'w') as f:
-        f.write(S)
+    return S
+
+def debug(orderbook, pairs, path):
+    """Save the LP of an order book and solve it
 
-def debug(orderbook,pairs):
+    :orderbook: whatever query_orderbook returns
+    :pairs: whatever query_tradable_pairs returns
+    :path: directory where the problem is written, as problem3.lp
+    and (with the proper variable names) problem3_replaces.lp
+    :return: see print_strategy
+    """
     prices = depth_matrix(orderbook, pairs)
     prices3 = head_depth_matrix(prices,n=2)
-    save_lp(prices3, 'problem3.lp')
+    fn = os.path.join(path, 'problem3.lp')
+    save_lp(prices3, fn)
     xs, _ = lp_variables_names(prices3)
-    lp_replace_variables('problem3.lp','problem3_replaces.lp',xs)
-    f = open('problem3.output','w')
-    subprocess.call(['lp_solve','problem3.lp'],stdout=f)
-    f.close()
-    sol = lp_read_solution('problem3.output')
-    return print_strategy(sol,xs)
-
-def log_arbitrage(path):
+    lp_replace_variables(fn, os.path.join(path, 'problem3_replaces.lp'), xs, prices3)
+    sol = solve_lp(prices3)
+    return print_strategy(sol,xs,prices3)
+
+def log_arbitrage(path, debug=False, processes=1):
     """ Check if there is an arbitrage and save it
 
+    The order book, pairs and the solution are saved only in case an
+    arbitrage is found, as a run of the snapshot store (see
+    snapshots.SnapshotStore). Artifacts that do not change between
+    runs (typically the pairs) are stored once.
+
+    The books are fetched at once (collector.SnapshotCollector). If
+    they have a cycle, the pairs of the cycles are fetched again and
+    only these are used, with the skew of the books in the solution.
+
+    :path: directory of the snapshot store
+    :debug: save also the LP problem in text format, as the
+    problem.lp and problem_replaced.lp artifacts of the run
+    :processes: number of processes for depth_matrix, None for the
+    number of cores. Default: serial
+    :return: run time in the store, or None
     """
-    os.makedirs(path, exist_ok = True)
-    path_lp = os.path.join(path,"problem.lp")
-    path_lpr = os.path.join(path,"problem_replaced.lp")
-    path_sol = os.path.join(path,"problem.output")
-    path_orderbook = os.path.join(path,"orderbook.json")
-    path_pairs = os.path.join(path,"pairs.json")
+    from snapshots import SnapshotStore
+    from collector import SnapshotCollector, snapshot_skew
 
     kraken = Kraken()
     kraken.load_key("keys/albus.key")
 
+    now = time.time()
     pairs = query_tradable_pairs(kraken)
     pair_names = get_pairs_names(pairs)
-    orderbook = query_orderbook(kraken, pair_names)
-
-    save_json(path_orderbook, orderbook)
-    save_json(path_pairs, pairs)
 
-    prices = depth_matrix(orderbook, pairs)
-    prices = head_depth_matrix(prices,n=2)
+    collector = SnapshotCollector()
+    orderbook, received = collector.sweep(pair_names)
 
-    save_lp(prices, path_lp)
-    xs, _ = lp_variables_names(prices)
-    lp_replace_variables(path_lp,path_lpr,xs)
-    f = open(path_sol,'w')
-    subprocess.call(['lp_solve',path_lp],stdout=f)
-    f.close()
-    sol = lp_read_solution(path_sol)
-    S,G = print_strategy(sol, xs)
+    # the LP is worth solving only if there is a cycle
+    top = top_depth_matrix(orderbook, pairs)
+    cycles = negative_cycles(top)
+    if 0 == len(cycles):
+        collector.close()
+        return
 
-    if 0 == len(S.keys()):
-        shutil.rmtree(path)
+    # the books of the cycles once more, with a smaller skew. The
+    # cycles found in the full sweep might be phantoms of it
+    orderbook, received = collector.sweep(cycle_pairs(cycles, top))
+    collector.close()
 
-def lp_read_solution(fn):
-    """Parse the lp solution file
+    top = top_depth_matrix(orderbook, pairs)
+    cycles = negative_cycles(top)
+    if 0 == len(cycles):
+        return
 
-    :fn: filename
-    :return: dict 'objective' -> float, 'solution' -> dict
+    for cycle, gain in cycles:
+        logging.info("Arbitrage cycle: " + cycle_str(cycle, top) + ", gain " + f2s(gain))
 
-    where solution dictionary is
-
-    '[xy][0-9]+' -> float
-
-    """
-    with open(fn,'r') as f:
-        lines = f.readlines()
-
-    res = {}
-    var = {}
-
-    objr = re.compile(r'^Value of objective function:\s+(\S+)\n$')
-    varr = re.compile(r'([xy][0-9]+)\s+(\S+)\n$')
-
-    for l in lines:
-        if objr.match(l):
-           res['objective'] = objr.sub(r'\1',l)
-
-        if varr.match(l):
-            var[varr.sub(r'\1',l)] = float(varr.sub(r'\2',l))
-
-    res['solution'] = var
+    prices = depth_matrix(orderbook, pairs, processes=processes)
+    prices = head_depth_matrix(prices,n=2)
 
-    return res
+    xs, _ = lp_variables_names(prices)
+    sol = solve_lp(prices)
+    S,G = print_strategy(sol, xs, prices)
 
-def get_solution_graph(solution):
+    if 0 == len(S.keys()):
+        return
+
+    artifacts = {
+        'orderbook.json': ('orderbook', orderbook),
+        'pairs.json': ('json', pairs),
+        'solution.json': ('json',
+                          {'objective': sol['objective'],
+                           'skew': snapshot_skew(received),
+                           'cycles': [(cycle_str(c, top), g) for c, g in cycles],
+                           'solution': {(prices.key(k) if not isinstance(k, str) else k): v
+                                        for k, v in S.items()}})}
+
+    if debug:
+        problem = lp_text(prices)
+        artifacts['problem.lp'] = ('text', problem)
+        artifacts['problem_replaced.lp'] = ('text', lp_rename_variables(problem, xs, prices))
+
+    store = SnapshotStore(path)
+    store.log(now, artifacts)
+    store.close()
+
+    return now
+
+def get_solution_graph(solution, prices):
     """Convert dictionary to a solution graph
 
-    :solution: dict 'A->B$C#vl<->vr' -> float volume in B
+    :solution: dict edge index -> float volume in the 'to' currency.
+    Other keys are ignored
+    :prices: whatever depth_matrix returns
 
     :return: networkx graph
     """
     G = nx.Graph().to_directed()
-    r = re.compile('^(.*)->(.*)\$(.*)#(.*)<->(.*)$')
 
     for k,v in solution.items():
-        if not r.match(k):
+        if isinstance(k, str):
             continue
-        f,t = [r.sub(x,k) for x in (r'\1',r'\2')]
+        f = prices.currencies[prices.fr[k]]
+        t = prices.currencies[prices.to[k]]
         if f not in G.nodes:
             G.add_node(f)
         if t not in G.nodes:
@@ -670,19 +1086,23 @@ def get_solution_graph(solution):
 
     return G
 
-def print_strategy(solution, xs):
+def print_strategy(solution, xs, prices):
     """Print strategy
 
-    :solution: whatever lp_read_solution outputs
-    :xs: dictionary '[xy][0-9]+' -> 'A->B$C#vl<->vr'
-    :return: ordered list of commands (strings)
+    :solution: whatever solve_lp returns (or ArbitrageLP.solve), only
+    its 'solution' entry is used
+    :xs: dictionary '[xy][0-9]+' -> edge index or own currency
+    :prices: whatever depth_matrix returns
+    :return: tuple (S, G), where S is a dict edge index or own
+    currency -> volume of the non-zero variables and G is the
+    solution graph, see get_solution_graph
     """
     S = {}
     for v,a in solution['solution'].items():
         if a > 0:
             S[xs[v]] = a
 
-    G = get_solution_graph(S)
+    G = get_solution_graph(S, prices)
 
     return S, G
 
@@ -690,87 +1110,75 @@ def head_depth_matrix(depth_matrix, n=5):
     """Take only first few entries from the orderbook
 
     :depth_matrix: whatever depth_matrix returns
-    :n: number of first volumes to consider
+    :n: number of first volumes to consider. These are the smallest
+    slice bounds of a pair in both directions, 0 is one of them, so
+    that at most n-1 slices of every direction are kept
 
     :return: the same format as in depth_matrix
 
     """
-    r=re.compile('^(.*)->(.*)\$(.*)#(.*)<->(.*)$')
-    curs=set([(r.sub(r'\1',x),r.sub(r'\2',x))
-              for x in depth_matrix.keys()])
-
-    res = {}
+    keep = np.zeros(len(depth_matrix), dtype=bool)
 
-    for cur1,cur2 in tqdm(curs):
-        r1 = re.compile('^'+cur1+'->'+cur2+
-                        '\$(.*)#(.*)<->(.*)$')
-        r2 = re.compile('^'+cur2+'->'+cur1+
-                        '\$(.*)#(.*)<->(.*)$')
-        m = {x:depth_matrix[x]
-             for x in depth_matrix.keys()
-             if r1.match(x) or r2.match(x)}
+    for _, idx in depth_matrix.pair_index.items():
+        v = np.unique(np.concatenate((depth_matrix.vl[idx],
+                                      depth_matrix.vr[idx])))[0:n]
+        keep[idx] = np.isin(depth_matrix.vr[idx], v)
 
-        v = []
-        for k in m.keys():
-            v += [float(r.sub(r'\4',k)),
-                  float(r.sub(r'\5',k))]
-        v = sorted(list(set(v)))[0:n]
+    return depth_matrix.subset(keep)
 
-        m = {x:m[x]
-             for x in m.keys()
-             if float(r.sub(r'\5',x)) in v}
-
-        res.update(m)
-
-    return res
-
-def cluster_depth_matrix(depth_matrix):
+def cluster_depth_matrix(depth_matrix, n_intervals = 50, method = 'kmeans'):
     """Reduce depth_matrix by making volumes common
 
-    The volumes in the orderbook are clustered with K-means algorithm,
+    The volumes in the orderbook are clustered (see cluster_volumes),
     where there prices are averaged
 
     :depth_matrix: whatever depth_matrix returns
+    :n_intervals, method: see cluster_volumes
     :return: the same format as in depth_matrix
 
     """
-    r=re.compile('^(.*)->(.*)\$(.*)#(.*)<->(.*)$')
-    curs=set([r.sub(r'\3',x) for x in depth_matrix.keys()])
+    dm = depth_matrix
+    chunks = {}
 
-    res = {}
+    for cur in tqdm(np.unique(dm.base)):
+        idx = np.nonzero(dm.base == cur)[0]
+        vl, vr = cluster_volumes(dm.subset(idx), n_intervals, method)
 
-    for cur in tqdm(curs):
-        r = re.compile('^(.*)->(.*)\$'+cur+'#(.*)<->(.*)$')
-        m = {x:depth_matrix[x]
-             for x in depth_matrix.keys()
-             if r.match(x)}
-        common=cluster_volumes(depth_matrix=m)
+        # average prices of the edges falling into the same slice
+        x = defaultdict(list)
+        for k, l, r in zip(idx, vl, vr):
+            x[(dm.pair[k], dm.fr[k], l, r)] += [dm.price[k]]
 
-        x = {}
-        for key,item in m.items():
-            k = common[key]
-            if k not in x:
-                x[k]=[]
-            x[k]+=[item]
+        x = {key: np.mean(item) for key, item in x.items()}
 
-        for key,item in x.items():
-            x[key]=np.mean(item)
+        # slices collapsed to a point are merged into the following one
+        d = {(p, f, r): item for (p, f, l, r), item in x.items() if l == r}
+        x = {(p, f, l, r): (item + d[(p, f, l)])/2 if (p, f, l) in d else item
+             for (p, f, l, r), item in x.items() if l != r}
 
-        d = {}
-        for key,item in x.items():
-            if r.sub(r'\3',key) == r.sub(r'\4',key):
-                d[r.sub(r'\4',key)] = item
+        for (p, f, l, r), item in x.items():
+            chunks.setdefault(p, {}).setdefault(f, {})[(l, r)] = item
 
-        for key,item in x.items():
-            if r.sub(r'\3',key) in d:
-                x[key] = (item + d[r.sub(r'\3',key)])/2
+    # assemble both directions of every pair
+    res = []
+    for p, directions in chunks.items():
+        k = dm.pair_index[p][0]
+        base = dm.currencies[dm.base[k]]
+        fr, to = dm.fr[k], dm.to[k]
+        b = dm.base[k]
+        q = to if fr == b else fr
 
-        x = {key:item for key,item in x.items()
-             if r.sub(r'\3',key) != r.sub(r'\4',key)}
+        bq = directions.get(b, {})
+        qb = directions.get(q, {})
+        slices = sorted(set(bq) & set(qb))
 
-        res.update(x)
+        res += [(dm.pairs[p], base, dm.currencies[q],
+                 np.array([l for l, r in slices], dtype=float),
+                 np.array([r for l, r in slices], dtype=float),
+                 np.array([bq[s] for s in slices], dtype=float),
+                 np.array([qb[s] for s in slices], dtype=float))]
 
-    return res
+    return DepthMatrix.from_pairs(res)
 
 def save_json(fn,data):
     with open(fn,'w') as f:
@@ -905,26 +1313,6 @@ def reformat(trades, entry_type):
     return res
 
 
-def _rou(value, currency):
-    """
-    Round up for printing ledger, such that it will fit to double entry
-
-    value -- the volume of currency
-    currency -- the corresponding currency
-    """
-    prec_list = {'XBT' : 3,
-                 'EUR' : 3,
-                 'XRP' : 3,
-                 'XLM' : 8
-                 }
-
-    fmt = "{:.%if}"%prec_list[currency] if currency in prec_list else "{:.9f}"
-
-    return fmt.format(value)
-
-
-
-
 def trade2ledger(entry, account_fee, account):
     """Convert a list of entries to a ledger format
 
@@ -1004,101 +1392,150 @@ def deposit2ledger(entry, account_fee, account):
     return res
 
 
-def convert2ledger(ledger, account_fee, account):
-    """Converts ledger entries to a double entry in the format of ledger
+def iter_refid_groups(ledger):
+    """Group ledger entries by refid in the order of time
+
+    The entries are sorted by time and collected per refid in one
+    pass, the groups come in the order of their first entries.
 
     ledger --- ledger list
-    account_fee --- name for the fee account in ledger
-    account --- name for the kraken account in ledger
 
-    return --- list of character in ledger format
+    return --- generator of lists of entries with the same refid
     """
-    # get unique trade ids
-    ids = list(set([x['refid'] for x in ledger]))
+    # refid -> entries, in the order of the first entries
+    groups = {}
 
-    # resulting list of strings. each entry is one entry in ledger
-    res = list('\n')
+    for x in sorted(ledger, key=lambda x: float(x['time'])):
+        groups.setdefault(x['refid'], []).append(x)
 
-    for id in ids:
-        # get list of trades corresponding to the id
-        entry = [x for x in ledger if x['refid'] == id]
+    yield from groups.values()
 
-        # case of trade
-        if len(entry) == 2:
-            if (entry[0]['type'] != 'trade') | (entry[1]['type'] != 'trade'):
-                print("ledger entries are not trade")
-                sys.exit()
+def iter_ledger(ledger, account_fee, account, anomalies=None, refids=None):
+    """Converts ledger entries to double entries in the format of ledger
 
-            res.append(trade2ledger(entry, account_fee, account))
+    Groups of entries that are neither a trade (two trade entries) nor
+    a withdrawal/transfer/funding (one entry) are logged and skipped.
 
-        # case of withdrawal/transfer/funding
-        if len(entry) == 1:
-            if (entry[0]['type'] == 'trade'):
-                print("lonely trade")
-                continue
+    ledger --- ledger list
+    account_fee --- name for the fee account in ledger
+    account --- name for the kraken account in ledger
+    anomalies --- list, the skipped groups are appended to it as
+    tuples (reason, entries)
+    refids --- list, the refids of the converted groups are appended
+    to it
 
-            res.append(deposit2ledger(entry, account_fee, account))
+    return --- generator of strings in ledger format, in the order of time
+    """
+    for entry in iter_refid_groups(ledger):
+        types = [x['type'] for x in entry]
+
+        # case of trade
+        if 2 == len(entry) and ['trade', 'trade'] == types:
+            if refids is not None:
+                refids.append(entry[0]['refid'])
+            yield trade2ledger(entry, account_fee, account)
+            continue
+
+        # case of withdrawal/transfer/funding
+        if 1 == len(entry) and 'trade' != types[0]:
+            if refids is not None:
+                refids.append(entry[0]['refid'])
+            yield deposit2ledger(entry, account_fee, account)
+            continue
 
         # in case some error in ledger
-        if len(entry) < 1 or len(entry) > 2:
-            print(entry)
-            print("length = ",len(entry))
-            print("unknown transaction")
-            sys.exit()
+        if 1 == len(entry):
+            reason = "lonely trade"
+        elif 2 == len(entry):
+            reason = "ledger entries are not trade"
+        else:
+            reason = "unknown transaction"
 
-    return res
+        logging.warning(reason + ": refid " + str(entry[0]['refid']) +
+                        ", types " + ", ".join(types))
+        if anomalies is not None:
+            anomalies.append((reason, entry))
 
+def convert2ledger(ledger, account_fee, account, anomalies=None):
+    """Converts ledger entries to a double entry in the format of ledger
 
-def save_timestamp(ledger, filename):
-    """Save the time of the latest trade in file
+    ledger --- ledger list
+    account_fee --- name for the fee account in ledger
+    account --- name for the kraken account in ledger
+    anomalies --- see iter_ledger
 
-    ledger --- downloaded ledger data
-    filename --- filename of the timestamp
-    return --- nothing
+    return --- list of character in ledger format
     """
-    time = max([x['time'] for key,x in ledger.items()])
-
-    with open(filename,'w') as fp:
-        fp.write(str(time))
+    return ['\n'] + list(iter_ledger(ledger, account_fee, account, anomalies))
 
+def write_ledger(fp, ledger, account_fee, account, anomalies=None, refids=None):
+    """Write ledger entries to a file as they are converted
 
-def read_timestamp(filename):
-    """Read the time of the latest trade from file
+    fp --- file object
+    ledger, account_fee, account, anomalies, refids --- see iter_ledger
 
-    filename --- filename of the timestamp
-    return --- float, should be time in seconds from epoch
+    return --- number of the written transactions
     """
-    try:
-        with open(filename,'r') as fp:
-            return float(fp.read())
-    except:
-        return 1
+    fp.write('\n')
+
+    n = 0
+    for x in iter_ledger(ledger, account_fee, account, anomalies, refids):
+        fp.write('\n' + x)
+        n += 1
+
+    return n
 
-def sync(kraken, ftimestamp, fledger, timeout, account_fee, account):
+def sync(data, fledger, timeout, account_fee, account, window=3600):
     """Synchronise ledger data
 
-    ftimestamp --- filename where the timestamp is
+    The new ledger entries are stored in the database (see
+    KrakenData.sync_ledger). The refids that are not in the ledger
+    file yet are converted, appended to the file and marked as
+    exported. Groups that can not be converted are marked as skipped,
+    except for trades with a missing entry: these are left for the
+    next sync, unless they are older than window seconds before the
+    latest entry. Nothing is written twice, no matter how the syncs
+    overlap.
+
+    data --- KrakenData object
     fledger --- filename of the ledger file
     timeout --- timeout between transactions
+    window --- seconds to wait for the missing entry of a trade
 
     """
-    # get the period of time
-    start = read_timestamp(ftimestamp)
-    end = time.time()
+    data.sync_ledger(timeout)
 
-    # query new entries
-    data = query_all_entries(kraken,'Ledgers','ledger',start,end,timeout)
+    fledger = os.path.abspath(os.path.expanduser(fledger))
+    entries = data._select_ledger_to_export(fledger)
 
-    # convert to ledger format
-    ledger = convert2ledger(reformat(data, entry_type="ledger"), account_fee, account)
+    if 0 == len(entries):
+        logging.info("No new entries.")
+        return
 
+    anomalies = []
+    refids = []
     with open(fledger, 'a+') as fp:
-        fp.write("\n".join(sorted(ledger)))
+        n = write_ledger(fp, entries, account_fee, account, anomalies, refids)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    # trades with a missing entry wait for it, unless they are too old
+    latest = entries[-1]['time']
+    pending = {}
+    skipped = []
+    for reason, entry in anomalies:
+        if "lonely trade" == reason and entry[0]['time'] >= latest - window:
+            pending[entry[0]['refid']] = entry[0]['time']
+        else:
+            skipped += [(entry[0]['refid'], reason)]
+
+    logging.info("Wrote " + str(n) + " entries, skipped " + str(len(skipped)) +
+                 ", pending " + str(len(pending)) + ".")
 
-    logging.info("Wrote " + str(len(ledger)) + " entries.")
+    # the next export starts at the earliest pending trade
+    start = min(pending.values(), default = latest)
 
-    save_timestamp(data, ftimestamp)
-    logging.info("Saved timestamp")
+    data._insert_to_ledgerExported(refids, fledger, time.time(), start, skipped)
 
 
 def str2krakenOrder(string):
@@ -1178,38 +1615,3 @@ def order_str(kraken, string):
     if (len(t['error'])):
         logging.error("API error occured",t['error'])
         raise Exception("API error")
-
-
-def depth_format(result,pair):
-    """
-    Display the table of depth
-
-    result -- result of public query of depth : depth['result']
-    pair -- currency pair
-
-    """
-    wc = 16 #width of each column
-
-    table = "Order Book {}/{}\n\n".format(pair[1:4],pair[5:])
-
-    fmttitle='{:^%i}  {:^%i}\n'%(3*wc+5,3*wc+5)
-    table+=fmttitle.format('Buying','Selling')
-
-    #table entries formatting
-    fmtt='{0:1}{5:^%i}{0:1}{1:^%i}{0:1}{2:^%i}{0:1}  {0:1}{3:^%i}{0:1}{4:^%i}{0:1}{6:^%i}{0:1}\n'%(wc+4,wc,wc,wc,wc,wc+4)
-    hline=fmtt.format('+','-'*wc,'-'*wc,'-'*wc,'-'*wc,'-'*(wc+4),'-'*(wc+4))
-
-    table += hline
-    table += fmtt.format('|','Volume','Price','Price','Volume','Cum. Vol','Cum. Vol')
-    table += hline
-
-    curr1 = pair[1:4]
-    c_ask,c_bid = 0,0 #cumulative values
-    for bid,ask in zip(result[pair]['bids'],result[pair]['asks']):
-        c_bid += float(bid[1])
-        c_ask += float(ask[1])
-        table += fmtt.format('|',bid[1],bid[0],ask[0],ask[1],_rou(c_bid,curr1),_rou(c_ask,curr1))
-
-    table+=hline
-
-    return table
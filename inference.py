@@ -0,0 +1,201 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import math
+
+import os
+
+import pickle
+
+import time
+
+from collections import deque
+
+import numpy as np
+
+from features import depth_features
+from labels import multi_horizon_labels
+
+class LiveInference(object):
+    """Incremental inference on the order book stream of the logger
+
+    An instance is registered as an order book listener of KrakenData
+    (see KrakenData.add_orderbook_listener). The snapshots of the pair
+    are resampled to the time grid of the training data (see
+    get_time_points in export-depth-data.py): the row of a grid point
+    is the latest snapshot not later than it (see
+    KrakenData.select_book). After a gap larger than max_gap the
+    windows start anew, no row before the gap is stacked with the rows
+    after it. For every row it computes the
+    depth features, stacks the T latest of them, predicts the class
+    and stores the prediction with its latency in the predictions
+    table. Once the price after horizon rows is known, the model is
+    updated with partial_fit on the realised class (see labels.py).
+
+    """
+
+    def __init__(self, kraken, pair, model = None, model_path = None, T = 5,
+                 horizon = 5, rho = 0.0042/2, price_interval = 0.1, n_points = 400,
+                 observe_each = 180, max_gap = 1000):
+        """Constructor
+
+        kraken --- KrakenData object, used to store predictions
+        pair --- trading pair
+        model --- estimator with partial_fit and predict. Default:
+        linear SVM (SGDClassifier with hinge loss)
+        model_path --- file with a pickled (model, scaler). It is
+        loaded if it exists and updated by save
+        T --- number of prior snapshots in a feature vector
+        horizon, rho --- class definition, see labels.multi_horizon_labels
+        price_interval, n_points --- features, see features.depth_features
+        observe_each, max_gap --- time grid, the ones the training
+        data is exported with (see export-depth-data.py). Grid points
+        are multiples of observe_each
+
+        """
+        self._kraken = kraken
+        self._pair = pair
+        self._model_path = model_path
+        self._T = T
+        self._horizon = horizon
+        self._rho = rho
+        self._price_interval = price_interval
+        self._n_points = n_points
+        self._observe_each = observe_each
+        self._max_gap = max_gap
+
+        scaler = None
+        if model_path is not None and os.path.exists(model_path):
+            with open(model_path, 'rb') as f:
+                model, scaler = pickle.load(f)
+
+        if model is None:
+            from sklearn.linear_model import SGDClassifier
+            model = SGDClassifier(loss = 'hinge', alpha = 1e-4)
+
+        if scaler is None:
+            from sklearn.preprocessing import StandardScaler
+            scaler = StandardScaler()
+
+        self._model = model
+        self._scaler = scaler
+        self._name = type(model).__name__ + "-" + pair
+        self._fitted = hasattr(model, 'classes_')
+
+        # latest feature vectors, and stacked vectors with their
+        # prices waiting for the realised class
+        self._features = deque(maxlen = T)
+        self._pending = deque(maxlen = horizon + 1)
+
+        # latest snapshot: (time, feature vector, market price)
+        self._last = None
+
+    def __call__(self, pair, time_, asks, bids, received = None):
+        """Process a new order book snapshot
+
+        Arguments are the ones of an order book listener, see
+        KrakenData.add_orderbook_listener.
+
+        """
+        if pair != self._pair or 0 == len(asks) or 0 == len(bids):
+            return
+
+        features, mid = depth_features([(asks, bids)], self._price_interval,
+                                       self._n_points)
+        last, self._last = self._last, (time_, features[0], mid[0])
+
+        if last is None:
+            return
+
+        for t in self._grid_points(last[0], time_):
+            self._add_row(t, last[1], last[2], received)
+
+    def _grid_points(self, last, time_):
+        """Grid points whose rows are known once a snapshot at time_
+        follows the one at last
+
+        The rows of these points are the snapshot at last. The points
+        inside of a gap larger than max_gap are dropped as
+        export-depth-data.py does, and the windows (the latest feature
+        vectors and the rows waiting for their class) are cleared.
+
+        return --- list of times
+
+        """
+        if time_ - last > self._max_gap:
+            self._features.clear()
+            self._pending.clear()
+            return []
+
+        first = -(-math.ceil(last)//self._observe_each)*self._observe_each
+
+        return list(range(first, math.ceil(time_), self._observe_each))
+
+    def _add_row(self, time_, features, price, received = None):
+        """Predict and update the model with a row of the time grid
+
+        time_ --- grid point
+        features --- feature vector of the row
+        price --- market price of the row
+        received --- local receive time of the snapshot that
+        completed the row
+
+        """
+        self._features.append(features)
+
+        if len(self._features) < self._T:
+            return
+
+        X = np.concatenate(self._features).reshape(1,-1)
+        self._pending.append((X, price))
+
+        if self._fitted:
+            prediction = self._model.predict(self._scaler.transform(X))[0]
+            latency = None if received is None else time.time() - received
+            self._kraken._insert_to_Predictions(
+                [(self._pair, time_, self._name, float(prediction), latency)])
+
+        self._update()
+
+    def _update(self):
+        """Update the model with the oldest pending feature vector,
+        as soon as its class is known"""
+        if len(self._pending) <= self._horizon:
+            return
+
+        price = [x[1] for x in self._pending]
+        y = multi_horizon_labels(price, [self._horizon], [self._rho])[0,0,:1]
+        X = self._pending.popleft()[0]
+
+        self._scaler.partial_fit(X)
+        self._model.partial_fit(self._scaler.transform(X), y, classes = [-1, 0, 1])
+        self._fitted = True
+
+    def save(self):
+        """Store the model and the scaler in model_path"""
+        if self._model_path is None:
+            return
+
+        try:
+            with open(self._model_path + ".tmp", 'wb') as f:
+                pickle.dump((self._model, self._scaler), f)
+            os.replace(self._model_path + ".tmp", self._model_path)
+        except Exception as e:
+            logging.error("Error saving model",e)
+            raise e
@@ -16,223 +16,205 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import krakenex
-
 import time
 
 import os
 
 import sqlite3
 
-from math import ceil, isclose
+from math import isclose
 
 from collections import defaultdict
 
+import heapq
+
 import logging
 
-class Kraken(krakenex.API):
-    """A wrap for the krakekex with API call rate control
+import zlib
+
+import struct
+
+def _pack_levels(levels):
+    """Pack order book levels to bytes
+
+    levels --- iterable of (price, volume) pairs
+
+    return --- bytes of little-endian float64 (price, volume) pairs
 
     """
+    import numpy as np
 
-    def __init__(self, key = '', secret = '', tier = 3, db_path = "/tmp/kraken_counter.db"):
-        """Constructor for the child
+    return np.array(list(levels), dtype='<f8').reshape(-1,2).tobytes()
 
-        The most important part of initialising a child class is to
-        set the tier. Different tier level implies different API call
-        rate, see
-        <https://www.kraken.com/help/api#api-call-rate-limit>
+def _unpack_levels(blob, arrays = True):
+    """Unpack order book levels packed by _pack_levels
 
-        key, secret --- parameters for the krakenex.API constructor
+    blob --- bytes
+    arrays --- return np.array. Otherwise a list of (price, volume)
+    tuples, and numpy is not imported
 
-        tier --- kraken tier (possible values 2,3 or 4). Exception otherwise
+    return --- np.array of shape (n,2) with price and volume columns
 
-        db_path --- path to the database where the current counter is
-        stored. DB support allows to run several instances and have
-        inter-process communications (at least among the processes
-        that share the common database), so that the queries rate call
-        is not too high.
-        """
-        # call constructor of the parent
-        super(Kraken, self).__init__(key = key, secret = secret)
+    """
+    if not arrays:
+        return list(struct.iter_unpack('<2d', blob))
 
-        db_path = os.path.expanduser(db_path)
+    import numpy as np
 
-        # set up a database for storing counter and counter_time
-        self._dbconn = sqlite3.connect(db_path, timeout = 15, isolation_level="EXCLUSIVE")
+    return np.frombuffer(blob, dtype='<f8').reshape(-1,2)
 
-        # set tier level
-        if (tier not in [2,3,4]):
-            raise Exception("Wrong tier number")
+def _levels2array(levels, descending = False):
+    """Convert dictionary of levels to a sorted array
 
-        self._tier = tier
+    levels --- dict price -> volume
+    descending --- sort prices in descending order (bids)
 
-        # init database
-        self._init_db()
+    return --- np.array of shape (n,2) with price and volume columns
 
+    """
+    import numpy as np
 
-    def _init_db(self):
-        """Create a database with a single table and a single row which
-        contains information about the counter and the timestamp the
-        counter was made
+    res = np.array(sorted(levels.items(), reverse = descending),
+                   dtype=float).reshape(-1,2)
 
-        The aim of the database is to take advatage of the sqlite lock
-        system for interprocess communications.
-        """
+    return res
 
-        # try to create a table
-        try:
-            c = self._dbconn.execute('''BEGIN EXCLUSIVE''')
-
-            # as a timestamp for the counter we use system time
-            # (time.time()). Mostly, for other timestamps we use
-            # kraken time. It might be an option to replace system
-            # time with Kraken time, but in that case one has to set
-            # counter not to zero. Anyway, at the current point it
-            # seems to be a reasonable solution.
-            c.execute('''
-            CREATE TABLE IF NOT EXISTS counter
-            (
-            Lock char(1) NOT NULL DEFAULT 'X',
-            counter REAL NOT NULL,
-            time REAL NOT NULL,
-            CONSTRAINT pk_Lock PRIMARY KEY (Lock),
-            CONSTRAINT ck_Lock_Locked CHECK (Lock = 'X')
-            )''')
-
-            # set the table wiith default values
-            c.execute('''
-            INSERT OR IGNORE INTO counter
-            (counter, time) VALUES
-            (0, ?)''', (time.time(),))
+def __getattr__(name):
+    """Kraken (the API client) is imported from krakenapi on first
+    access, so that the readers of the database do not load krakenex
 
-            # commit changes in database
-            self._dbconn.commit()
-        except Exception as e:
-            logging.error("Error creating database (kraken counter)",e)
-            self._dbconn.rollback()
-            raise e
+    """
+    if 'Kraken' == name:
+        from krakenapi import Kraken
 
-    def _query_cost(self, urlpath):
-        """Determines cost of the urlpath query
+        return Kraken
 
-        urlpath --- path specified in _query
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-        return integer
 
-        """
+class KrakenData(object):
+    """Methods to access and store kraken data
 
-        # determine cost depending on the query
-        if "private/Ledgers" in urlpath or "private/QueryLedgers" in urlpath or\
-           "private/Trades" in urlpath or "private/QueryTrades" in urlpath:
-            return 2
-        elif "private/AddOrder" in urlpath or "private/CancelOrder" in urlpath:
-            return 0
-        else:
-            return 1
+    Data is stored in sqlite3 database. The following data can be
+    downloaded and stored: historical order book, trades history,
+    ledger, personal trades.
 
+    """
 
-    def _if_blocked(self, counter_diff):
-        """Determines whether call rate limit is too high
+    def __init__(self, db_path = '', key_path = '', tier = 3, keyframe_each = 100,
+                 read_only = False):
+        """Constructor
 
-        The functions calls the database and updates its values
+        Here we initialise database connection, kraken class to
+        connect to exchange and other helping variables.
 
-        return True or False. True if call rate is too high
+        db_path --- path for the database location
+        key_path --- kraken key path
+        keyframe_each --- number of order book snapshots of a pair
+        between consecutive keyframes
+        read_only --- open the database read-only and do not connect
+        to the exchange. Only the select methods can be used then
 
         """
+        # init path for db and API keys
+        self._db_path = os.path.expanduser(db_path)
+        self._key_path = os.path.expanduser(key_path)
 
-        try:
-            c = self._dbconn.execute('''BEGIN EXCLUSIVE''')
-
-            c.execute("SELECT counter, time FROM counter")
-            counter, counter_time = c.fetchone()
+        # latest stored order book of every pair: pair -> dict with
+        # snapshot time, keyframe time, frame offset, asks and bids
+        # levels. The first snapshot of a pair after start is always
+        # stored as keyframe
+        self._keyframe_each = keyframe_each
+        self._books = {}
 
-            # determine new counter: tier 2 users reduce count every 3
-            # seconds, tier 3 users reduce count every 2 seconds, tier
-            # 4 users reduce count every 1 second.
-            counter -= (time.time() - counter_time)/(4-(self._tier-1))
+        # cache of pair ids
+        self._pair_ids = {}
 
-            # check if the counter is negative
-            if (counter < 0):
-                counter = 0
+        # order lifetimes computed without the orderBookLifetime
+        # table, see _get_max_lifetime
+        self._lifetimes = {}
 
-            # update value with the new query cost
-            counter += counter_diff
-            counter_time = time.time()
+        # functions called on every newly stored order book
+        self._orderbook_listeners = []
 
-            # write updated values
-            c.execute('''
-            UPDATE counter SET counter = ?, time = ?
-            WHERE Lock ='X'
-            ''', (counter, counter_time))
+        # kraken connection is created on first use (see _kraken)
+        self._tier = tier
+        self._read_only = read_only
+        self._kraken_api = None
 
-            # commit changes
-            self._dbconn.commit()
-        except Exception as e:
-            logging.error("Error db, while getting counter",e)
-            self._dbconn.rollback()
-            raise e
+        if read_only:
+            self._dbconn = sqlite3.connect("file:" + self._db_path + "?mode=ro",
+                                           uri = True, timeout = 60)
+            return
 
-        # determine if blocked
-        if 2 == self._tier:
-            return ceil(counter) >= 15
-        elif 3 == self._tier or 4 == self._tier:
-            return ceil(counter) >= 20
+        # init db connection
+        self._dbconn = sqlite3.connect(self._db_path, timeout = 60)
 
+        # init database
+        self._init_db()
 
-    def _query(self, urlpath, data, headers = None, timeout = None):
-        """Redefinition of low-level query handling
+    @property
+    def _kraken(self):
+        """Kraken connection, created on first use. None if read-only
 
-        Arguments correspond to the parent function.
+        The key is needed only for private queries.
 
         """
+        if self._kraken_api is None and not self._read_only:
+            from krakenapi import Kraken
 
-        # determine cost of the query and add up to the counter
-        counter_diff = self._query_cost(urlpath)
+            self._kraken_api = Kraken(tier = self._tier)
+            if self._key_path:
+                self._kraken_api.load_key(self._key_path)
 
-        while (self._if_blocked(counter_diff)):
-            counter_diff = 0
-            # wait a second
-            time.sleep(1)
+        return self._kraken_api
 
-        # call the parent function
-        return super(Kraken, self)._query(urlpath = urlpath, data = data, \
-                                          headers = headers, timeout = timeout)
 
+    def _get_pair_id(self, pair):
+        """Get id of the pair in the pairs table
 
-class KrakenData(object):
-    """Methods to access and store kraken data
+        pair --- pair name
 
-    Data is stored in sqlite3 database. The following data can be
-    downloaded and stored: historical order book, trades history,
-    ledger, personal trades.
+        return --- integer. KeyError is raised for an unknown pair
 
-    """
+        """
+        if pair in self._pair_ids:
+            return self._pair_ids[pair]
 
-    def __init__(self, db_path = '', key_path = '', tier = 3):
-        """Constructor
+        c = self._dbconn.cursor()
 
-        Here we initialise database connection, kraken class to
-        connect to exchange and other helping variables.
+        try:
+            c.execute('SELECT id from pairs where name = ?', (str(pair),))
+            res = c.fetchone()
+        except Exception as e:
+            logging.error("Error quering pair id",e)
+            self._dbconn.rollback()
+            raise e
 
-        db_path --- path for the database location
-        key_path --- kraken key path
+        if res is None:
+            raise KeyError(pair)
 
-        """
-        # init path for db and API keys
-        self._db_path = os.path.expanduser(db_path)
-        self._key_path = os.path.expanduser(key_path)
+        pair_id = res[0]
+        self._pair_ids[pair] = pair_id
 
-        # init db connection
-        self._dbconn = sqlite3.connect(self._db_path, timeout = 60)
+        return pair_id
 
-        # init kraken connection
-        self._kraken = Kraken(tier = tier)
-        self._kraken.load_key(self._key_path)
 
-        # init database
-        self._init_db()
+    def _has_table(self, name):
+        """Whether the database has a table
 
+        Read-only connections might be opened on databases created
+        before some of the tables.
+
+        name --- table name
+
+        return --- True or False
+
+        """
+        c = self._dbconn.cursor()
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+
+        return c.fetchone() is not None
 
     def _get_pairs(self):
         """Get tradable pairs
@@ -322,6 +304,13 @@ class KrakenData(object):
             logging.error("cannot read createdb.sql to variable",e)
             raise e
 
+        # the schema version is a checksum of the script. Nothing to
+        # do if the database has been initialised with the same one
+        version = zlib.crc32(script.encode()) & 0x7fffffff
+
+        if c.execute("PRAGMA user_version").fetchone()[0] == version:
+            return
+
         # try to execute script with a database. Rollback in case of
         # errors
         try:
@@ -335,6 +324,8 @@ class KrakenData(object):
         if (len(self._get_pairs()) == 0):
             self._init_pairs()
 
+        # set once the pairs are there
+        c.execute("PRAGMA user_version = " + str(version))
         self._dbconn.commit()
 
 
@@ -373,12 +364,14 @@ class KrakenData(object):
         # try to query timestamp
         try:
             c.execute("SELECT time FROM timestamps WHERE name = ?", (str(name),))
-            return c.fetchone()[0]
+            res = c.fetchone()
         except Exception as e:
             logging.error("Error during quering timestamp for '" + str(name) + "', ",e)
             logging.warning("Assuming timestamp is zero")
             return 0
 
+        return 0 if res is None else res[0]
+
 
     def _setTimeStamp(self, name, time):
         """Set a timestamp in the "timestamps" table
@@ -449,10 +442,14 @@ class KrakenData(object):
 
         # convert data to a list
         orderbook_list = []
+        lifetime_list = []
         for pair, pairValue in new_data.items():
+            lifetime = 0
             for askbid, askbidValue in pairValue.items():
                 for item in askbidValue:
                     orderbook_list.append((item[0], item[2], timestamp[pair], askbid, item[1], pair))
+                    lifetime = max(lifetime, timestamp[pair] - int(item[2]))
+            lifetime_list.append((lifetime, pair))
 
         try:
             # add orders
@@ -463,6 +460,13 @@ class KrakenData(object):
             (SELECT id from pairs WHERE name = ?))
             ''', orderbook_list)
 
+            # only the stored lifetimes are updated, they are created
+            # from the whole history by _get_max_lifetime
+            c.executemany('''
+            UPDATE orderBookLifetime SET lifetime = MAX(lifetime, ?)
+            WHERE pair_id = (SELECT id from pairs WHERE name = ?)
+            ''', lifetime_list)
+
         except Exception as e:
             logging.error("Error with db insertion to ordersBook",e)
             self._dbconn.rollback()
@@ -483,13 +487,7 @@ class KrakenData(object):
         c = self._dbconn.cursor()
 
         # get pair id
-        try:
-            c.execute('SELECT id from pairs where name = ?', (str(pair),))
-            pair_id = c.fetchone()[0]
-        except Exception as e:
-            logging.error("Error quering pair id",e)
-            self._dbconn.rollback()
-            raise e
+        pair_id = self._get_pair_id(pair)
 
         try:
             # query orderbook
@@ -508,6 +506,484 @@ class KrakenData(object):
 
         return(query_res)
 
+    def iter_books(self, pair, times):
+        """Iterate over order books at the given time points
+
+        The books are reconstructed in a single ordered pass over the
+        orderBook rows of the pair. Rows are added to the active set
+        once their creation time is passed and removed once their
+        last seen time is passed, so that the yielded books are the
+        same as the ones given by _select_from_OrderBook.
+
+        pair --- trading pair
+        times --- sorted list of time points
+
+        return --- generator of tuples (time, asks, bids), where asks
+        and bids are np.array with price and volume columns, asks are
+        sorted by increasing price and bids by decreasing price
+
+        """
+        import numpy as np
+
+        times = list(times)
+
+        if 0 == len(times):
+            return
+
+        c = self._dbconn.cursor()
+
+        pair_id = self._get_pair_id(pair)
+        lifetime = self._get_max_lifetime(pair_id)
+
+        try:
+            # rows which are alive at some point of times. The rows
+            # are read at once, the read lock is not held while the
+            # books are yielded
+            c.execute('''
+            SELECT id, price, volume, type, time, time_l from orderBook
+            WHERE pair_id = ? AND time >= ? AND time < ? AND time_l > ?
+            ORDER BY time
+            ''', (pair_id, times[0] - lifetime, times[-1], times[0]))
+            rows = iter(c.fetchall())
+        except Exception as e:
+            logging.error("Error quering data from orderBook",e)
+            self._dbconn.rollback()
+            raise e
+
+        self._dbconn.commit()
+
+        # active rows: id -> (price, volume, type), and a heap of
+        # their last seen times
+        active = {}
+        expire = []
+        row = next(rows, None)
+
+        for t in times:
+            while row is not None and row[4] < t:
+                if row[5] > t:
+                    active[row[0]] = row[1:4]
+                    heapq.heappush(expire, (row[5], row[0]))
+                row = next(rows, None)
+
+            while len(expire) and expire[0][0] <= t:
+                active.pop(heapq.heappop(expire)[1], None)
+
+            asks = sorted((p, v) for p, v, askbid in active.values()
+                          if "asks" == askbid)
+            bids = sorted(((p, v) for p, v, askbid in active.values()
+                           if "bids" == askbid), reverse = True)
+
+            yield (t, np.array(asks, dtype=float).reshape(-1,2),
+                   np.array(bids, dtype=float).reshape(-1,2))
+
+    def _get_max_lifetime(self, pair_id):
+        """Longest time an order of a pair has been in the orderBook
+
+        The value is stored in the orderBookLifetime table, it is
+        computed from the whole orderBook of the pair the first time
+        and then kept up to date by _insert_to_OrderBook. Read-only
+        connections and databases without the table compute it (once
+        per object).
+
+        pair_id --- pair id
+
+        return --- seconds
+
+        """
+        if pair_id in self._lifetimes:
+            return self._lifetimes[pair_id]
+
+        c = self._dbconn.cursor()
+
+        try:
+            if not self._read_only:
+                c.execute('''
+                INSERT OR IGNORE INTO orderBookLifetime (pair_id, lifetime)
+                SELECT ?, COALESCE(MAX(time_l - time), 0) FROM orderBook
+                WHERE pair_id = ?
+                ''', (pair_id, pair_id))
+                self._dbconn.commit()
+
+            c.execute("SELECT lifetime FROM orderBookLifetime WHERE pair_id = ?",
+                      (pair_id,))
+            row = c.fetchone()
+            if row is not None:
+                return row[0]
+        except sqlite3.OperationalError:
+            # databases created before the table
+            pass
+
+        c.execute("SELECT COALESCE(MAX(time_l - time), 0) FROM orderBook WHERE pair_id = ?",
+                  (pair_id,))
+        self._lifetimes[pair_id] = c.fetchone()[0]
+        self._dbconn.commit()
+
+        return self._lifetimes[pair_id]
+
+    def add_orderbook_listener(self, listener):
+        """Register a function called on every newly stored order book
+
+        listener --- function with arguments (pair, time, asks, bids,
+        received), where asks and bids are np.array with price and
+        volume columns (asks sorted by increasing price, bids by
+        decreasing price) and received is the local time
+        (time.time()) the book was received at, or None
+
+        The listeners are called by sync_OrderBook as soon as the book
+        of a pair is received, before the sweep over the other pairs
+        is finished and stored.
+
+        """
+        self._orderbook_listeners.append(listener)
+
+    def _notify_orderbook_listeners(self, pair, timestamp, book, received = None):
+        """Call the order book listeners on a received book
+
+        pair --- trading pair
+        timestamp --- snapshot time
+        book --- order book of the pair as given by the Depth query
+        received --- local receive time
+
+        """
+        if 0 == len(self._orderbook_listeners):
+            return
+
+        asks = _levels2array({float(x[0]): float(x[1]) for x in book.get('asks', [])})
+        bids = _levels2array({float(x[0]): float(x[1]) for x in book.get('bids', [])},
+                             descending = True)
+
+        for listener in self._orderbook_listeners:
+            try:
+                listener(pair, timestamp, asks, bids, received)
+            except Exception as e:
+                logging.error("Error in order book listener",e)
+
+    def _insert_to_OrderBookFrames(self, new_data, timestamp, received = None):
+        """Inserts packed order book frames and updates the snapshot catalog
+
+        Every keyframe_each snapshot of a pair is stored as a
+        keyframe, the snapshots in between as deltas with respect to
+        the previous snapshot.
+
+        Frames are keyed by the snapshot time in seconds. A snapshot
+        that is not later than the latest stored one of its pair (two
+        sweeps within a second) is skipped, a frame is never
+        overwritten, which would break the chain of deltas.
+
+        new_data --- a new entries orderbook
+        timestamp --- a list of timestamps of the orderbook download time
+        received --- optional dictionary pair -> local receive time
+
+        """
+
+        c = self._dbconn.cursor()
+
+        frames_list = []
+        snapshots_list = []
+        latest_list = []
+        books = {}
+        received = {} if received is None else received
+        for pair, pairValue in new_data.items():
+            pair_id = self._get_pair_id(pair)
+
+            old = self._books.get(pair)
+
+            # latest stored snapshot, also the ones of earlier runs
+            latest = old['time'] if old is not None else self._get_latest_frame_time(pair_id)
+            if latest is not None and timestamp[pair] <= latest:
+                logging.debug("Skipping order book of " + pair + " at " +
+                              str(timestamp[pair]) + ", the frame exists")
+                continue
+
+            new = {askbid: {float(item[0]): float(item[1])
+                            for item in pairValue.get(askbid, [])}
+                   for askbid in ('asks', 'bids')}
+
+            if old is None or old['offset'] + 1 >= self._keyframe_each:
+                keyframe_time = timestamp[pair]
+                offset = 0
+                frame = new
+            else:
+                keyframe_time = old['keyframe_time']
+                offset = old['offset'] + 1
+                # changed and new levels, removed levels get zero volume
+                frame = {}
+                for askbid in ('asks', 'bids'):
+                    frame[askbid] = {p: v for p, v in new[askbid].items()
+                                     if old[askbid].get(p) != v}
+                    frame[askbid].update({p: 0.0 for p in old[askbid]
+                                          if p not in new[askbid]})
+
+            frames_list.append((pair_id, timestamp[pair], int(0 == offset),
+                                _pack_levels(frame['asks'].items()),
+                                _pack_levels(frame['bids'].items())))
+            snapshots_list.append((pair_id, timestamp[pair], keyframe_time, offset))
+            latest_list.append((pair_id, timestamp[pair], received.get(pair),
+                                _pack_levels(sorted(new['asks'].items())),
+                                _pack_levels(sorted(new['bids'].items(), reverse = True))))
+
+            books[pair] = {'time': timestamp[pair],
+                           'keyframe_time': keyframe_time, 'offset': offset,
+                           'asks': new['asks'], 'bids': new['bids']}
+
+        try:
+            c.executemany('''
+            INSERT INTO orderBookFrames
+            (pair_id, time, keyframe, asks, bids) VALUES
+            (?,?,?,?,?)
+            ''', frames_list)
+
+            c.executemany('''
+            INSERT INTO orderBookSnapshots
+            (pair_id, time, keyframe_time, frame_offset) VALUES
+            (?,?,?,?)
+            ''', snapshots_list)
+
+            c.executemany('''
+            INSERT OR REPLACE INTO orderBookLatest
+            (pair_id, time, received, asks, bids) VALUES
+            (?,?,?,?,?)
+            ''', latest_list)
+        except Exception as e:
+            logging.error("Error with db insertion to orderBookFrames",e)
+            self._dbconn.rollback()
+            # the stored chain is broken, start next frames with keyframes
+            self._books = {}
+            raise e
+
+        # commit changes in database
+        self._dbconn.commit()
+
+        # the in-memory books are updated only after successful commit
+        self._books.update(books)
+
+    def _get_latest_frame_time(self, pair_id):
+        """Time of the latest stored frame of a pair, None if none"""
+        c = self._dbconn.cursor()
+        c.execute("SELECT MAX(time) FROM orderBookFrames WHERE pair_id = ?", (pair_id,))
+
+        return c.fetchone()[0]
+
+    def select_latest_book(self, pair, arrays = True):
+        """Latest stored order book of a pair
+
+        pair --- trading pair
+        arrays --- return np.array. Otherwise asks and bids are lists of
+        (price, volume) tuples, see _unpack_levels
+
+        return --- tuple (snapshot time, receive time, asks, bids),
+        see select_book. None if no book is stored
+
+        """
+
+        c = self._dbconn.cursor()
+
+        pair_id = self._get_pair_id(pair)
+
+        try:
+            c.execute('''
+            SELECT time, received, asks, bids FROM orderBookLatest
+            WHERE pair_id = ?
+            ''', (pair_id,))
+            res = c.fetchone()
+        except Exception as e:
+            logging.error("Error quering data from orderBookLatest",e)
+            self._dbconn.rollback()
+            raise e
+
+        self._dbconn.commit()
+
+        if res is None:
+            return None
+
+        return (res[0], res[1], _unpack_levels(res[2], arrays),
+                _unpack_levels(res[3], arrays))
+
+    def get_pair_info(self, pair):
+        """Get the row of the pair in the pairs table
+
+        pair --- pair name
+
+        return --- dictionary column -> value. KeyError is raised for
+        an unknown pair
+
+        """
+        c = self._dbconn.cursor()
+
+        try:
+            c.execute('SELECT * from pairs where name = ?', (str(pair),))
+            res = c.fetchone()
+            names = [x[0] for x in c.description]
+        except Exception as e:
+            logging.error("Error quering pair",e)
+            self._dbconn.rollback()
+            raise e
+
+        if res is None:
+            raise KeyError(pair)
+
+        return dict(zip(names, res))
+
+    def select_book(self, time, pair):
+        """Rebuild order book at a given time from the packed frames
+
+        The book is rebuilt from the latest snapshot not later than
+        time: its keyframe is unpacked and the following delta frames
+        are replayed.
+
+        Only the snapshots recorded since the frames exist are
+        covered, the older orderBook rows are not converted to
+        frames. Use iter_books for them.
+
+        time --- query time
+        pair --- trading pair that for which order book is queried
+
+        return --- tuple (snapshot time, asks, bids), where asks and
+        bids are np.array with price and volume columns, asks are
+        sorted by increasing price and bids by decreasing price. None
+        if there is no snapshot before time
+
+        """
+
+        c = self._dbconn.cursor()
+
+        pair_id = self._get_pair_id(pair)
+
+        try:
+            c.execute('''
+            SELECT time, keyframe_time FROM orderBookSnapshots
+            WHERE pair_id = ? AND time <= ?
+            ORDER BY time DESC LIMIT 1
+            ''', (pair_id, time))
+            snapshot = c.fetchone()
+
+            if snapshot is None:
+                self._dbconn.commit()
+                return None
+
+            c.execute('''
+            SELECT keyframe, asks, bids FROM orderBookFrames
+            WHERE pair_id = ? AND time >= ? AND time <= ?
+            ORDER BY time
+            ''', (pair_id, snapshot[1], snapshot[0]))
+            frames = c.fetchall()
+        except Exception as e:
+            logging.error("Error quering data from orderBookFrames",e)
+            self._dbconn.rollback()
+            raise e
+
+        self._dbconn.commit()
+
+        if 0 == len(frames) or not frames[0][0]:
+            raise RuntimeError("Missing keyframe for " + str(pair) +
+                               " at " + str(snapshot[1]))
+
+        asks, bids = {}, {}
+        for _, a, b in frames:
+            for levels, blob in ((asks, a), (bids, b)):
+                for p, v in _unpack_levels(blob):
+                    if 0 == v:
+                        levels.pop(p, None)
+                    else:
+                        levels[p] = v
+
+        return (snapshot[0], _levels2array(asks), _levels2array(bids, descending = True))
+
+    def get_snapshot_times(self, pair, start = None, end = None):
+        """Get times of the collected order book snapshots
+
+        The times are taken from the snapshot catalog. For databases
+        collected before the catalog existed the distinct last seen
+        times of the orderBook are used instead.
+
+        pair --- trading pair
+        start, end --- optional time interval (inclusive)
+
+        return --- sorted list of integers
+
+        """
+
+        c = self._dbconn.cursor()
+
+        pair_id = self._get_pair_id(pair)
+        start = -float('inf') if start is None else start
+        end = float('inf') if end is None else end
+
+        try:
+            res = []
+            if self._has_table("orderBookSnapshots"):
+                c.execute('''
+                SELECT time FROM orderBookSnapshots
+                WHERE pair_id = ? AND time >= ? AND time <= ?
+                ORDER BY time
+                ''', (pair_id, start, end))
+                res = c.fetchall()
+
+            if 0 == len(res):
+                c.execute('''
+                SELECT DISTINCT time_l FROM orderBook
+                WHERE pair_id = ? AND time_l >= ? AND time_l <= ?
+                ORDER BY time_l
+                ''', (pair_id, start, end))
+                res = c.fetchall()
+        except Exception as e:
+            logging.error("Error quering snapshot times",e)
+            self._dbconn.rollback()
+            raise e
+
+        self._dbconn.commit()
+
+        return [x[0] for x in res]
+
+    def _insert_to_Predictions(self, predictions):
+        """Inserts model predictions to the database
+
+        predictions --- list of tuples (pair, time, model, prediction,
+        latency)
+
+        """
+
+        c = self._dbconn.cursor()
+
+        try:
+            c.executemany('''
+            INSERT OR REPLACE INTO predictions
+            (pair_id, time, model, prediction, latency) VALUES
+            ((SELECT id from pairs WHERE name = ?),
+            ?,?,?,?)
+            ''', predictions)
+        except Exception as e:
+            logging.error("Error with db insertion to predictions",e)
+            self._dbconn.rollback()
+            raise e
+
+        # commit changes in database
+        self._dbconn.commit()
+
+    def _insert_to_ArbitrageOpportunities(self, opportunities):
+        """Inserts arbitrage opportunities to the database
+
+        opportunities --- list of tuples (time, owncur, cycles, size,
+        profit, solution)
+
+        """
+
+        c = self._dbconn.cursor()
+
+        try:
+            c.executemany('''
+            INSERT OR REPLACE INTO arbitrageOpportunities
+            (time, owncur, cycles, size, profit, solution) VALUES
+            (?,?,?,?,?,?)
+            ''', opportunities)
+        except Exception as e:
+            logging.error("Error with db insertion to arbitrageOpportunities",e)
+            self._dbconn.rollback()
+            raise e
+
+        # commit changes in database
+        self._dbconn.commit()
+
     def _insert_to_OrdersPrivate(self, new_data, time):
         """Insert new orders to the database
 
@@ -609,8 +1085,6 @@ class KrakenData(object):
         new_data --- new data with ledger entries
         time --- time the ledger has been fetched (Kraken time)
 
-        NOT TESTED
-
         """
 
         c = self._dbconn.cursor()
@@ -641,6 +1115,118 @@ class KrakenData(object):
         self._dbconn.commit()
 
 
+    def _select_ledger_to_export(self, filename):
+        """Ledger entries with refids not exported to a file yet
+
+        Only the entries from the export timestamp of the file on are
+        looked at, see _insert_to_ledgerExported. The refids skipped
+        for the file are left out.
+
+        filename --- ledger file
+
+        return --- list of dictionaries in the format of the Ledgers
+        query, with the ledger id in 'id', ordered by time
+
+        """
+        c = self._dbconn.cursor()
+
+        start = self._getTimeStamp("ledgerExported " + filename)
+
+        try:
+            c.execute('''
+            SELECT l.ledgerid, l.refid, l.time, l.type, l.aclass, l.asset,
+            l.amount, l.fee, l.balance
+            FROM ledger l
+            LEFT JOIN ledgerExported e ON e.refid = l.refid AND e.filename = ?
+            LEFT JOIN ledgerSkipped s ON s.refid = l.refid AND s.filename = ?
+            WHERE l.time >= ? AND e.refid IS NULL AND s.refid IS NULL
+            ORDER BY l.time
+            ''', (filename, filename, start))
+            res = c.fetchall()
+        except Exception as e:
+            logging.error("Error quering ledger entries to export",e)
+            self._dbconn.rollback()
+            raise e
+
+        self._dbconn.commit()
+
+        names = ('id', 'refid', 'time', 'type', 'aclass', 'asset', 'amount', 'fee', 'balance')
+        return [dict(zip(names, x)) for x in res]
+
+    def _insert_to_ledgerExported(self, refids, filename, time, start, skipped = ()):
+        """Mark refids as exported to a file
+
+        refids --- list of refids written to the file
+        filename --- ledger file
+        time --- time of the export
+        start --- time of the earliest entry that is still not
+        exported (e.g. a trade with one entry so far), or of the
+        latest exported entry. The next export starts there
+        skipped --- list of tuples (refid, reason) of the groups that
+        are not written to the file and are not looked at anymore
+
+        """
+        c = self._dbconn.cursor()
+
+        try:
+            c.executemany('''
+            INSERT OR IGNORE INTO ledgerExported (refid, filename, time)
+            VALUES (?,?,?)
+            ''', [(x, filename, time) for x in refids])
+
+            c.executemany('''
+            INSERT OR IGNORE INTO ledgerSkipped (refid, filename, time, reason)
+            VALUES (?,?,?,?)
+            ''', [(x, filename, time, reason) for x, reason in skipped])
+        except Exception as e:
+            logging.error("Error with db insertion to ledgerExported",e)
+            self._dbconn.rollback()
+            raise e
+
+        # update timestamp and commit changes in database
+        self._setTimeStamp("ledgerExported " + filename, start)
+
+    def sync_ledger(self, timeout = 5):
+        """Download the new ledger entries to the database
+
+        The entries are queried from the time of the latest stored
+        entry on (with an overlap of a second, the entries are unique
+        by the ledger id) up to the current server time. The pages of
+        the Ledgers query within this interval are taken by offset,
+        until all entries of the interval are fetched.
+
+        timeout --- seconds between the queries
+
+        return --- number of the fetched entries
+
+        """
+        c = self._dbconn.cursor()
+        c.execute("SELECT MAX(time) FROM ledger")
+        start = c.fetchone()[0]
+
+        end = self._get_ServerTime()
+        arg = {'start': 0 if start is None else start - 1, 'end': end, 'ofs': 0}
+
+        new_data = {}
+        while True:
+            t = self._kraken.query_private('Ledgers', arg)
+
+            if (len(t['error'])):
+                raise Exception("API error", t['error'])
+
+            entries = t['result']['ledger']
+            new_data.update(entries)
+            arg['ofs'] += len(entries)
+
+            if 0 == len(entries) or len(new_data) >= int(t['result']['count']):
+                break
+
+            time.sleep(timeout)
+
+        self._insert_to_ledger(new_data, end)
+
+        return len(new_data)
+
     def sync_RecentTrades(self, pairs = None):
         """Download recent trades data
 
@@ -715,6 +1301,9 @@ class KrakenData(object):
         # timestamps of the orderBook entries (for each pair)
         timestamp = {}
 
+        # local times the orderBook entries were received at
+        received = {}
+
         # get pairs list
         if pairs is None:
             pairs = self._get_pairs()
@@ -736,9 +1325,14 @@ class KrakenData(object):
                 continue
 
             new_data[pair] = t[pair]
-            timestamp[pair] = time.server + int(time.time() - time.local)
+            received[pair] = time.time()
+            timestamp[pair] = time.server + int(received[pair] - time.local)
+
+            self._notify_orderbook_listeners(pair, timestamp[pair], t[pair],
+                                             received[pair])
 
         self._insert_to_OrderBook(new_data,timestamp)
+        self._insert_to_OrderBookFrames(new_data,timestamp,received)
 
 
     def _sync_OrdersPrivate(self):
@@ -0,0 +1,233 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Kraken API client with the call rate control
+
+The module is imported by kraken.Kraken on first access, so that
+krakenex (and requests) is loaded only by the users of the API.
+
+"""
+
+import krakenex
+
+import time
+
+import os
+
+import sqlite3
+
+from math import ceil
+
+import logging
+
+
+class Kraken(krakenex.API):
+    """A wrap for the krakekex with API call rate control
+
+    """
+
+    def __init__(self, key = '', secret = '', tier = 3, db_path = "/tmp/kraken_counter.db"):
+        """Constructor for the child
+
+        The most important part of initialising a child class is to
+        set the tier. Different tier level implies different API call
+        rate, see
+        <https://www.kraken.com/help/api#api-call-rate-limit>
+
+        key, secret --- parameters for the krakenex.API constructor
+
+        tier --- kraken tier (possible values 2,3 or 4). Exception otherwise
+
+        db_path --- path to the database where the current counter is
+        stored. DB support allows to run several instances and have
+        inter-process communications (at least among the processes
+        that share the common database), so that the queries rate call
+        is not too high.
+        """
+        # call constructor of the parent
+        super(Kraken, self).__init__(key = key, secret = secret)
+
+        db_path = os.path.expanduser(db_path)
+
+        # set up a database for storing counter and counter_time
+        self._dbconn = sqlite3.connect(db_path, timeout = 15, isolation_level="EXCLUSIVE")
+
+        # set tier level
+        if (tier not in [2,3,4]):
+            raise Exception("Wrong tier number")
+
+        self._tier = tier
+
+        # init database
+        self._init_db()
+
+
+    def _init_db(self):
+        """Create a database with a single table and a single row which
+        contains information about the counter and the timestamp the
+        counter was made
+
+        The aim of the database is to take advatage of the sqlite lock
+        system for interprocess communications.
+        """
+
+        # try to create a table
+        try:
+            c = self._dbconn.execute('''BEGIN EXCLUSIVE''')
+
+            # as a timestamp for the counter we use system time
+            # (time.time()). Mostly, for other timestamps we use
+            # kraken time. It might be an option to replace system
+            # time with Kraken time, but in that case one has to set
+            # counter not to zero. Anyway, at the current point it
+            # seems to be a reasonable solution.
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS counter
+            (
+            Lock char(1) NOT NULL DEFAULT 'X',
+            counter REAL NOT NULL,
+            time REAL NOT NULL,
+            CONSTRAINT pk_Lock PRIMARY KEY (Lock),
+            CONSTRAINT ck_Lock_Locked CHECK (Lock = 'X')
+            )''')
+
+            # set the table wiith default values
+            c.execute('''
+            INSERT OR IGNORE INTO counter
+            (counter, time) VALUES
+            (0, ?)''', (time.time(),))
+
+            # commit changes in database
+            self._dbconn.commit()
+        except Exception as e:
+            logging.error("Error creating database (kraken counter)",e)
+            self._dbconn.rollback()
+            raise e
+
+    def _query_cost(self, urlpath):
+        """Determines cost of the urlpath query
+
+        urlpath --- path specified in _query
+
+        return integer
+
+        """
+
+        # determine cost depending on the query
+        if "private/Ledgers" in urlpath or "private/QueryLedgers" in urlpath or\
+           "private/Trades" in urlpath or "private/QueryTrades" in urlpath:
+            return 2
+        elif "private/AddOrder" in urlpath or "private/CancelOrder" in urlpath:
+            return 0
+        else:
+            return 1
+
+
+    def _if_blocked(self, counter_diff):
+        """Determines whether call rate limit is too high
+
+        The functions calls the database and updates its values
+
+        return True or False. True if call rate is too high
+
+        """
+
+        try:
+            c = self._dbconn.execute('''BEGIN EXCLUSIVE''')
+
+            c.execute("SELECT counter, time FROM counter")
+            counter, counter_time = c.fetchone()
+
+            # determine new counter: tier 2 users reduce count every 3
+            # seconds, tier 3 users reduce count every 2 seconds, tier
+            # 4 users reduce count every 1 second.
+            counter -= (time.time() - counter_time)/(4-(self._tier-1))
+
+            # check if the counter is negative
+            if (counter < 0):
+                counter = 0
+
+            # update value with the new query cost
+            counter += counter_diff
+            counter_time = time.time()
+
+            # write updated values
+            c.execute('''
+            UPDATE counter SET counter = ?, time = ?
+            WHERE Lock ='X'
+            ''', (counter, counter_time))
+
+            # commit changes
+            self._dbconn.commit()
+        except Exception as e:
+            logging.error("Error db, while getting counter",e)
+            self._dbconn.rollback()
+            raise e
+
+        # determine if blocked
+        return ceil(counter) >= self._counter_limit()
+
+    def _counter_limit(self):
+        """Counter value at which the calls are blocked"""
+        return 15 if 2 == self._tier else 20
+
+    def _get_counter(self):
+        """Current value of the counter, the database is not changed"""
+        c = self._dbconn.execute("SELECT counter, time FROM counter")
+        counter, counter_time = c.fetchone()
+
+        return max(0, counter - (time.time() - counter_time)/(4-(self._tier-1)))
+
+    def wait_budget(self, cost):
+        """Wait until calls of the given cost can be made at once
+
+        The calls are not counted here, the counter is updated by the
+        calls themselves (see _query).
+
+        cost --- total cost of the calls, at most one less than the
+        counter limit
+
+        """
+        cost = min(cost, self._counter_limit() - 1)
+
+        while True:
+            excess = ceil(self._get_counter() + cost) - self._counter_limit() + 1
+            if excess <= 0:
+                return
+            # until the counter is decreased by the excess
+            time.sleep(excess*(4-(self._tier-1)))
+
+
+    def _query(self, urlpath, data, headers = None, timeout = None):
+        """Redefinition of low-level query handling
+
+        Arguments correspond to the parent function.
+
+        """
+
+        # determine cost of the query and add up to the counter
+        counter_diff = self._query_cost(urlpath)
+
+        while (self._if_blocked(counter_diff)):
+            counter_diff = 0
+            # wait a second
+            time.sleep(1)
+
+        # call the parent function
+        return super(Kraken, self)._query(urlpath = urlpath, data = data, \
+                                          headers = headers, timeout = timeout)
@@ -0,0 +1,78 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+def multi_horizon_labels(price, horizons, rhos):
+    """Price movement classes for a grid of horizons and rates
+
+    Class 1 at time point t for horizon T and rate rho if for every
+    step x = 1,...,T-1 the price has increased at least linearly,
+    price[t+x]/price[t] - 1 > rho*x. Class -1 if the price decreased
+    analogously, class 0 otherwise.
+
+    The condition is equivalent to a bound on the minimum (maximum)
+    of the per-step rates (price[t+x]/price[t] - 1)/x over the window
+    of steps. The running minimum and maximum over the steps are
+    computed once for the largest horizon, the smaller horizons are
+    taken on the way and compared to all rates at once.
+
+    price --- market prices
+    horizons --- list of horizons T
+    rhos --- list of rates rho
+
+    return --- np.array of int8 of shape (len(horizons), len(rhos),
+    len(price)). Classes of horizon T are defined for time points t <
+    len(price) - T, the rest is 0
+
+    """
+    price = np.asarray(price, dtype=float)
+    horizons = np.asarray(horizons, dtype=int)
+    rhos = np.asarray(rhos, dtype=float)
+    n = len(price)
+
+    res = np.zeros((len(horizons), len(rhos), n), dtype=np.int8)
+
+    # running minimum and maximum of the per-step rates
+    rmin = np.full(n, np.inf)
+    rmax = np.full(n, -np.inf)
+
+    for x in range(1, max(horizons.max(initial=0), 1)):
+        rate = (price[x:]/price[:-x] - 1)/x
+        np.minimum(rmin[:n-x], rate, out=rmin[:n-x])
+        np.maximum(rmax[:n-x], rate, out=rmax[:n-x])
+
+        for h in np.nonzero(horizons == x + 1)[0]:
+            m = max(n - x - 1, 0)
+            res[h,:,:m][rmin[None,:m] > rhos[:,None]] = 1
+            res[h,:,:m][rmax[None,:m] < -rhos[:,None]] = -1
+
+    return res
+
+def get_classes(price, T, rho):
+    """Get classes for classification from the market price changes
+
+    See multi_horizon_labels.
+
+    price --- market prices
+    T --- time period for price rise/decrease
+    rho --- rate of increase/decrease to make classes
+
+    return --- np.array of length len(price) - T
+
+    """
+    return multi_horizon_labels(price, [T], [rho])[0,0,:max(len(price) - T, 0)].astype(int)
@@ -0,0 +1,299 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Market data served from memory over a local Unix socket
+
+The protocol is a sequence of request/response pairs over one
+connection. A request is
+
+    opcode (uint8) | length (uint16) | pair name (utf-8)
+
+and a response is
+
+    status (uint8) | time (float64) | length (uint32) | payload
+
+with little-endian numbers. Status is 0 on success and 1 if nothing
+is known about the pair. The payloads are
+
+    BOOK   --- n_asks (uint32) | n_bids (uint32) | asks | bids, where
+               asks and bids are float64 (price, volume) pairs
+    TICKER --- ask price, ask volume, bid price, bid volume (float64),
+               the top of the latest book. It is not the ticker of
+               the exchange: there is no last trade, volume or
+               high/low, and it is as old as the book
+    PAIRS  --- json of the pairs table row of the pair, or of all
+               pairs (name -> row) for an empty pair name
+
+The server is fed by "krak logger --socket" and holds only what the
+logger stores: the books of the logged pairs and the pairs table.
+"krak depth --local" and depth.py read the books from it and fall back
+to the database or to the exchange. orders.py needs the open orders of
+the account, which are private and not served. The arbitrage logger
+(arbitrage.py, functions.log_arbitrage) fetches the books of all
+pairs at once itself, as the logger fetches them one after another.
+
+"""
+
+import json
+
+import logging
+
+import os
+
+import socket
+
+import socketserver
+
+import struct
+
+import threading
+
+BOOK = 1
+TICKER = 2
+PAIRS = 3
+
+_REQUEST = struct.Struct('<BH')
+_RESPONSE = struct.Struct('<BdI')
+_BOOK = struct.Struct('<II')
+_TICKER = struct.Struct('<dddd')
+_LEVEL = struct.Struct('<dd')
+
+def _recvall(sock, n):
+    """Receive exactly n bytes
+
+    return --- bytes, or None if the connection is closed
+    """
+    res = bytearray()
+    while len(res) < n:
+        x = sock.recv(n - len(res))
+        if not x:
+            return None
+        res += x
+
+    return bytes(res)
+
+class _Handler(socketserver.BaseRequestHandler):
+    """Answers requests of one connection"""
+
+    def handle(self):
+        while True:
+            header = _recvall(self.request, _REQUEST.size)
+            if header is None:
+                return
+
+            opcode, n = _REQUEST.unpack(header)
+            pair = _recvall(self.request, n)
+            if pair is None:
+                return
+
+            self.request.sendall(self.server.market.response(opcode, pair.decode()))
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class MarketDataServer(object):
+    """Latest books, tickers and pair metadata held in memory
+
+    The server is fed by the logger: update has the signature of an
+    order book listener (see KrakenData.add_orderbook_listener). The
+    responses are packed on update, so that a read is a dictionary
+    lookup and a send.
+
+    """
+
+    def __init__(self, path, kraken = None):
+        """Constructor
+
+        path --- location of the Unix socket
+        kraken --- optional KrakenData object. The pair metadata and
+        the latest stored books are loaded from its database
+
+        """
+        self._path = os.path.expanduser(path)
+
+        # pair -> packed responses
+        self._books = {}
+        self._tickers = {}
+        self._pairs = {}
+
+        if kraken is not None:
+            pairs = {}
+            for pair in kraken._get_pairs():
+                pairs[pair] = kraken.get_pair_info(pair)
+                self._pairs[pair] = self._pack(0, json.dumps(pairs[pair]).encode())
+
+                book = kraken.select_latest_book(pair)
+                if book is not None:
+                    self.update(pair, book[0], book[2], book[3])
+
+            self._pairs[''] = self._pack(0, json.dumps(pairs).encode())
+
+        self._server = None
+
+    @staticmethod
+    def _pack(time, payload, status = 0):
+        return _RESPONSE.pack(status, time, len(payload)) + payload
+
+    def update(self, pair, time, asks, bids, received = None):
+        """Store a new order book of a pair
+
+        pair --- trading pair
+        time --- snapshot time
+        asks, bids --- np.array with price and volume columns
+        received --- local receive time (unused)
+
+        """
+        import numpy as np
+
+        asks = np.ascontiguousarray(asks, dtype='<f8')
+        bids = np.ascontiguousarray(bids, dtype='<f8')
+
+        self._books[pair] = self._pack(time, _BOOK.pack(len(asks), len(bids)) +
+                                       asks.tobytes() + bids.tobytes())
+
+        if len(asks) and len(bids):
+            self._tickers[pair] = self._pack(time, _TICKER.pack(asks[0,0], asks[0,1],
+                                                                bids[0,0], bids[0,1]))
+
+    def response(self, opcode, pair):
+        """Packed response to a request
+
+        opcode --- BOOK, TICKER or PAIRS
+        pair --- trading pair
+
+        return --- bytes
+
+        """
+        table = {BOOK: self._books, TICKER: self._tickers, PAIRS: self._pairs}
+
+        if opcode not in table or pair not in table[opcode]:
+            return self._pack(0, b'', status = 1)
+
+        return table[opcode][pair]
+
+    def start(self):
+        """Start serving in a background thread"""
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+        self._server = _Server(self._path, _Handler)
+        self._server.market = self
+
+        thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        thread.start()
+
+        logging.info("Market data served at " + self._path)
+
+    def close(self):
+        """Stop serving and remove the socket"""
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+class MarketDataClient(object):
+    """Client of MarketDataServer"""
+
+    def __init__(self, path, timeout = 1):
+        """Constructor
+
+        path --- location of the Unix socket
+        timeout --- socket timeout in seconds
+
+        """
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(os.path.expanduser(path))
+
+    def _query(self, opcode, pair):
+        pair = pair.encode()
+        self._sock.sendall(_REQUEST.pack(opcode, len(pair)) + pair)
+
+        header = _recvall(self._sock, _RESPONSE.size)
+        if header is None:
+            raise RuntimeError("Market data server closed connection")
+
+        status, time, n = _RESPONSE.unpack(header)
+        payload = _recvall(self._sock, n) if n else b''
+
+        if status:
+            return None
+
+        return (time, payload)
+
+    def book(self, pair, arrays = True):
+        """Latest order book of a pair
+
+        arrays --- return np.array. Otherwise asks and bids are lists of
+        (price, volume) tuples, and numpy is not imported
+
+        return --- tuple (time, asks, bids), see KrakenData.select_book.
+        None if the pair is unknown
+
+        """
+        res = self._query(BOOK, pair)
+        if res is None:
+            return None
+
+        time, payload = res
+        n_asks, n_bids = _BOOK.unpack_from(payload)
+
+        if not arrays:
+            levels = list(_LEVEL.iter_unpack(payload[_BOOK.size:]))
+            return (time, levels[:n_asks], levels[n_asks:n_asks+n_bids])
+
+        import numpy as np
+
+        levels = np.frombuffer(payload, dtype='<f8', offset = _BOOK.size).reshape(-1,2)
+
+        return (time, levels[:n_asks], levels[n_asks:n_asks+n_bids])
+
+    def ticker(self, pair):
+        """Top of the latest order book of a pair
+
+        This is not the ticker of the exchange, see TICKER in the
+        module description.
+
+        return --- tuple (time, (ask price, ask volume, bid price, bid
+        volume)). None if the pair is unknown
+
+        """
+        res = self._query(TICKER, pair)
+        if res is None:
+            return None
+
+        return (res[0], _TICKER.unpack(res[1]))
+
+    def pairs(self, pair = ''):
+        """Metadata of a pair, or of all pairs for an empty name
+
+        return --- dictionary. None if the pair is unknown
+
+        """
+        res = self._query(PAIRS, pair)
+        if res is None:
+            return None
+
+        return json.loads(res[1].decode())
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,200 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import time
+
+import numpy as np
+
+import networkx as nx
+
+from functions import DepthMatrix, pair_depth, pair_fees, head_depth_matrix, \
+    solve_lp, lp_variables_names, print_strategy, f2s
+
+class ArbitrageMonitor(object):
+    """Continuous arbitrage detection on the order book stream
+
+    An instance is registered as an order book listener of KrakenData
+    (see KrakenData.add_orderbook_listener). The currency graph and
+    its cycles are enumerated once. Every pair has two directed edges
+    with the log of the best exchange rate (as in
+    functions.top_depth_matrix), and every cycle is a row of edge
+    indices, so that an update of a pair changes two numbers and
+    rechecks only the cycles through the pair.
+
+    Once a cycle gains, the depth-aware LP (functions.solve_lp) is
+    solved on the pairs of the gaining cycles only. The per-pair
+    depth slices are computed lazily and kept until the book of the
+    pair changes.
+
+    """
+
+    def __init__(self, pairs, owncur = ["ZEUR"], max_length = 4, head = 2,
+                 tol = 1e-9, callback = None):
+        """Constructor
+
+        pairs --- whatever functions.query_tradable_pairs returns
+        owncur --- list of own currencies, see functions.solve_lp
+        max_length --- maximal number of currencies in a cycle
+        head --- number of first volumes of a pair in the LP, the n
+        of functions.head_depth_matrix (at most head - 1 slices in a
+        direction)
+        tol --- minimal log gain of a cycle
+        callback --- function called with every opportunity (a
+        dictionary, see __call__). Default: log it
+
+        """
+        self._pairs = pairs
+        self._owncur = owncur
+        self._head = head
+        self._tol = tol
+        self._callback = callback
+
+        # edge 2*i is base->quote, 2*i+1 is quote->base of pair i
+        self._names = list(pairs.keys())
+        self._codes = {x: i for i, x in enumerate(self._names)}
+
+        G = nx.Graph()
+        edges = {}
+        for i, key in enumerate(self._names):
+            b, q = pairs[key]['base'], pairs[key]['quote']
+            if (b, q) in edges:
+                continue
+            edges[(b, q)] = 2*i
+            edges[(q, b)] = 2*i + 1
+            G.add_edge(b, q)
+
+        # log rates, the last one is the padding of short cycles. No
+        # book yet means no exchange
+        self._lograte = np.full(2*len(self._names) + 1, -np.inf)
+        self._lograte[-1] = 0
+
+        cycles = []
+        for c in nx.simple_cycles(G, length_bound = max_length):
+            if len(c) < 3:
+                continue
+            for c in (c, c[::-1]):
+                e = [edges[(a, b)] for a, b in zip(c, c[1:] + c[:1])]
+                cycles += [e + [len(self._lograte) - 1]*(max_length - len(e))]
+
+        self._cycles = np.array(cycles, dtype=int).reshape(-1, max_length)
+
+        # pair -> indices of the cycles through the pair
+        pair_of_cycle = self._cycles // 2
+        self._pair_cycles = {}
+        for i in range(len(self._names)):
+            self._pair_cycles[i] = np.nonzero(np.any(pair_of_cycle == i, axis=1))[0]
+
+        self._books = {}
+        self._chunks = {}
+
+        logging.info("Arbitrage monitor: " + str(len(self._cycles)) + " cycles")
+
+    def cycle_str(self, cycle):
+        """Human readable cycle 'A->B->C->A'"""
+        res = []
+        for e in cycle:
+            if e >= 2*len(self._names):
+                break
+            key = self._names[e // 2]
+            b, q = self._pairs[key]['base'], self._pairs[key]['quote']
+            res += [b] if 0 == e % 2 else [q]
+
+        return '->'.join(res + res[:1])
+
+    def _depth(self, i):
+        """Depth slices of pair i, see functions.pair_depth"""
+        if i not in self._chunks:
+            key = self._names[i]
+            self._chunks[i] = pair_depth(key, self._books[i], self._pairs)
+
+        return self._chunks[i]
+
+    def __call__(self, pair, time_, asks, bids, received = None):
+        """Process a new order book snapshot
+
+        Arguments are the ones of an order book listener, see
+        KrakenData.add_orderbook_listener.
+
+        return --- the opportunity, or None. An opportunity is a
+        dictionary with 'time', 'pair' (the updated pair), 'cycles'
+        (list of tuples (cycle, gain)), 'objective' and 'solution' of
+        the LP, 'edges' (dict edge index -> volume) and 'prices' (the
+        DepthMatrix of the LP), 'detected' (time of the detection) and
+        'latency' (seconds from receiving the book, or from the call if
+        received is unknown, to the detection)
+
+        """
+        start = time.time()
+
+        if pair not in self._codes:
+            return None
+        i = self._codes[pair]
+
+        if 0 == len(asks) or 0 == len(bids):
+            self._lograte[2*i:2*i+2] = -np.inf
+            self._books.pop(i, None)
+            self._chunks.pop(i, None)
+            return None
+
+        fp, fq = pair_fees(pair, self._pairs)
+        self._lograte[2*i] = np.log(bids[0][0]*(1-fq))
+        self._lograte[2*i+1] = -np.log(asks[0][0]*(1+fp))
+
+        # the same format as query_orderbook has
+        self._books[i] = {x: [[p, v, time_] for p, v in y]
+                          for x, y in (('asks', asks), ('bids', bids))}
+        self._chunks.pop(i, None)
+
+        idx = self._pair_cycles[i]
+        gain = self._lograte[self._cycles[idx]].sum(axis=1)
+        idx = idx[gain > self._tol]
+
+        if 0 == len(idx):
+            return None
+
+        cycles = [(self.cycle_str(c), np.expm1(g)) for c, g in
+                  zip(self._cycles[idx], self._lograte[self._cycles[idx]].sum(axis=1))]
+
+        # the LP on the pairs of the gaining cycles
+        codes = np.unique(self._cycles[idx] // 2)
+        codes = codes[codes < len(self._names)]
+        prices = DepthMatrix.from_pairs([self._depth(x) for x in codes])
+        prices = head_depth_matrix(prices, n = self._head)
+
+        xs, _ = lp_variables_names(prices, owncur = self._owncur)
+        sol = solve_lp(prices, owncur = self._owncur)
+        S, _ = print_strategy(sol, xs, prices)
+
+        res = {'time': time_, 'pair': pair, 'cycles': cycles,
+               'objective': sol['objective'],
+               'solution': {(prices.key(k) if not isinstance(k, str) else k): v
+                            for k, v in S.items()},
+               'edges': {k: v for k, v in S.items() if not isinstance(k, str)},
+               'prices': prices, 'detected': time.time()}
+        res['latency'] = res['detected'] - (start if received is None else received)
+
+        if self._callback is not None:
+            self._callback(res)
+        else:
+            logging.info("Arbitrage after " + pair + " update: " +
+                         ", ".join(c + " " + f2s(g) for c, g in cycles) +
+                         "; objective " + f2s(res['objective']) +
+                         "; latency " + f2s(res['latency'], "{:.6f}") + "s")
+
+        return res
@@ -1,5 +1,9 @@
 #!/bin/env python3
 
+# The open orders are private, the market data server of the logger
+# (see marketdata.py) does not have them, they are queried from the
+# exchange
+
 import sys
 
 from tabulate import tabulate
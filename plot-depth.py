@@ -1,71 +1,143 @@
 #!/bin/env python3
 
-from kraken import Kraken, KrakenData
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from collections import deque
+from kraken import KrakenData
 
 from matplotlib import pyplot as plt
-from matplotlib import animation
 import numpy as np
+import subprocess
+import os
 
-kraken = KrakenData(db_path="data/data.db",key_path="keys/albus.key")
+def query_cumsum(asks, bids, interval=(0.8,1.2)):
+    """Convert order book to the cumsum of bids and asks
 
-def query_cumsum(depth_res, interval=(0.8,1.2)):
-    """Convert query result to the cumsum of bids and asks
+    asks, bids --- order book arrays as given by KrakenData.iter_books
 
-    depth_res --- result of the query
-    
-    """
-    # get asks and bids from queried data
-    asks = list(filter(lambda x: x[2] == "asks", depth_res))
-    bids = list(filter(lambda x: x[2] == "bids", depth_res))
-    
-    # sort by price
-    asks = sorted(asks, key=lambda x: x[0])
-    bids = sorted(bids, key=lambda x: -x[0])
+    interval --- price interval relative to the market price
 
+    """
     # calculate accumulated volume and corresponding price
-    volume = list(np.cumsum([float(x[1]) for x in bids]))[::-1] + list(np.cumsum([float(x[1]) for x in asks]))
-    price = list([float(x[0]) for x in bids])[::-1] + list([float(x[0]) for x in asks])
+    volume = np.concatenate((np.cumsum(bids[:,1])[::-1], np.cumsum(asks[:,1])))
+    price = np.concatenate((bids[::-1,0], asks[:,0]))
 
     # get market price (average between largest bids and smallest asks)
-    market_price=(max([float(x[0]) for x in bids]) + min([float(x[0]) for x in asks]))/2
-    
+    market_price = (bids[0,0] + asks[0,0])/2
+
     # plot only +/- 20% around the market price
-    pr_vol = list(zip(price,volume))
-    volume=[v for p,v in pr_vol if p > interval[0]*market_price and p < interval[1]*market_price]
-    price=[p for p,v in pr_vol if p > interval[0]*market_price and p < interval[1]*market_price]
-    
-    return (price, volume)
-
-def plot_time(time):
-    query = kraken._select_from_OrderBook(time,pair="XXBTZEUR")
-    price,volume = query_cumsum(query)
+    idx = (price > interval[0]*market_price) & (price < interval[1]*market_price)
+
+    return (price[idx], volume[idx])
+
+def plot_time(kraken, time, pair="XXBTZEUR"):
+    _, asks, bids = next(kraken.iter_books(pair, [time]))
+    price,volume = query_cumsum(asks, bids)
     plt.plot(price,volume)
     plt.show()
 
-fig = plt.figure()
-ax = plt.axes(xlim=(300,1500),ylim=(0,5000))
-line, = ax.plot([],[])
+# figure of a rendering process
+fig = None
+line = None
+
+def _init_render(size, dpi, xlim, ylim):
+    """Create the figure of a rendering process
+
+    The frames are drawn off-screen, with the Agg backend. The backend
+    is selected here and not at import, so that plot_time shows its
+    plot with the default one.
+
+    """
+    global fig, line
+
+    plt.switch_backend('Agg')
+    fig = plt.figure(figsize=(size[0]/dpi, size[1]/dpi), dpi=dpi)
+    ax = plt.axes(xlim=xlim,ylim=ylim)
+    line, = ax.plot([],[])
+
+def _render(book):
+    """Render a frame
+
+    book --- tuple (time, asks, bids)
 
-def init():
-    line.set_data([],[])
-    return line,
+    return --- raw RGB bytes of the frame
 
-def animate(i):
-    print("Iteration: " + str(i))
-    # query depth book 
-    query = kraken._select_from_OrderBook(1480201200+i*300,pair="XXBTZEUR")
+    """
+    _, asks, bids = book
 
     # calculate accumulated price and volume
-    price,volume = query_cumsum(query)
+    if len(asks) and len(bids):
+        line.set_data(*query_cumsum(asks, bids))
+    else:
+        line.set_data([],[])
+
+    fig.canvas.draw()
+
+    return np.asarray(fig.canvas.buffer_rgba())[:,:,:3].tobytes()
+
+def animate(kraken, times, output, pair="XXBTZEUR", processes=os.cpu_count(),
+            size=(640,480), dpi=100, xlim=(300,1500), ylim=(0,5000), fps=12):
+    """Render the depth animation
+
+    The books of all frames are reconstructed in one pass
+    (KrakenData.iter_books), the frames are rendered by a pool of
+    processes and streamed in order to ffmpeg.
+
+    kraken --- KrakenData object
+    times --- sorted list of frame times
+    output --- output video file
+
+    """
+    ffmpeg = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                               '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                               '-s', '{}x{}'.format(*size), '-r', str(fps),
+                               '-i', '-', '-vcodec', 'libx264',
+                               '-pix_fmt', 'yuv420p', output],
+                              stdin=subprocess.PIPE)
+
+    with Pool(processes=processes, initializer=_init_render,
+              initargs=(size, dpi, xlim, ylim)) as pool:
+        # the books are read in this thread (the database connection
+        # cannot be shared), the number of frames in flight is bounded
+        pending = deque()
+        i = 0
+        for book in kraken.iter_books(pair, times):
+            pending.append(pool.apply_async(_render, (book,)))
+
+            while len(pending) >= 4*processes or \
+                  (len(pending) and pending[0].ready()):
+                print("Iteration: " + str(i))
+                ffmpeg.stdin.write(pending.popleft().get())
+                i += 1
+
+        while len(pending):
+            print("Iteration: " + str(i))
+            ffmpeg.stdin.write(pending.popleft().get())
+            i += 1
+
+    ffmpeg.stdin.close()
+    if ffmpeg.wait():
+        raise RuntimeError("ffmpeg failed")
 
-    # update plot
-    line.set_data(price, volume)
-    
-    return line,
-    
-anim = animation.FuncAnimation(fig,animate,init_func=init,
-                               frames=8640,interval=200,blit=True)
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='plot-depth', description='Render depth animation')
+    parser.add_argument('--db', default='data/data.db', type=str,
+                        help='Location of the database. Default: data/data.db')
+    parser.add_argument('-p','--pair', default='XXBTZEUR', type=str,
+                        help='Currency pair. Default: XXBTZEUR')
+    parser.add_argument('--start', default=1480201200, type=int,
+                        help='Time of the first frame. Default: 1480201200')
+    parser.add_argument('--step', default=300, type=int,
+                        help='Seconds between frames. Default: 300')
+    parser.add_argument('-n','--frames', default=8640, type=int,
+                        help='Number of frames. Default: 8640')
+    parser.add_argument('-j','--jobs', default=os.cpu_count(), type=int,
+                        help='Number of processes. Default: number of cores')
+    parser.add_argument('-o','--output', default='basic_animation.mp4', type=str,
+                        help='Output file. Default: basic_animation.mp4')
+    args = parser.parse_args()
 
-anim.save('basic_animation.mp4', fps=12, extra_args=['-vcodec', 'libx264'])
+    kraken = KrakenData(db_path=args.db, read_only=True)
 
-#plt.show()
+    animate(kraken, [args.start + i*args.step for i in range(args.frames)],
+            args.output, pair=args.pair, processes=args.jobs)
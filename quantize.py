@@ -0,0 +1,169 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""One-dimensional quantization
+
+A quantizer is a tuple (edges, centers): value x falls into bin
+searchsorted(edges, x), i.e. bin i holds the values in
+(edges[i-1], edges[i]], and is represented by centers[i].
+
+"""
+
+import numpy as np
+
+def _layer(D, S1, S2, first):
+    """One layer of the k-means dynamic programme
+
+    new[i] = min over j in [first, i] of D[j-1] + cost(j, i), where
+    cost(j, i) is the sum of squared deviations of x[j..i]. The
+    optimal j is non-decreasing in i, so the minima are found by
+    divide and conquer. All subproblems of a recursion level are
+    solved at once.
+
+    D --- costs of the previous layer, D[-1] is the cost of nothing
+    S1, S2 --- prefix sums of x and x^2 (with leading 0)
+    first --- least possible j
+
+    return --- tuple (new, arg) of np.arrays of length len(D)
+
+    """
+    n = len(D)
+    new = np.full(n, np.inf)
+    arg = np.zeros(n, dtype=int)
+
+    # subproblems: rows i in [ilo, ihi], candidates j in [jlo, jhi]
+    ilo = np.array([first])
+    ihi = np.array([n - 1])
+    jlo = np.array([first])
+    jhi = np.array([n - 1])
+
+    prev = np.concatenate(([0.0], D))
+
+    while len(ilo):
+        mid = (ilo + ihi)//2
+        hi = np.minimum(mid, jhi)
+        counts = hi - jlo + 1
+
+        task = np.repeat(np.arange(len(mid)), counts)
+        j = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + \
+            np.repeat(jlo, counts)
+        i = mid[task]
+
+        m = i - j + 1
+        s = S1[i+1] - S1[j]
+        cost = prev[j] + (S2[i+1] - S2[j]) - s*s/m
+
+        # first minimum of every subproblem, the candidates of a
+        # subproblem are contiguous
+        start = np.cumsum(counts) - counts
+        lowest = np.minimum.reduceat(cost, start)
+        best = np.flatnonzero(cost == lowest[task])
+        best = best[np.searchsorted(best, start)]
+
+        new[mid] = cost[best]
+        arg[mid] = j[best]
+
+        # left halves keep [jlo, opt], right halves [opt, jhi]
+        left = ilo < mid
+        right = mid < ihi
+        ilo, ihi, jlo, jhi = (np.concatenate((ilo[left], mid[right] + 1)),
+                              np.concatenate((mid[left] - 1, ihi[right])),
+                              np.concatenate((jlo[left], arg[mid][right])),
+                              np.concatenate((arg[mid][left], jhi[right])))
+
+    return new, arg
+
+def kmeans_edges(x, k):
+    """Optimal k-means (Jenks natural breaks) quantizer
+
+    The sum of squared deviations from the bin means is minimised
+    exactly by dynamic programming over the sorted values. There are
+    k-1 layers of O(n log n) each (see _layer), so the total is
+    O(k n log n) after the O(n log n) sort. The result is
+    deterministic.
+
+    x --- 1d np.array
+    k --- number of bins
+
+    return --- tuple (edges, centers), edges are the largest values of
+    all bins but the last, centers are the bin means
+
+    """
+    x = np.sort(np.asarray(x, dtype=float))
+    n = len(x)
+    k = min(k, n)
+
+    if 0 == k:
+        return (np.zeros(0), np.zeros(0))
+
+    S1 = np.concatenate(([0.0], np.cumsum(x)))
+    S2 = np.concatenate(([0.0], np.cumsum(x*x)))
+
+    i = np.arange(n)
+    D = S2[i+1] - S1[i+1]**2/(i+1)
+
+    args = []
+    for m in range(1, k):
+        D, arg = _layer(D, S1, S2, m)
+        args += [arg]
+
+    # the first index of every bin, from the last bin backwards
+    starts = []
+    i = n - 1
+    for arg in reversed(args):
+        starts += [arg[i]]
+        i = arg[i] - 1
+    starts = np.array([0] + starts[::-1], dtype=int)
+
+    ends = np.append(starts[1:], n)
+    centers = (S1[ends] - S1[starts])/(ends - starts)
+
+    return (x[ends[:-1] - 1], centers)
+
+def quantile_edges(x, k):
+    """Equal-frequency quantizer
+
+    x --- 1d np.array
+    k --- number of bins
+
+    return --- tuple (edges, centers), see kmeans_edges. Bins of
+    repeated values are merged, there might be fewer than k
+
+    """
+    x = np.sort(np.asarray(x, dtype=float))
+
+    if 0 == len(x):
+        return (np.zeros(0), np.zeros(0))
+
+    edges = np.unique(np.quantile(x, np.arange(1, k)/k, method = 'inverted_cdf'))
+    edges = edges[edges < x[-1]]
+
+    bins = np.searchsorted(edges, x)
+    centers = np.bincount(bins, weights = x)/np.bincount(bins)
+
+    return (edges, centers)
+
+def quantize(x, edges, centers):
+    """Replace values by the centers of their bins
+
+    x --- np.array
+    edges, centers --- quantizer, see kmeans_edges
+
+    return --- np.array of the shape of x
+
+    """
+    return centers[np.searchsorted(edges, x)]
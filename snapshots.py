@@ -0,0 +1,266 @@
+#!/bin/env python3
+
+# This is part of kraken-tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content-addressed store of arbitrage logs
+
+Artifacts of a run (order books, pairs, solution, LP text) are kept
+as zlib-compressed blobs named by the sha256 of their content, so that
+an artifact which does not change between runs (e.g. pairs) is stored
+once. An index table maps the run times to the blobs.
+
+The layout of a store directory is
+
+    index.db             --- sqlite table runs (time, name, kind, blob)
+    blobs/ab/cdef...     --- blob with hash abcdef...
+
+Order books are stored in a binary format: a json header with the
+pairs and the numbers of asks and bids, followed by the float64
+(price, volume, timestamp) rows.
+
+Running the module lists the runs of a store, or exports a run to
+files (orderbook.json, pairs.json, ...) as log_arbitrage used to
+write them.
+
+"""
+
+from argparse import ArgumentParser
+
+import hashlib
+
+import json
+
+import logging
+
+import os
+
+import sqlite3
+
+import struct
+
+import zlib
+
+import numpy as np
+
+_HEADER = struct.Struct('<I')
+
+def encode_orderbook(orderbook):
+    """Binary form of an order book
+
+    orderbook --- whatever functions.query_orderbook returns
+
+    return --- bytes
+
+    """
+    header = []
+    rows = []
+    for key, item in orderbook.items():
+        for name, book in item.items():
+            asks = np.asarray(book['asks'], dtype=float)
+            bids = np.asarray(book['bids'], dtype=float)
+
+            # an empty side has no rows to take the width from
+            width = next((x.shape[1] for x in (asks, bids) if 2 == x.ndim), 3)
+            asks = asks.reshape(-1, width)
+            bids = bids.reshape(-1, width)
+            header += [[key, name, len(asks), len(bids), width]]
+            rows += [asks.reshape(-1), bids.reshape(-1)]
+
+    header = json.dumps(header, separators = (',', ':')).encode()
+    data = np.concatenate(rows).astype('<f8') if len(rows) else np.zeros(0, dtype='<f8')
+
+    return _HEADER.pack(len(header)) + header + data.tobytes()
+
+def decode_orderbook(data):
+    """Order book from its binary form
+
+    data --- bytes given by encode_orderbook
+
+    return --- order book as query_orderbook returns, with asks and
+    bids as np.array
+
+    """
+    n, = _HEADER.unpack_from(data)
+    header = json.loads(data[_HEADER.size:_HEADER.size + n].decode())
+    rows = np.frombuffer(data, dtype='<f8', offset = _HEADER.size + n)
+
+    res = {}
+    i = 0
+    for key, name, n_asks, n_bids, width in header:
+        asks = rows[i:i + n_asks*width].reshape(n_asks, width)
+        i += n_asks*width
+        bids = rows[i:i + n_bids*width].reshape(n_bids, width)
+        i += n_bids*width
+        res.setdefault(key, {})[name] = {'asks': asks, 'bids': bids}
+
+    return res
+
+# kinds of artifacts: (encode, decode)
+_kinds = {'json': (lambda x: json.dumps(x, sort_keys = True, separators = (',', ':')).encode(),
+                   lambda x: json.loads(x.decode())),
+          'text': (lambda x: x.encode(), lambda x: x.decode()),
+          'orderbook': (encode_orderbook, decode_orderbook)}
+
+class SnapshotStore(object):
+    """Store of arbitrage logs, see the module description"""
+
+    def __init__(self, path, level = 6):
+        """Constructor
+
+        path --- store directory, created if missing
+        level --- zlib compression level
+
+        """
+        self._path = path
+        self._level = level
+
+        os.makedirs(os.path.join(path, "blobs"), exist_ok = True)
+
+        self._dbconn = sqlite3.connect(os.path.join(path, "index.db"), timeout = 60)
+        self._dbconn.execute('''
+        CREATE TABLE IF NOT EXISTS runs
+        (
+        time REAL NOT NULL,                       -- run time
+        name TEXT NOT NULL,                       -- artifact name
+        kind TEXT NOT NULL,                       -- json, text or orderbook
+        blob TEXT NOT NULL,                       -- sha256 of the content
+        CONSTRAINT uc_artifact UNIQUE (time, name)
+        )''')
+        self._dbconn.commit()
+
+    def _blob_path(self, blob):
+        return os.path.join(self._path, "blobs", blob[:2], blob[2:])
+
+    def put(self, data):
+        """Store bytes
+
+        data --- bytes
+
+        return --- blob id (sha256 hex digest)
+
+        """
+        blob = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(blob)
+
+        if os.path.exists(path):
+            return blob
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(zlib.compress(data, self._level))
+        os.replace(path + ".tmp", path)
+
+        return blob
+
+    def get(self, blob):
+        """Bytes of a blob"""
+        with open(self._blob_path(blob), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def log(self, time, artifacts):
+        """Store artifacts of a run
+
+        time --- run time
+        artifacts --- dict name -> (kind, value), kind is 'json',
+        'text' or 'orderbook'
+
+        return --- dict name -> blob id
+
+        """
+        res = {}
+        for name, (kind, value) in artifacts.items():
+            res[name] = self.put(_kinds[kind][0](value))
+
+        c = self._dbconn.cursor()
+
+        try:
+            c.executemany('''
+            INSERT OR REPLACE INTO runs (time, name, kind, blob) VALUES (?,?,?,?)
+            ''', [(time, name, artifacts[name][0], blob) for name, blob in res.items()])
+        except Exception as e:
+            logging.error("Error with insertion to the snapshot index",e)
+            self._dbconn.rollback()
+            raise e
+
+        self._dbconn.commit()
+
+        return res
+
+    def runs(self, start = None, end = None):
+        """Times of the stored runs
+
+        start, end --- optional time interval (inclusive)
+
+        return --- sorted list
+
+        """
+        c = self._dbconn.cursor()
+        c.execute('''
+        SELECT DISTINCT time FROM runs WHERE time >= ? AND time <= ? ORDER BY time
+        ''', (float('-inf') if start is None else start,
+              float('inf') if end is None else end))
+
+        return [x[0] for x in c.fetchall()]
+
+    def load(self, time, name = None):
+        """Artifacts of a run
+
+        time --- run time
+        name --- artifact name. Default: all artifacts
+
+        return --- value of the artifact, or dict name -> value
+
+        """
+        c = self._dbconn.cursor()
+        c.execute('SELECT name, kind, blob FROM runs WHERE time = ?', (time,))
+
+        res = {x: _kinds[kind][1](self.get(blob)) for x, kind, blob in c.fetchall()
+               if name is None or x == name}
+
+        if name is None:
+            return res
+
+        if name not in res:
+            raise KeyError("No artifact " + name + " in run " + str(time))
+
+        return res[name]
+
+    def close(self):
+        self._dbconn.close()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='snapshots',
+                            description='List or export runs of an arbitrage log store')
+    parser.add_argument('store', type=str, help='Store directory')
+    parser.add_argument('--run', default=None, type=float,
+                        help='Run time to export. Default: list the runs')
+    parser.add_argument('-o','--output', default='.', type=str,
+                        help='Output directory of the export. Default: .')
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.store)
+
+    if args.run is None:
+        for t in store.runs():
+            print(repr(t))
+    else:
+        os.makedirs(args.output, exist_ok = True)
+        for name, value in store.load(args.run).items():
+            with open(os.path.join(args.output, name), 'w') as f:
+                if isinstance(value, str):
+                    f.write(value)
+                else:
+                    json.dump(value, f, default = lambda x: x.tolist())
@@ -1,84 +1,26 @@
 #!/bin/env python3
 
 import numpy as np
-from sklearn import svm
-from sklearn.model_selection import KFold, cross_val_score
-from sklearn.model_selection import StratifiedKFold
-import json
+import os
+import pickle
+from sklearn.linear_model import SGDClassifier
+from dataset import FeatureDataset
+from labels import get_classes
 from sklearn import preprocessing
 
+dataset = FeatureDataset("orderBook_0.1_400")
 
-def get_classes(data, T, rho):
-    """Get classes for classification from the market price changes. Class
-    1 if price has increased at least linearly with rate rho until
-    time point T (that corresponds to T*time interval data). Class -1
-    if price decreased analogously. Class 0 if price doesn't belong to
-    class 1 or -1.
+# labels of every partition, the price changes are not taken
+# across the gaps between partitions
+labels = dataset.labels(get_classes,5,0.0042/2)
+Y = np.concatenate(labels)
 
-    data --- orderBook data
+# number of prior time points in a feature vector
+T = 5
 
-    T --- time period for price rise/decrease
-
-    rho --- rate of increase/decrease to make classes
-
-    """
-    price = [x[1] for x in data]
-    
-    # calculate price change in percentage
-    diff=[]
-    for i in range(1,T):
-        diff+=[(np.array(price[i:])/np.array(price[:-i])-1)[:-(T-i)]]
-
-    # get index of times when price rose more than .0042 after t*3 minutes
-    i_pos = ~np.zeros(len(diff[0]),dtype=bool)
-    for x in range(0,T):
-        i_pos = i_pos & (diff[x-1] > rho*x)
-
-    i_neg = ~np.zeros(len(diff[0]),dtype=bool)
-    for x in range(0,T):
-        i_neg = i_neg & (diff[x-1] < -rho*x)
-
-    res=np.zeros(len(data) - T,dtype=np.int)
-    res[i_pos] = 1
-    res[i_neg] = -1
-
-    return res
-
-def get_features(data, T=1, standardise=True):
-    """Combine orders in a table combining several time points together
-
-    data --- orderBook data
-
-    T --- number of prior time points to combine
-
-    standardise --- 
-    """
-    orders= [x[0] for x in data]
-
-    #orders = [list(np.array(x)/sum(x)) for x in orders]
-
-    return orders
-
-with open("orderBook_0.1_400.json") as x:
-    data = json.load(x)
-
-Y = get_classes(data,5,0.0042/2)
-X = get_features(data)
-
-X = X[40000:len(Y)]
-Y = Y[40000:len(Y)]
-
-X = [x[(len(x)/2 - 2):(len(x)/2 + 3)] for x in X]
-
-#X = [list(np.array(x)/sum(x)) for x in X]
-
-# just put noise
-X = np.random.randn(len(X),5)
-
-#X = preprocessing.scale(X)
-
-print(X[1:10])
-print(Y[1:10])
+# rows used for training and testing
+train = (40000, 40000 + (len(dataset) - 40000)*2//3)
+test = (train[1], len(dataset))
 
 #weights = {1: sum(Y == 1)/len(Y), -1: sum(Y == -1)/len(Y), 0: sum(Y == 0)/len(Y)}
 weights = {1: len(Y)/sum(Y == 1), -1: len(Y)/sum(Y == -1), 0: len(Y)/sum(Y == 0)}
@@ -90,15 +32,37 @@ print("Positive: " + str(sum(Y == 1)))
 print("Negative: " + str(sum(Y == -1)))
 print("Zero: " + str(sum(Y == 0)))
 
-svc = svm.SVC(C=1.0,cache_size=5000,kernel='rbf', gamma='auto',
-              class_weight = weights)
+# linear SVM trained incrementally, the windows are streamed in
+# mini-batches from the memory-mapped features
+svc = SGDClassifier(loss='hinge', alpha=1e-4, class_weight=weights)
+scaler = preprocessing.StandardScaler()
+
+print("fit...")
+
+for X, y in dataset.iter_batches(T, labels, start=train[0], stop=train[1]):
+    scaler.partial_fit(X)
+
+for epoch in range(5):
+    for X, y in dataset.iter_batches(T, labels, start=train[0], stop=train[1]):
+        svc.partial_fit(scaler.transform(X), y, classes=[-1, 0, 1])
+
+print("test...")
 
-print("do cv...")
+correct = 0
+total = 0
+for X, y in dataset.iter_batches(T, labels, start=test[0], stop=test[1]):
+    correct += np.sum(svc.predict(scaler.transform(X)) == y)
+    total += len(y)
 
-k_fold = KFold(n_splits=2)
+print(correct/total)
 
-skf = StratifiedKFold(n_splits=3)
+# the model and the scaler are loaded by the live predictions of the
+# logger (krak logger --predict, see inference.LiveInference), which
+# uses the same T, horizon and rate
+model_path = os.path.expanduser("~/.krak/model.pickle")
+os.makedirs(os.path.dirname(model_path), exist_ok=True)
+with open(model_path + ".tmp", 'wb') as f:
+    pickle.dump((svc, scaler), f)
+os.replace(model_path + ".tmp", model_path)
 
-score = cross_val_score(svc, X, Y, cv=skf, n_jobs=-1)
-    
-print(score)
+print("model saved to " + model_path)